@@ -0,0 +1,236 @@
+"""
+批改准入控制与优先级调度：限制同时进行的上游批改数量，并按客户端 IP 限速，防止个别用户脚本刷提交挤占高峰期资源。
+
+- 所有上游批改共用 GRADE_CONCURRENCY 个槽位，按优先级类别排队：small（小题）、essay（大作文）、image（拍照作答）
+- 槽位空出时，在各类别队首中选「权重 ×（1 + 已等待秒数 / GRADE_AGING_SECONDS）」最大者：
+  小题权重高，大作文集中涌入时小题仍能优先拿到槽位；排得久的大作文 / 图片请求优先级随等待时间上升，不会饿死
+- 每个类别还有自己的并发上限（大作文、图片默认只能占一部分槽位，剩余的始终留给小题）与有界等待队列（类别内先到先得）
+- 队列已满或等待超时抛出 Rejected，由调用方返回 429 + Retry-After
+- 每个客户端 IP 一个令牌桶（每分钟补充 GRADE_IP_RATE_PER_MINUTE 个，最多攒 GRADE_IP_BURST 个）
+
+只在事件循环线程中使用，不需要加锁。
+
+环境变量：
+  GRADE_CONCURRENCY          - 上游批改总并发，默认 20
+  GRADE_AGING_SECONDS        - 等待多少秒优先级翻一倍，默认 10
+  GRADE_SMALL_CONCURRENCY    - 小题并发上限，默认不单独限制（等于总并发）
+  GRADE_SMALL_QUEUE          - 小题等待队列长度，默认 32
+  GRADE_SMALL_WEIGHT         - 小题权重，默认 6
+  GRADE_ESSAY_CONCURRENCY    - 大作文并发上限，默认 8
+  GRADE_ESSAY_QUEUE          - 大作文等待队列长度，默认 12
+  GRADE_ESSAY_WEIGHT         - 大作文权重，默认 2
+  GRADE_IMAGE_CONCURRENCY    - 拍照作答并发上限，默认 8
+  GRADE_IMAGE_QUEUE          - 拍照作答等待队列长度，默认 12
+  GRADE_IMAGE_WEIGHT         - 拍照作答权重，默认 2
+  GRADE_QUEUE_WAIT_SECONDS   - 队列中最长等待时间，默认 30
+  GRADE_IP_RATE_PER_MINUTE   - 每个 IP 每分钟可提交次数，默认 30（学校等共用出口 IP 的场景留有余量）；设为 0 不限速
+  GRADE_IP_BURST             - 每个 IP 可连续提交的次数，默认 10
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_CONCURRENCY = max(1, int(os.getenv("GRADE_CONCURRENCY") or 20))
+_AGING_SECONDS = float(os.getenv("GRADE_AGING_SECONDS") or 10)
+_QUEUE_WAIT_SECONDS = float(os.getenv("GRADE_QUEUE_WAIT_SECONDS") or 30)
+_IP_RATE_PER_MINUTE = float(os.getenv("GRADE_IP_RATE_PER_MINUTE") or 30)
+_IP_BURST = float(os.getenv("GRADE_IP_BURST") or 10)
+_IP_BUCKETS_MAX = 10000
+_WAIT_SAMPLES = 200             # 每个类别保留的最近排队耗时样本数
+
+
+class Rejected(Exception):
+    """准入被拒：retry_after 为建议的重试等待秒数。"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Class:
+    """优先级类别：并发上限 limit、权重 weight、最多 queue_size 个排队者（类别内 FIFO）。"""
+
+    def __init__(self, name: str, env: str, limit: int, queue_size: int, weight: float):
+        self.name = name
+        self.limit = max(1, min(_CONCURRENCY, int(os.getenv(f"GRADE_{env}_CONCURRENCY") or limit)))
+        self.queue_size = max(0, int(os.getenv(f"GRADE_{env}_QUEUE") or queue_size))
+        self.weight = max(0.01, float(os.getenv(f"GRADE_{env}_WEIGHT") or weight))
+        self.active = 0
+        self.waiters: Deque[Tuple[asyncio.Future, float]] = deque()    # (future, 入队时间)
+        self.avg_hold_seconds = 20.0       # 槽位平均占用时长（EWMA），用于估算 Retry-After
+        self.counters = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_timeout": 0}
+        self.max_queue_depth = 0
+        self.wait_seconds_total = 0.0
+        self.waits: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+
+    def priority(self, now: float) -> float:
+        return self.weight * (1.0 + (now - self.waiters[0][1]) / _AGING_SECONDS)
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil((len(self.waiters) + 1) / self.limit * self.avg_hold_seconds))
+
+    def note_wait(self, seconds: float):
+        self.wait_seconds_total += seconds
+        self.waits.append(seconds)
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        waits = sorted(self.waits)
+        return dict(
+            self.counters,
+            limit=self.limit,
+            weight=self.weight,
+            queue_size=self.queue_size,
+            active=self.active,
+            queued_now=len(self.waiters),
+            max_queue_depth=self.max_queue_depth,
+            oldest_wait_seconds=round(now - self.waiters[0][1], 2) if self.waiters else 0,
+            wait_p50_seconds=round(waits[len(waits) // 2], 3) if waits else None,
+            wait_p95_seconds=round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else None,
+            wait_seconds_total=round(self.wait_seconds_total, 2),
+            avg_hold_seconds=round(self.avg_hold_seconds, 2),
+        )
+
+
+_classes: Dict[str, _Class] = {
+    "small": _Class("小题", "SMALL", _CONCURRENCY, 32, 6),
+    "essay": _Class("大作文", "ESSAY", 8, 12, 2),
+    "image": _Class("拍照作答", "IMAGE", 8, 12, 2),
+}
+_active = 0
+_ip_buckets: Dict[str, Tuple[float, float]] = {}    # ip -> (令牌数, 上次补充时间)
+_ip_counters = {"allowed": 0, "rejected": 0}
+
+
+def _can_start(c: _Class) -> bool:
+    return _active < _CONCURRENCY and c.active < c.limit
+
+
+def _start(c: _Class):
+    global _active
+    _active += 1
+    c.active += 1
+    c.counters["admitted"] += 1
+
+
+def _dispatch():
+    """把空出的槽位按优先级分给各类别的队首。"""
+    while _active < _CONCURRENCY:
+        now = time.monotonic()
+        for c in _classes.values():
+            while c.waiters and c.waiters[0][0].done():
+                c.waiters.popleft()
+        ready = [c for c in _classes.values() if c.waiters and c.active < c.limit]
+        if not ready:
+            return
+        c = max(ready, key=lambda c: c.priority(now))
+        fut, _ = c.waiters.popleft()
+        _start(c)
+        fut.set_result(True)
+
+
+def _abandon(c: _Class, fut: asyncio.Future):
+    """放弃排队；若槽位恰好已分给自己，则归还。"""
+    if fut.done() and not fut.cancelled():
+        _release(c, 0.0)
+        return
+    fut.cancel()
+    for entry in c.waiters:
+        if entry[0] is fut:
+            c.waiters.remove(entry)
+            break
+
+
+def _release(c: _Class, held_seconds: float):
+    global _active
+    if held_seconds > 0:
+        c.avg_hold_seconds = 0.8 * c.avg_hold_seconds + 0.2 * held_seconds
+    _active -= 1
+    c.active -= 1
+    _dispatch()
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def check_client(ip: Optional[str]):
+    """按 IP 限速：令牌不足时抛出 Rejected。未知 IP 不限速。"""
+    if not ip or _IP_RATE_PER_MINUTE <= 0:
+        return
+    now = time.monotonic()
+    tokens, last = _ip_buckets.get(ip, (_IP_BURST, now))
+    tokens = min(_IP_BURST, tokens + (now - last) * _IP_RATE_PER_MINUTE / 60.0)
+    if tokens < 1.0:
+        _ip_buckets[ip] = (tokens, now)
+        _ip_counters["rejected"] += 1
+        raise Rejected("提交过于频繁", max(1, math.ceil((1.0 - tokens) * 60.0 / _IP_RATE_PER_MINUTE)))
+    _ip_buckets[ip] = (tokens - 1.0, now)
+    _ip_counters["allowed"] += 1
+    if len(_ip_buckets) > _IP_BUCKETS_MAX:
+        # 清理已经补满的桶（长时间未提交的 IP）
+        full_after = _IP_BURST * 60.0 / _IP_RATE_PER_MINUTE
+        for key in [k for k, (_, t) in _ip_buckets.items() if now - t > full_after]:
+            _ip_buckets.pop(key, None)
+
+
+async def acquire(cls: str, max_wait: Optional[float] = None, background: bool = False) -> float:
+    """为类别 cls（small / essay / image）占用一个槽位，返回占用开始时间，用完须调用 release(cls, 开始时间)。
+
+    排队最多等待 min(max_wait, GRADE_QUEUE_WAIT_SECONDS) 秒；background=True（后台任务）时不受队列长度与等待时间限制。
+    """
+    c = _classes[cls]
+    if not c.waiters and _can_start(c):
+        _start(c)
+        c.note_wait(0.0)
+        return time.monotonic()
+    if not background and len(c.waiters) >= c.queue_size:
+        c.counters["rejected_full"] += 1
+        raise Rejected(f"{c.name}批改排队已满", c.retry_after())
+    if background:
+        wait = None
+    else:
+        wait = _QUEUE_WAIT_SECONDS if max_wait is None else min(max_wait, _QUEUE_WAIT_SECONDS)
+    fut = asyncio.get_running_loop().create_future()
+    queued_at = time.monotonic()
+    c.waiters.append((fut, queued_at))
+    c.counters["queued"] += 1
+    c.max_queue_depth = max(c.max_queue_depth, len(c.waiters))
+    _dispatch()
+    try:
+        await asyncio.wait({fut}, timeout=wait)
+    except asyncio.CancelledError:
+        _abandon(c, fut)
+        raise
+    finally:
+        c.note_wait(time.monotonic() - queued_at)
+    if not fut.done():
+        _abandon(c, fut)
+        c.counters["rejected_timeout"] += 1
+        raise Rejected(f"{c.name}批改排队超时", c.retry_after())
+    return time.monotonic()
+
+
+def check_capacity(cls: str):
+    """该类别拿不到槽位且等待队列已满（此时 acquire 必然被拒绝）时抛出 Rejected。"""
+    c = _classes[cls]
+    if not _can_start(c) and len(c.waiters) >= c.queue_size:
+        c.counters["rejected_full"] += 1
+        raise Rejected(f"{c.name}批改排队已满", c.retry_after())
+
+
+def release(cls: str, started: float):
+    _release(_classes[cls], time.monotonic() - started)
+
+
+def get_stats() -> Dict[str, Any]:
+    now = time.monotonic()
+    return {
+        "concurrency": _CONCURRENCY,
+        "active": _active,
+        "aging_seconds": _AGING_SECONDS,
+        "classes": {name: c.stats(now) for name, c in _classes.items()},
+        "ip": dict(_ip_counters, tracked=len(_ip_buckets), rate_per_minute=_IP_RATE_PER_MINUTE, burst=_IP_BURST),
+    }
@@ -0,0 +1,206 @@
+"""
+拍照作答的 multipart/form-data 上传：图片以二进制文件部分上传，不再以 base64 data URL 嵌在 JSON 里。
+
+- 按 Content-Length 提前拒绝过大的请求（不读请求体）；没有 Content-Length 的请求直接拒绝
+- 图片由 Starlette 写入 SpooledTemporaryFile（超过 1MB 落盘），这里只做一遍分块扫描：
+  校验大小、计算 base64 文本的 sha256（与 JSON 上传同一张图的缓存键一致）
+- 发给上游的 JSON 中，图片位置直接放 UploadedImage.base64_field() / data_url() 返回的占位对象，encode_json 序列化时
+  只解析该 payload 自身带的图片；含图片时返回 EncodedJson，发送时逐段产出请求体，图片从临时文件分块 base64 编码，
+  内存中不会拼出完整的 base64 或请求体
+
+环境变量：
+  GRADE_UPLOAD_MAX_BYTES        - 整个上传请求的最大字节数，默认 25MB
+  GRADE_UPLOAD_MAX_IMAGE_BYTES  - 单张图片最大字节数，默认 10MB
+  GRADE_UPLOAD_MAX_IMAGES       - 最多图片数，默认 8
+"""
+
+import base64
+import hashlib
+import json
+import os
+import uuid
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_MAX_BYTES = int(os.getenv("GRADE_UPLOAD_MAX_BYTES") or 25 * 1024 * 1024)
+_MAX_IMAGE_BYTES = int(os.getenv("GRADE_UPLOAD_MAX_IMAGE_BYTES") or 10 * 1024 * 1024)
+_MAX_IMAGES = int(os.getenv("GRADE_UPLOAD_MAX_IMAGES") or 8)
+_CHUNK_BYTES = 3 * 64 * 1024    # 3 的倍数：分块 base64 编码后直接拼接即为整体编码
+_ALLOWED_MIME = ("image/jpeg", "image/png", "image/webp", "image/heic", "image/heif")
+_TOKEN_PREFIX = "@@answer-image-"
+
+
+class UploadRejected(Exception):
+    """上传不符合要求：status 为应返回的 HTTP 状态码。"""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+class UploadedImage:
+    """一张上传的作答图片：file 为已写完的临时文件，token 为其在序列化 JSON 中的占位符（只在所属 payload 内解析）。"""
+
+    def __init__(self, file: BinaryIO, mime: str, filename: str = ""):
+        self.file = file
+        self.mime = mime
+        self.filename = filename
+        self.size = 0
+        self.digest = ""        # base64 文本的 sha256
+        self.token = f"{_TOKEN_PREFIX}{uuid.uuid4().hex}@@"
+
+    def scan(self):
+        """分块读一遍文件：统计大小并计算 base64 文本的 sha256。"""
+        h = hashlib.sha256()
+        size = 0
+        for chunk in self.raw_chunks():
+            size += len(chunk)
+            h.update(base64.b64encode(chunk))
+        self.size = size
+        self.digest = h.hexdigest()
+
+    def raw_chunks(self) -> Iterator[bytes]:
+        """分块读出原始字节。"""
+        # 每次读之前按自己的偏移 seek：同一张图可能被两个上游请求（对冲）交替读取
+        offset = 0
+        while True:
+            self.file.seek(offset)
+            chunk = self.file.read(_CHUNK_BYTES)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+    def base64_chunks(self) -> Iterator[bytes]:
+        for chunk in self.raw_chunks():
+            yield base64.b64encode(chunk)
+
+    def base64_size(self) -> int:
+        return (self.size + 2) // 3 * 4
+
+    def base64_field(self) -> "_Placeholder":
+        """放在 JSON 中图片 base64 字段的位置（如 Gemini 的 inlineData.data），由 encode_json 展开。"""
+        return _Placeholder(self, "")
+
+    def data_url(self) -> "_Placeholder":
+        """放在 JSON 中 data URL 字段的位置（如 OpenAI 的 image_url.url），由 encode_json 展开。"""
+        return _Placeholder(self, f"data:{self.mime};base64,")
+
+
+class _Placeholder:
+    def __init__(self, image: UploadedImage, prefix: str):
+        self.image = image
+        self.prefix = prefix
+
+
+class EncodedJson:
+    """含上传图片的请求体：可重复异步迭代（每次重试重新分块读文件），len() 为总字节数。
+
+    作为 httpx 的 content 时需另带 Content-Length 请求头（见 content_headers），否则 httpx 会改用分块传输编码。
+    """
+
+    def __init__(self, segments: List[Union[bytes, UploadedImage]]):
+        self._segments = segments
+
+    def __len__(self) -> int:
+        return sum(len(s) if isinstance(s, bytes) else s.base64_size() for s in self._segments)
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for segment in self._segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                for chunk in segment.base64_chunks():
+                    yield chunk
+
+
+def encode_json(obj: Any) -> Union[bytes, EncodedJson]:
+    """与 json.dumps(obj, ensure_ascii=False).encode("utf-8") 相同；obj 中含 UploadedImage 占位对象时返回 EncodedJson。"""
+    images: Dict[str, UploadedImage] = {}
+
+    def default(value: Any) -> str:
+        if isinstance(value, _Placeholder):
+            images[value.image.token] = value.image
+            return value.prefix + value.image.token
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    data = json.dumps(obj, ensure_ascii=False, default=default).encode("utf-8")
+    if not images:
+        return data
+    segments: List[Union[bytes, UploadedImage]] = []
+    pos = 0
+    while True:
+        start = data.find(_TOKEN_PREFIX.encode(), pos)
+        if start == -1:
+            break
+        end = data.find(b"@@", start + len(_TOKEN_PREFIX))
+        if end == -1:
+            break
+        end += 2
+        image = images.get(data[start:end].decode("ascii"))
+        if image is None:       # 用户文本中恰好出现的同形字符串，原样保留
+            segments.append(data[pos:end])
+        else:
+            segments.append(data[pos:start])
+            segments.append(image)
+        pos = end
+    segments.append(data[pos:])
+    return EncodedJson(segments)
+
+
+def content_headers(data: Union[bytes, EncodedJson], headers: Dict[str, str]) -> Dict[str, str]:
+    """EncodedJson 请求体补上 Content-Length（httpx 对异步迭代的请求体默认使用分块传输编码）。"""
+    if isinstance(data, EncodedJson):
+        return dict(headers, **{"Content-Length": str(len(data))})
+    return headers
+
+
+def check_content_length(headers: Dict[str, str]):
+    """读取请求体之前按 Content-Length 拒绝过大的上传。"""
+    length = headers.get("content-length")
+    if length is None:
+        raise UploadRejected(411, "上传请求缺少 Content-Length。")
+    try:
+        n = int(length)
+    except ValueError:
+        raise UploadRejected(400, "Content-Length 无效。")
+    if n > _MAX_BYTES:
+        raise UploadRejected(413, f"上传内容过大（{n / 1024 / 1024:.1f}MB），上限 {_MAX_BYTES / 1024 / 1024:.1f}MB，请压缩图片或减少图片数量。")
+
+
+def parse_form(form: Any) -> Tuple[Dict[str, Any], List[UploadedImage]]:
+    """解析批改表单：payload 字段为与 /api/grade 相同的 JSON（不含 answer_images），images 字段为图片文件（可多个）。"""
+    raw = form.get("payload")
+    try:
+        payload = json.loads(raw) if raw else {}
+    except (TypeError, ValueError):
+        raise UploadRejected(400, "payload 字段不是合法的 JSON。")
+    if not isinstance(payload, dict):
+        raise UploadRejected(400, "payload 字段必须是 JSON 对象。")
+    files = [f for f in form.getlist("images") if not isinstance(f, str)]
+    if len(files) > _MAX_IMAGES:
+        raise UploadRejected(413, f"图片数量过多（{len(files)} 张），最多 {_MAX_IMAGES} 张。")
+    images: List[UploadedImage] = []
+    for f in files:
+        mime = (f.content_type or "image/jpeg").split(";")[0].strip().lower()
+        if mime == "image/jpg":
+            mime = "image/jpeg"
+        if mime not in _ALLOWED_MIME:
+            raise UploadRejected(415, f"不支持的图片格式：{mime}")
+        image = UploadedImage(f.file, mime, f.filename or "")
+        image.scan()
+        if image.size > _MAX_IMAGE_BYTES:
+            raise UploadRejected(413, f"图片 {image.filename or len(images) + 1} 过大（{image.size / 1024 / 1024:.1f}MB），单张上限 {_MAX_IMAGE_BYTES / 1024 / 1024:.1f}MB。")
+        if image.size:
+            images.append(image)
+    return payload, images
+
+
+def max_images() -> int:
+    return _MAX_IMAGES
+
+
+def describe(image: Any) -> Optional[int]:
+    """日志用：图片大小（data URL 为字符数，上传文件为字节数）。"""
+    return image.size if isinstance(image, UploadedImage) else len(image)
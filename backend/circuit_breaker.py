@@ -0,0 +1,196 @@
+"""
+上游熔断器：按上游（gemini / qianduoduo）和按 Key（gemini#0、gemini#1 …）分别统计最近一段时间的
+错误率与耗时，状态为 closed（正常）→ open（熔断，直接跳过）→ half_open（放少量探测请求）→ closed。
+
+- 滚动窗口 BREAKER_WINDOW_SECONDS 内请求数达到 BREAKER_MIN_REQUESTS，且失败率或慢调用率
+  超过 BREAKER_ERROR_RATE 时熔断；慢调用指耗时超过 BREAKER_SLOW_CALL_SECONDS
+- 单个 Key 遇到配额/限流（429）立即熔断，不必等错误率累积
+- 熔断时长从 BREAKER_OPEN_SECONDS 开始，探测失败一次翻倍，最长 BREAKER_MAX_OPEN_SECONDS；探测成功即恢复
+- order() 按实时健康度给上游排序，供批改路由使用（健康度相同时保持调用方给出的顺序）
+
+只统计能反映上游健康的结果：网络错误、超时、429、5xx 记为失败，其余 HTTP 响应记为成功
+（400 之类是请求本身的问题，安全过滤导致的空结果也不算上游故障）。
+
+环境变量：
+  BREAKER_WINDOW_SECONDS     - 滚动窗口，默认 120
+  BREAKER_MIN_REQUESTS       - 判定熔断所需的最少请求数，默认 5
+  BREAKER_ERROR_RATE         - 失败率 / 慢调用率阈值，默认 0.5
+  BREAKER_SLOW_CALL_SECONDS  - 慢调用阈值，默认 75
+  BREAKER_OPEN_SECONDS       - 首次熔断时长，默认 30
+  BREAKER_MAX_OPEN_SECONDS   - 最长熔断时长，默认 1800
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS") or 120)
+_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS") or 5)
+_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE") or 0.5)
+_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS") or 75)
+_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS") or 30)
+_MAX_OPEN_SECONDS = float(os.getenv("BREAKER_MAX_OPEN_SECONDS") or 1800)
+_PROBE_TIMEOUT_SECONDS = 180    # 探测请求超过该时长仍未回报结果（如被取消）时允许下一次探测
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+_STATE_RANK = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_lock = threading.Lock()
+_breakers: Dict[str, Dict[str, Any]] = {}
+
+
+def _breaker_locked(name: str) -> Dict[str, Any]:
+    b = _breakers.get(name)
+    if b is None:
+        b = _breakers[name] = {
+            "state": CLOSED,
+            "calls": deque(),           # (时间, 是否成功, 耗时)
+            "open_until": 0.0,
+            "open_seconds": _OPEN_SECONDS,
+            "probe_started": 0.0,
+            "opened": 0,
+            "rejected": 0,
+            "reason": None,
+        }
+    return b
+
+
+def _trim_locked(b: Dict[str, Any], now: float):
+    calls: Deque[Tuple[float, bool, float]] = b["calls"]
+    while calls and calls[0][0] < now - _WINDOW_SECONDS:
+        calls.popleft()
+
+
+def _rates_locked(b: Dict[str, Any]) -> Tuple[int, float, float]:
+    calls = b["calls"]
+    n = len(calls)
+    if not n:
+        return (0, 0.0, 0.0)
+    failures = sum(1 for _, ok, _ in calls if not ok)
+    slow = sum(1 for _, ok, latency in calls if ok and latency >= _SLOW_CALL_SECONDS)
+    return (n, failures / n, slow / n)
+
+
+def _open_locked(b: Dict[str, Any], now: float, seconds: float, reason: str):
+    b["state"] = OPEN
+    b["open_until"] = now + seconds
+    b["probe_started"] = 0.0
+    b["opened"] += 1
+    b["reason"] = reason
+
+
+def _state_locked(b: Dict[str, Any], now: float) -> str:
+    if b["state"] == OPEN and now >= b["open_until"]:
+        b["state"] = HALF_OPEN
+        b["probe_started"] = 0.0
+    return b["state"]
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def allow(name: str) -> bool:
+    """是否允许向该上游 / Key 发请求。半开状态下同一时间只放行一个探测请求，放行后须以 record / record_quota 回报结果，
+    最终没有发出请求时以 release_probe 归还探测名额。"""
+    now = time.time()
+    with _lock:
+        b = _breaker_locked(name)
+        state = _state_locked(b, now)
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and (not b["probe_started"] or now - b["probe_started"] > _PROBE_TIMEOUT_SECONDS):
+            b["probe_started"] = now
+            return True
+        b["rejected"] += 1
+        return False
+
+
+def release_probe(name: str):
+    """放行后没有发出请求（没拿到 Key、剩余时间不够、被取消）：归还半开探测名额，下一个请求可立即探测；其他状态下无操作。"""
+    with _lock:
+        b = _breaker_locked(name)
+        if _state_locked(b, time.time()) == HALF_OPEN:
+            b["probe_started"] = 0.0
+
+
+def record(name: str, ok: bool, latency: float):
+    """回报一次调用结果（ok=False 表示网络错误、超时、429 或 5xx）。"""
+    now = time.time()
+    with _lock:
+        b = _breaker_locked(name)
+        state = _state_locked(b, now)
+        if state == HALF_OPEN:
+            if ok and latency < _SLOW_CALL_SECONDS:
+                b["state"] = CLOSED
+                b["calls"].clear()
+                b["open_seconds"] = _OPEN_SECONDS
+                b["reason"] = None
+            else:
+                b["open_seconds"] = min(_MAX_OPEN_SECONDS, b["open_seconds"] * 2)
+                _open_locked(b, now, b["open_seconds"], "探测失败" if not ok else "探测过慢")
+            return
+        b["calls"].append((now, ok, latency))
+        _trim_locked(b, now)
+        if state != CLOSED:
+            return
+        n, error_rate, slow_rate = _rates_locked(b)
+        if n >= _MIN_REQUESTS and (error_rate >= _ERROR_RATE or slow_rate >= _ERROR_RATE):
+            reason = f"失败率 {error_rate:.0%}" if error_rate >= _ERROR_RATE else f"慢调用率 {slow_rate:.0%}"
+            _open_locked(b, now, b["open_seconds"], reason)
+
+
+def record_quota(name: str, latency: float):
+    """配额/限流（429）：立即熔断该 Key，探测失败时熔断时长翻倍。"""
+    now = time.time()
+    with _lock:
+        b = _breaker_locked(name)
+        if _state_locked(b, now) == HALF_OPEN:
+            b["open_seconds"] = min(_MAX_OPEN_SECONDS, b["open_seconds"] * 2)
+        b["calls"].append((now, False, latency))
+        _trim_locked(b, now)
+        _open_locked(b, now, b["open_seconds"], "配额/限流")
+
+
+def is_open(name: str) -> bool:
+    """是否处于熔断中（不占用半开探测名额）。"""
+    with _lock:
+        return _state_locked(_breaker_locked(name), time.time()) == OPEN
+
+
+def order(names: Sequence[str]) -> List[str]:
+    """按健康度排序：先按状态（正常 → 半开 → 熔断），再按失败率 + 慢调用率（按 0.1 分档，避免抖动），同档保持原顺序。"""
+    now = time.time()
+    keys: Dict[str, Tuple[int, float]] = {}
+    with _lock:
+        for name in names:
+            b = _breaker_locked(name)
+            state = _state_locked(b, now)
+            _trim_locked(b, now)
+            _, error_rate, slow_rate = _rates_locked(b)
+            keys[name] = (_STATE_RANK[state], round(error_rate + slow_rate, 1))
+    return sorted(names, key=lambda n: keys[n])
+
+
+def get_stats() -> Dict[str, Any]:
+    now = time.time()
+    stats: Dict[str, Any] = {}
+    with _lock:
+        for name, b in sorted(_breakers.items()):
+            state = _state_locked(b, now)
+            _trim_locked(b, now)
+            n, error_rate, slow_rate = _rates_locked(b)
+            latencies = sorted(latency for _, ok, latency in b["calls"] if ok)
+            p95: Optional[float] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None
+            stats[name] = {
+                "state": state,
+                "reason": b["reason"] if state != CLOSED else None,
+                "openRemainingSeconds": round(max(0.0, b["open_until"] - now), 1) if state == OPEN else 0,
+                "windowRequests": n,
+                "errorRate": round(error_rate, 3),
+                "slowRate": round(slow_rate, 3),
+                "p95Seconds": round(p95, 3) if p95 is not None else None,
+                "opened": b["opened"],
+                "rejected": b["rejected"],
+            }
+    return stats
@@ -0,0 +1,139 @@
+"""
+Gemini 上下文缓存（cachedContents）登记表：同一道题的固定前缀（批改说明 + 地区特征 + 材料 + 题目）
+在 Gemini 侧建一份缓存，之后的批改请求只上传学生答案并引用该缓存。
+
+本模块只做登记与淘汰决策，HTTP 调用（创建 / 续期 / 删除）在 main.py 中完成。
+cachedContents 只能被创建它的项目使用，因此登记按 (Key 序号, 前缀 id) 区分。
+
+- 前缀在窗口期内被使用达到 GEMINI_CONTEXT_CACHE_MIN_USES 次才创建缓存，避免冷门题目白付存储费
+- 缓存剩余有效期不足 GEMINI_CONTEXT_CACHE_REFRESH_SECONDS 时续期
+- 超过 GEMINI_CONTEXT_CACHE_MAX_ENTRIES 时按最近使用时间淘汰（由调用方删除远端缓存）
+- 创建被拒（如前缀 token 数低于模型下限）的前缀在一段时间内不再尝试
+
+环境变量：
+  GEMINI_CONTEXT_CACHE                  - 设为 0 关闭，默认开启
+  GEMINI_CONTEXT_CACHE_TTL_SECONDS      - 缓存 TTL，默认 3600
+  GEMINI_CONTEXT_CACHE_REFRESH_SECONDS  - 剩余有效期低于该值时续期，默认 600
+  GEMINI_CONTEXT_CACHE_MIN_USES         - 创建缓存前需要的使用次数，默认 2
+  GEMINI_CONTEXT_CACHE_MAX_ENTRIES      - 每个进程最多登记的缓存数，默认 200
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_ENABLED = (os.getenv("GEMINI_CONTEXT_CACHE") or "1").strip() not in ("0", "false", "off")
+TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS") or 3600)
+_REFRESH_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_REFRESH_SECONDS") or 600)
+_MIN_USES = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_USES") or 2)
+_MAX_ENTRIES = int(os.getenv("GEMINI_CONTEXT_CACHE_MAX_ENTRIES") or 200)
+_USE_WINDOW_SECONDS = 24 * 3600
+_REJECT_BACKOFF_SECONDS = 6 * 3600
+
+_lock = threading.Lock()
+
+_entries: "OrderedDict[Tuple[int, str], Dict[str, Any]]" = OrderedDict()   # (key_idx, prefix_id) -> {"name", "expire_at"}
+_uses: Dict[str, List[float]] = {}          # prefix_id -> 最近使用时间
+_rejected: Dict[str, float] = {}            # prefix_id -> 不再尝试创建直到该时间
+_creating: set = set()                      # 正在创建中的 (key_idx, prefix_id)，避免并发重复创建
+_counters = {"hits": 0, "creates": 0, "refreshes": 0, "evictions": 0, "fallbacks": 0, "rejects": 0}
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def enabled() -> bool:
+    return _ENABLED
+
+
+def lookup(key_idx: int, prefix_id: str) -> Optional[Dict[str, Any]]:
+    """返回仍有效的缓存登记 {"name", "expire_at", "refresh"}；refresh 为 True 表示应当续期。"""
+    now = time.time()
+    with _lock:
+        entry = _entries.get((key_idx, prefix_id))
+        if not entry:
+            return None
+        if entry["expire_at"] <= now + 5:
+            _entries.pop((key_idx, prefix_id), None)
+            return None
+        _entries.move_to_end((key_idx, prefix_id))
+        _counters["hits"] += 1
+        return dict(entry, refresh=entry["expire_at"] - now < _REFRESH_SECONDS)
+
+
+def begin_refresh(key_idx: int, prefix_id: str) -> bool:
+    """续期前调用：同一缓存同时只发一次续期请求。"""
+    with _lock:
+        entry = _entries.get((key_idx, prefix_id))
+        if not entry or entry.get("refreshing"):
+            return False
+        entry["refreshing"] = True
+        return True
+
+
+def begin_create(key_idx: int, prefix_id: str) -> bool:
+    """记录一次使用，并判断是否应当为该前缀创建缓存；返回 True 时调用方须以 store / abandon_create / reject 结束。"""
+    now = time.time()
+    with _lock:
+        if _rejected.get(prefix_id, 0) > now or (key_idx, prefix_id) in _creating:
+            return False
+        uses = [t for t in _uses.get(prefix_id, []) if t > now - _USE_WINDOW_SECONDS]
+        uses.append(now)
+        _uses[prefix_id] = uses[-_MIN_USES:]
+        if len(uses) < _MIN_USES:
+            return False
+        _creating.add((key_idx, prefix_id))
+        return True
+
+
+def abandon_create(key_idx: int, prefix_id: str):
+    """创建因临时错误（限流、网络）失败，下次再试。"""
+    with _lock:
+        _creating.discard((key_idx, prefix_id))
+
+
+def store(key_idx: int, prefix_id: str, name: str, ttl_seconds: int = TTL_SECONDS) -> List[Tuple[int, str]]:
+    """登记新建的缓存，返回因超出上限被淘汰、需要在远端删除的 (Key 序号, 缓存名)。"""
+    evicted: List[Tuple[int, str]] = []
+    with _lock:
+        _creating.discard((key_idx, prefix_id))
+        _entries[(key_idx, prefix_id)] = {"name": name, "expire_at": time.time() + ttl_seconds, "key_idx": key_idx}
+        _entries.move_to_end((key_idx, prefix_id))
+        _counters["creates"] += 1
+        while len(_entries) > _MAX_ENTRIES:
+            _, old = _entries.popitem(last=False)
+            evicted.append((old["key_idx"], old["name"]))
+            _counters["evictions"] += 1
+    return evicted
+
+
+def touch(key_idx: int, prefix_id: str, ttl_seconds: int = TTL_SECONDS):
+    """续期结束后调用；ttl_seconds 为 0 表示续期失败，只清除续期中标记。"""
+    with _lock:
+        entry = _entries.get((key_idx, prefix_id))
+        if entry:
+            entry["refreshing"] = False
+            if ttl_seconds > 0:
+                entry["expire_at"] = time.time() + ttl_seconds
+                _counters["refreshes"] += 1
+
+
+def forget(key_idx: int, prefix_id: str):
+    """远端缓存已失效（过期、被删、不可用）时移除登记。"""
+    with _lock:
+        _entries.pop((key_idx, prefix_id), None)
+        _counters["fallbacks"] += 1
+
+
+def reject(key_idx: int, prefix_id: str):
+    """创建被拒的前缀在一段时间内不再尝试。"""
+    with _lock:
+        _creating.discard((key_idx, prefix_id))
+        _rejected[prefix_id] = time.time() + _REJECT_BACKOFF_SECONDS
+        _counters["rejects"] += 1
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        return dict(_counters, entries=len(_entries), enabled=_ENABLED)
@@ -0,0 +1,230 @@
+"""
+Gemini 多 Key 调度：按权重轮询（平滑加权轮询）把请求分给所有配置的 Key，每个 Key 各有本地令牌桶
+（每分钟请求数 RPM、每分钟 token 数 TPM），避免单个 Key 先撞上限而其他 Key 闲置。
+
+- 所有可用 Key 的令牌桶都空时，最多排队等待 GEMINI_KEY_QUEUE_SECONDS 秒，而不是立刻转到备用上游
+- Key 序号（0, 1, 2 …）按配置顺序固定，熔断器（gemini#序号）与上下文缓存登记都用它区分 Key
+- 实际消耗的 token 数在响应返回后结算（settle），令牌桶按实际用量修正；上游报错、超时或响应无法解析时按 0 结算，
+  预扣的 token 全部退回。选中后因熔断探测名额被占而没有发出的请求用 release 退回请求数与 token
+
+配置（环境变量）：
+  GEMINI_API_KEY            - 主 Key（序号 0）
+  GEMINI_API_KEY_FALLBACK   - 备用 Key（兼容旧配置）
+  GEMINI_API_KEYS           - 更多 Key，逗号分隔；每项可写成 key:权重:RPM:TPM，后三项可省略
+  GEMINI_KEY_RPM            - 每个 Key 默认的每分钟请求数，默认 60
+  GEMINI_KEY_TPM            - 每个 Key 默认的每分钟 token 数，默认 1000000
+  GEMINI_KEY_QUEUE_SECONDS  - 令牌桶全空时的最长排队时间，默认 5
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_DEFAULT_RPM = float(os.getenv("GEMINI_KEY_RPM") or 60)
+_DEFAULT_TPM = float(os.getenv("GEMINI_KEY_TPM") or 1_000_000)
+_QUEUE_SECONDS = float(os.getenv("GEMINI_KEY_QUEUE_SECONDS") or 5)
+_UTILIZATION_WINDOW_SECONDS = 60.0
+
+_lock = threading.Lock()
+
+_config_source: Optional[Tuple[str, str, str]] = None
+_keys: List[Dict[str, Any]] = []
+_counters = {"acquired": 0, "queued": 0, "queue_seconds": 0.0, "throttled": 0}
+
+
+def _parse_entry(entry: str) -> Optional[Dict[str, Any]]:
+    fields = [f.strip() for f in entry.split(":")]
+    if not fields[0]:
+        return None
+
+    def _num(i: int, default: float) -> float:
+        try:
+            return float(fields[i]) if len(fields) > i and fields[i] else default
+        except ValueError:
+            return default
+
+    return {
+        "key": fields[0],
+        "weight": max(0.0, _num(1, 1.0)),
+        "rpm": _num(2, _DEFAULT_RPM),
+        "tpm": _num(3, _DEFAULT_TPM),
+    }
+
+
+def _new_state(spec: Dict[str, Any], now: float) -> Dict[str, Any]:
+    return dict(
+        spec,
+        current_weight=0.0,
+        req_tokens=spec["rpm"],
+        tok_tokens=spec["tpm"],
+        refilled_at=now,
+        recent=deque(),          # (时间, token 数, 是否计为一次请求)，用于计算最近一分钟的利用率
+        selected=0,
+    )
+
+
+def _sync_config_locked():
+    """环境变量变化时重建 Key 列表；Key 未变的保留令牌桶状态。"""
+    global _config_source, _keys
+    source = (
+        (os.getenv("GEMINI_API_KEY") or "").strip(),
+        (os.getenv("GEMINI_API_KEY_FALLBACK") or "").strip(),
+        (os.getenv("GEMINI_API_KEYS") or "").strip(),
+    )
+    if source == _config_source:
+        return
+    specs: List[Dict[str, Any]] = []
+    for entry in [source[0], source[1]] + source[2].split(","):
+        spec = _parse_entry(entry) if entry.strip() else None
+        if spec and all(s["key"] != spec["key"] for s in specs):
+            specs.append(spec)
+    now = time.monotonic()
+    old = {k["key"]: k for k in _keys}
+    keys = []
+    for spec in specs:
+        prev = old.get(spec["key"])
+        keys.append(dict(prev, **spec) if prev else _new_state(spec, now))
+    _keys = keys
+    _config_source = source
+
+
+def _refill_locked(k: Dict[str, Any], now: float):
+    elapsed = now - k["refilled_at"]
+    if elapsed > 0:
+        k["req_tokens"] = min(k["rpm"], k["req_tokens"] + elapsed * k["rpm"] / 60.0)
+        k["tok_tokens"] = min(k["tpm"], k["tok_tokens"] + elapsed * k["tpm"] / 60.0)
+        k["refilled_at"] = now
+    recent: Deque[Tuple[float, int, bool]] = k["recent"]
+    while recent and recent[0][0] < now - _UTILIZATION_WINDOW_SECONDS:
+        recent.popleft()
+
+
+def _wait_seconds_locked(k: Dict[str, Any], tokens: int) -> float:
+    """该 Key 的令牌桶还需多久才够发一次 tokens 大小的请求。"""
+    need_req = max(0.0, 1.0 - k["req_tokens"])
+    need_tok = max(0.0, min(tokens, k["tpm"]) - k["tok_tokens"])
+    return max(need_req * 60.0 / k["rpm"] if k["rpm"] > 0 else 0.0, need_tok * 60.0 / k["tpm"] if k["tpm"] > 0 else 0.0)
+
+
+def _pick_locked(candidates: List[int], tokens: int, now: float) -> Tuple[Optional[int], float]:
+    """在有余量的候选 Key 中做一次平滑加权轮询；都没有余量时返回 (None, 最短等待秒数)。"""
+    ready = []
+    shortest = float("inf")
+    for idx in candidates:
+        k = _keys[idx]
+        _refill_locked(k, now)
+        wait = _wait_seconds_locked(k, tokens)
+        if wait <= 0:
+            ready.append(idx)
+        else:
+            shortest = min(shortest, wait)
+    if not ready:
+        return (None, shortest)
+    total = sum(_keys[i]["weight"] for i in ready) or float(len(ready))
+    for i in ready:
+        _keys[i]["current_weight"] += _keys[i]["weight"] or 1.0
+    chosen = max(ready, key=lambda i: _keys[i]["current_weight"])
+    k = _keys[chosen]
+    k["current_weight"] -= total
+    k["req_tokens"] -= 1.0
+    k["tok_tokens"] -= min(tokens, k["tpm"])
+    k["recent"].append((now, tokens, True))
+    k["selected"] += 1
+    return (chosen, 0.0)
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def configured_keys() -> List[str]:
+    """按序号返回所有配置的 Key。"""
+    with _lock:
+        _sync_config_locked()
+        return [k["key"] for k in _keys]
+
+
+async def acquire(tokens: int, exclude: Set[int], usable: Callable[[int], bool]) -> Optional[int]:
+    """为一次约 tokens 个 token 的请求选一个 Key，返回其序号。
+
+    exclude 为本次请求已经试过的 Key；usable(序号) 为 False 的 Key（如熔断中）不参与选择。
+    候选 Key 的令牌桶都空时排队等待，超过 GEMINI_KEY_QUEUE_SECONDS 仍无余量或没有候选 Key 时返回 None。
+    """
+    deadline = time.monotonic() + _QUEUE_SECONDS
+    queued_at: Optional[float] = None
+    while True:
+        with _lock:
+            _sync_config_locked()
+            candidates = [i for i in range(len(_keys)) if i not in exclude and _keys[i]["weight"] > 0 and usable(i)]
+            if not candidates:
+                return None
+            now = time.monotonic()
+            idx, wait = _pick_locked(candidates, tokens, now)
+            if idx is not None:
+                _counters["acquired"] += 1
+                if queued_at is not None:
+                    _counters["queue_seconds"] += now - queued_at
+                return idx
+            if now + wait > deadline:
+                _counters["throttled"] += 1
+                if queued_at is not None:
+                    _counters["queue_seconds"] += now - queued_at
+                return None
+            if queued_at is None:
+                queued_at = now
+                _counters["queued"] += 1
+        await asyncio.sleep(min(wait, 1.0) + 0.01)
+
+
+def release(idx: int, estimated_tokens: int):
+    """选中的 Key 最终没有发出请求（如半开探测名额已被占用）时，退回 acquire 预扣的请求数与 token。"""
+    with _lock:
+        if idx >= len(_keys):
+            return
+        k = _keys[idx]
+        k["req_tokens"] = min(k["rpm"], k["req_tokens"] + 1.0)
+        k["tok_tokens"] = min(k["tpm"], k["tok_tokens"] + min(estimated_tokens, k["tpm"]))
+        k["selected"] -= 1
+        recent: Deque[Tuple[float, int, bool]] = k["recent"]
+        for i in range(len(recent) - 1, -1, -1):
+            if recent[i][1] == estimated_tokens and recent[i][2]:
+                del recent[i]
+                break
+
+
+def settle(idx: int, estimated_tokens: int, actual_tokens: int):
+    """请求结束后按实际 token 用量修正令牌桶（多退少补）；actual_tokens 为 0 表示上游未计费（报错、超时、无法解析），退回全部预扣。"""
+    with _lock:
+        if idx >= len(_keys):
+            return
+        k = _keys[idx]
+        reserved = min(estimated_tokens, k["tpm"])
+        actual_tokens = max(0, actual_tokens)
+        k["tok_tokens"] = min(k["tpm"], k["tok_tokens"] + reserved - actual_tokens)
+        k["recent"].append((time.monotonic(), actual_tokens - estimated_tokens, False))
+
+
+def get_stats() -> Dict[str, Any]:
+    """各 Key 最近一分钟的请求数 / token 数及其占 RPM / TPM 的比例（Key 只显示末 4 位）。"""
+    now = time.monotonic()
+    with _lock:
+        _sync_config_locked()
+        keys = []
+        for idx, k in enumerate(_keys):
+            _refill_locked(k, now)
+            requests = sum(1 for _, _, is_request in k["recent"] if is_request)
+            tokens = max(0, sum(t for _, t, _ in k["recent"]))
+            keys.append({
+                "index": idx,
+                "key": "…" + k["key"][-4:],
+                "weight": k["weight"],
+                "rpm": k["rpm"],
+                "tpm": k["tpm"],
+                "requestsLastMinute": requests,
+                "tokensLastMinute": tokens,
+                "rpmUtilization": round(requests / k["rpm"], 3) if k["rpm"] > 0 else None,
+                "tpmUtilization": round(tokens / k["tpm"], 3) if k["tpm"] > 0 else None,
+                "selected": k["selected"],
+            })
+        return dict(_counters, queue_seconds=round(_counters["queue_seconds"], 3), keys=keys)
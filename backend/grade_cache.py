@@ -0,0 +1,191 @@
+"""
+批改结果缓存：同一份答案重复提交（连点、刷新、网络重试）时直接返回上次的批改结果，不再调用模型。
+
+两级存储：
+1. 进程内 LRU：按条数与字节数双重上限淘汰，带 TTL
+2. SQLite 磁盘层：重启后仍可命中，同一台机器上的多个 uvicorn worker 共享
+
+缓存键由调用方计算（见 main._grading_cache_key），本模块只负责存取与淘汰。
+
+环境变量：
+  GRADE_CACHE_TTL_SECONDS    - 结果有效期，默认 24 小时；设为 0 关闭缓存
+  GRADE_CACHE_MAX_ENTRIES    - 内存层最多条数，默认 512
+  GRADE_CACHE_MAX_BYTES      - 内存层最多字节数，默认 32MB
+  GRADE_CACHE_DB_PATH        - SQLite 文件路径，默认 backend/grade_cache.db；设为 off 只用内存层
+  GRADE_CACHE_DB_MAX_ENTRIES - 磁盘层最多条数，默认 20000
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_TTL_SECONDS = int(os.getenv("GRADE_CACHE_TTL_SECONDS") or 24 * 3600)
+_MAX_ENTRIES = int(os.getenv("GRADE_CACHE_MAX_ENTRIES") or 512)
+_MAX_BYTES = int(os.getenv("GRADE_CACHE_MAX_BYTES") or 32 * 1024 * 1024)
+_DB_PATH = (os.getenv("GRADE_CACHE_DB_PATH") or "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "grade_cache.db"
+)
+_DB_MAX_ENTRIES = int(os.getenv("GRADE_CACHE_DB_MAX_ENTRIES") or 20000)
+_DB_TRIM_EVERY = 100
+
+_lock = threading.Lock()
+
+# ── 内存层 ──────────────────────────────────────────────────────────────────────
+_mem: "OrderedDict[str, Tuple[float, Dict[str, Any], int]]" = OrderedDict()   # key -> (expires_at, result, size)
+_mem_bytes = 0
+_counters = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "puts": 0, "evictions": 0}
+_puts_since_trim = 0
+
+
+def _mem_evict_locked():
+    global _mem_bytes
+    while _mem and (len(_mem) > _MAX_ENTRIES or _mem_bytes > _MAX_BYTES):
+        _, (_, _, size) = _mem.popitem(last=False)
+        _mem_bytes -= size
+        _counters["evictions"] += 1
+
+
+def _mem_drop_locked(key: str):
+    global _mem_bytes
+    old = _mem.pop(key, None)
+    if old:
+        _mem_bytes -= old[2]
+
+
+def _mem_put_locked(key: str, expires_at: float, result: Dict[str, Any], size: int):
+    global _mem_bytes
+    _mem_drop_locked(key)
+    _mem[key] = (expires_at, result, size)
+    _mem_bytes += size
+    _mem_evict_locked()
+
+
+# ── SQLite 层 ──────────────────────────────────────────────────────────────────
+def _connect() -> sqlite3.Connection:
+    return sqlite3.connect(_DB_PATH, timeout=10.0)
+
+
+def _sqlite_init():
+    conn = _connect()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS grade_cache (
+            cache_key   TEXT PRIMARY KEY,
+            result      TEXT NOT NULL,
+            expires_at  REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_grade_cache_accessed ON grade_cache (accessed_at)")
+    conn.commit()
+    conn.close()
+    print(f"[批改缓存] 使用 SQLite 磁盘层: {_DB_PATH}")
+
+
+def _sqlite_get(key: str, now: float) -> Optional[Tuple[float, str]]:
+    conn = _connect()
+    row = conn.execute(
+        "SELECT expires_at, result FROM grade_cache WHERE cache_key = ? AND expires_at > ?",
+        (key, now),
+    ).fetchone()
+    if row:
+        conn.execute("UPDATE grade_cache SET accessed_at = ? WHERE cache_key = ?", (now, key))
+        conn.commit()
+    conn.close()
+    return (row[0], row[1]) if row else None
+
+
+def _sqlite_put(key: str, text: str, expires_at: float, now: float, trim: bool):
+    conn = _connect()
+    conn.execute(
+        "INSERT OR REPLACE INTO grade_cache (cache_key, result, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+        (key, text, expires_at, now),
+    )
+    if trim:
+        conn.execute("DELETE FROM grade_cache WHERE expires_at <= ?", (now,))
+        conn.execute(
+            "DELETE FROM grade_cache WHERE cache_key IN ("
+            " SELECT cache_key FROM grade_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (_DB_MAX_ENTRIES,),
+        )
+    conn.commit()
+    conn.close()
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def enabled() -> bool:
+    return _TTL_SECONDS > 0
+
+
+def get(key: str) -> Optional[Dict[str, Any]]:
+    """查缓存：先内存层，再磁盘层（命中后回填内存层）。未命中或已过期返回 None。"""
+    if not enabled():
+        return None
+    now = time.time()
+    with _lock:
+        item = _mem.get(key)
+        if item:
+            if item[0] > now:
+                _mem.move_to_end(key)
+                _counters["hits_memory"] += 1
+                return item[1]
+            _mem_drop_locked(key)
+    if _DB_PATH:
+        try:
+            row = _sqlite_get(key, now)
+        except Exception as e:
+            print(f"[批改缓存] 读取磁盘层失败（忽略）: {e}")
+            row = None
+        if row:
+            expires_at, text = row
+            result = json.loads(text)
+            with _lock:
+                _mem_put_locked(key, expires_at, result, len(text))
+                _counters["hits_disk"] += 1
+            return result
+    with _lock:
+        _counters["misses"] += 1
+    return None
+
+
+def put(key: str, result: Dict[str, Any]):
+    """写入一条批改结果（两级同时写）。"""
+    global _puts_since_trim
+    if not enabled():
+        return
+    now = time.time()
+    expires_at = now + _TTL_SECONDS
+    text = json.dumps(result, ensure_ascii=False)
+    with _lock:
+        _mem_put_locked(key, expires_at, result, len(text))
+        _counters["puts"] += 1
+        _puts_since_trim += 1
+        trim = _puts_since_trim >= _DB_TRIM_EVERY
+        if trim:
+            _puts_since_trim = 0
+    if _DB_PATH:
+        try:
+            _sqlite_put(key, text, expires_at, now, trim)
+        except Exception as e:
+            print(f"[批改缓存] 写入磁盘层失败（忽略）: {e}")
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        return dict(_counters, memory_entries=len(_mem), memory_bytes=_mem_bytes, ttl_seconds=_TTL_SECONDS)
+
+
+# ── 模块初始化 ──────────────────────────────────────────────────────────────────
+if _DB_PATH.lower() == "off" or not enabled():
+    _DB_PATH = ""
+else:
+    try:
+        _sqlite_init()
+    except Exception as e:
+        print(f"[批改缓存] SQLite 初始化失败，只使用内存层: {e}")
+        _DB_PATH = ""
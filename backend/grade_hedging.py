@@ -0,0 +1,127 @@
+"""
+批改请求对冲（hedging）：主上游在其历史耗时的某个分位数内仍未返回时，并行向下一个上游发同一请求，
+先成功者返回，其余取消（调度在 main._first_successful_provider 中完成）。
+
+本模块只负责：
+- 按上游记录最近成功调用的耗时，给出对冲触发时间（分位数，样本不足时用默认值）
+- 对冲频率上限：时间窗口内对冲次数不超过请求数 × GRADE_HEDGE_MAX_RATE，避免在上游整体变慢时把配额翻倍
+- 计数（对冲次数、被上限拒绝次数、各上游胜出次数）
+
+环境变量：
+  GRADE_HEDGE                        - 设为 1 开启对冲，默认关闭（串行兜底）
+  GRADE_HEDGE_PERCENTILE             - 触发分位数，默认 95
+  GRADE_HEDGE_DEFAULT_DELAY_SECONDS  - 样本不足时的触发时间，默认 30
+  GRADE_HEDGE_MIN_DELAY_SECONDS      - 触发时间下限，默认 3
+  GRADE_HEDGE_MAX_RATE               - 对冲请求占比上限，默认 0.1
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_ENABLED = (os.getenv("GRADE_HEDGE") or "0").strip().lower() in ("1", "true", "on")
+_PERCENTILE = float(os.getenv("GRADE_HEDGE_PERCENTILE") or 95)
+_DEFAULT_DELAY_SECONDS = float(os.getenv("GRADE_HEDGE_DEFAULT_DELAY_SECONDS") or 30)
+_MIN_DELAY_SECONDS = float(os.getenv("GRADE_HEDGE_MIN_DELAY_SECONDS") or 3)
+_MAX_RATE = float(os.getenv("GRADE_HEDGE_MAX_RATE") or 0.1)
+_LATENCY_SAMPLES = 200          # 每个上游保留的最近耗时样本数
+_MIN_SAMPLES = 20               # 少于该样本数时用默认触发时间
+_RATE_WINDOW_SECONDS = 600
+
+_lock = threading.Lock()
+
+_latencies: Dict[str, Deque[float]] = {}
+_requests: Deque[float] = deque()
+_hedges: Deque[float] = deque()
+_counters: Dict[str, Any] = {"requests": 0, "hedges": 0, "denied": 0, "wins": {}}
+
+
+def _percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[idx]
+
+
+def _trim_locked(now: float):
+    cutoff = now - _RATE_WINDOW_SECONDS
+    while _requests and _requests[0] < cutoff:
+        _requests.popleft()
+    while _hedges and _hedges[0] < cutoff:
+        _hedges.popleft()
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def enabled() -> bool:
+    return _ENABLED
+
+
+def record_latency(provider: str, seconds: float):
+    """记录一次成功调用的耗时（被取消或失败的调用不计入）。"""
+    with _lock:
+        samples = _latencies.get(provider)
+        if samples is None:
+            samples = _latencies[provider] = deque(maxlen=_LATENCY_SAMPLES)
+        samples.append(seconds)
+
+
+def hedge_delay(provider: str) -> float:
+    """主上游开始后经过多少秒仍未返回时触发对冲。"""
+    with _lock:
+        samples = list(_latencies.get(provider) or ())
+    if len(samples) < _MIN_SAMPLES:
+        return _DEFAULT_DELAY_SECONDS
+    return max(_MIN_DELAY_SECONDS, _percentile(samples, _PERCENTILE))
+
+
+def typical_latency(provider: str) -> float:
+    """该上游成功调用的耗时中位数；样本不足时返回 0。"""
+    with _lock:
+        samples = list(_latencies.get(provider) or ())
+    return _percentile(samples, 50) if len(samples) >= _MIN_SAMPLES else 0.0
+
+
+def note_request():
+    """每个走上游的批改请求调用一次，作为对冲占比的分母。"""
+    now = time.time()
+    with _lock:
+        _trim_locked(now)
+        _requests.append(now)
+        _counters["requests"] += 1
+
+
+def try_acquire_hedge() -> bool:
+    """判断本次是否允许对冲；允许时计入对冲次数。"""
+    now = time.time()
+    with _lock:
+        _trim_locked(now)
+        if len(_hedges) >= max(1.0, len(_requests) * _MAX_RATE):
+            _counters["denied"] += 1
+            return False
+        _hedges.append(now)
+        _counters["hedges"] += 1
+        return True
+
+
+def note_win(provider: str):
+    """对冲后先返回结果的上游。"""
+    with _lock:
+        _counters["wins"][provider] = _counters["wins"].get(provider, 0) + 1
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        stats: Dict[str, Any] = dict(_counters, wins=dict(_counters["wins"]), enabled=_ENABLED, max_rate=_MAX_RATE)
+        providers = {name: list(samples) for name, samples in _latencies.items()}
+    stats["latency"] = {
+        name: {
+            "samples": len(samples),
+            "p50": round(_percentile(samples, 50), 3),
+            "p95": round(_percentile(samples, 95), 3),
+        }
+        for name, samples in providers.items() if samples
+    }
+    stats["delay"] = {name: round(hedge_delay(name), 3) for name in providers}
+    return stats
@@ -0,0 +1,192 @@
+"""
+批改任务存储：异步批改（POST /api/grade/jobs）的任务状态与结果持久化到本地 SQLite。
+
+- 任务状态：queued（排队）→ running（执行中）→ done（完成）/ failed（失败）
+- 结果写入 SQLite，后端重启后仍可通过 GET /api/grade/jobs/{id} 查询
+- 任务记录执行进程 pid；重启后，排队中或“执行进程已不存在”的任务会被重新入队
+- payload（含 base64 作答图片，可达数 MB）只在重启恢复时需要：任务结束（完成 / 失败）即清空，
+  WAL 文件在检查点后截断到 _JOURNAL_SIZE_LIMIT 以内
+
+环境变量：
+  GRADE_JOBS_DB_PATH       - SQLite 文件路径，默认 backend/grade_jobs.db
+  GRADE_JOB_TTL_SECONDS    - 已结束任务的保留时长，默认 7 天
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_DB_PATH = (os.getenv("GRADE_JOBS_DB_PATH") or "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "grade_jobs.db"
+)
+_TTL_SECONDS = int(os.getenv("GRADE_JOB_TTL_SECONDS") or 7 * 24 * 3600)
+
+_JOURNAL_SIZE_LIMIT = 8 * 1024 * 1024
+_EMPTY_PAYLOAD = "{}"
+
+_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(_DB_PATH, timeout=10.0)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_size_limit = {_JOURNAL_SIZE_LIMIT}")
+    return conn
+
+
+def _init_db():
+    conn = _connect()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS grade_jobs (
+            id          TEXT PRIMARY KEY,
+            status      TEXT NOT NULL,
+            payload     TEXT NOT NULL,
+            client_ip   TEXT,
+            owner_pid   INTEGER,
+            result      TEXT,
+            error       TEXT,
+            error_code  INTEGER,
+            created_at  REAL NOT NULL,
+            updated_at  REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_grade_jobs_status ON grade_jobs (status)")
+    conn.commit()
+    conn.close()
+    print(f"[批改任务] 使用 SQLite 存储: {_DB_PATH}")
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def _row_to_job(row: sqlite3.Row, include_payload: bool = False) -> Dict[str, Any]:
+    job: Dict[str, Any] = {
+        "jobId": row["id"],
+        "status": row["status"],
+        "createdAt": row["created_at"],
+        "updatedAt": row["updated_at"],
+    }
+    if row["result"]:
+        job["result"] = json.loads(row["result"])
+    if row["error"]:
+        job["error"] = row["error"]
+        job["errorCode"] = row["error_code"]
+    if include_payload:
+        job["payload"] = json.loads(row["payload"])
+        job["clientIp"] = row["client_ip"]
+    return job
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def create_job(payload: Dict[str, Any], client_ip: Optional[str] = None) -> str:
+    """新建一个排队中的任务，返回任务 id。"""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "INSERT INTO grade_jobs (id, status, payload, client_ip, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+            (job_id, json.dumps(payload, ensure_ascii=False), client_ip, now, now),
+        )
+        conn.commit()
+        conn.close()
+    return job_id
+
+
+def claim_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """把排队中的任务标记为执行中并返回（含 payload）；已被其他进程领取或不存在时返回 None。"""
+    with _lock:
+        conn = _connect()
+        cur = conn.execute(
+            "UPDATE grade_jobs SET status = 'running', owner_pid = ?, updated_at = ? WHERE id = ? AND status = 'queued'",
+            (os.getpid(), time.time(), job_id),
+        )
+        conn.commit()
+        row = conn.execute("SELECT * FROM grade_jobs WHERE id = ?", (job_id,)).fetchone() if cur.rowcount else None
+        conn.close()
+    return _row_to_job(row, include_payload=True) if row else None
+
+
+def finish_job(job_id: str, result: Dict[str, Any]):
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "UPDATE grade_jobs SET status = 'done', payload = ?, result = ?, updated_at = ? WHERE id = ?",
+            (_EMPTY_PAYLOAD, json.dumps(result, ensure_ascii=False), time.time(), job_id),
+        )
+        conn.commit()
+        conn.close()
+
+
+def fail_job(job_id: str, error: str, error_code: int = 500):
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "UPDATE grade_jobs SET status = 'failed', payload = ?, error = ?, error_code = ?, updated_at = ? WHERE id = ?",
+            (_EMPTY_PAYLOAD, error, error_code, time.time(), job_id),
+        )
+        conn.commit()
+        conn.close()
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    with _lock:
+        conn = _connect()
+        row = conn.execute("SELECT * FROM grade_jobs WHERE id = ?", (job_id,)).fetchone()
+        conn.close()
+    return _row_to_job(row) if row else None
+
+
+def recover_pending_jobs() -> List[str]:
+    """启动时调用：返回需要重新入队的任务 id（排队中，或执行进程已退出的执行中任务），并清理过期任务
+    （以及旧版本留下的、已结束任务的 payload）。"""
+    now = time.time()
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "DELETE FROM grade_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+            (now - _TTL_SECONDS,),
+        )
+        conn.execute(
+            "UPDATE grade_jobs SET payload = ? WHERE status IN ('done', 'failed') AND payload != ?",
+            (_EMPTY_PAYLOAD, _EMPTY_PAYLOAD),
+        )
+        rows = conn.execute(
+            "SELECT id, status, owner_pid FROM grade_jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+        ).fetchall()
+        job_ids = []
+        for r in rows:
+            if r["status"] == "running":
+                if _pid_alive(r["owner_pid"]) and r["owner_pid"] != os.getpid():
+                    continue
+                conn.execute(
+                    "UPDATE grade_jobs SET status = 'queued', owner_pid = NULL, updated_at = ? WHERE id = ?",
+                    (now, r["id"]),
+                )
+            job_ids.append(r["id"])
+        conn.commit()
+        conn.close()
+    return job_ids
+
+
+# ── 模块初始化 ──────────────────────────────────────────────────────────────────
+_init_db()
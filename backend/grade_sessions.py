@@ -0,0 +1,199 @@
+"""
+批改会话存储：每次批改的结果按前端生成的 gradingSessionId 持久化到本地 SQLite，
+页面刷新或换设备后可凭 id 取回报告，不必重新批改（也不必把完整报告存在浏览器 localStorage 里）。
+
+- 以 session id 为主键，按客户端 id（请求头 X-Client-Id 或 payload.clientId）建索引，用于分页查询历史
+- 每条记录保存结果 JSON 及其 ETag（结果 JSON 的 sha256），GET /api/grade/{sessionId} 支持 If-None-Match
+- 同一 session id 再次批改时覆盖结果，但只限原记录的所有者：带客户端 id 的记录只能由同一客户端 id 覆盖；
+  不带客户端 id 的记录只能由同一 IP、同样不带客户端 id 的请求覆盖（不会被之后带 id 的请求认领）；已过期的记录视为不存在
+- 超过保留时长的记录在启动时及每写入 200 次后清理
+
+环境变量：
+  GRADE_SESSIONS_DB_PATH       - SQLite 文件路径，默认 backend/grade_sessions.db
+  GRADE_SESSION_TTL_SECONDS    - 保留时长，默认 30 天
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_DB_PATH = (os.getenv("GRADE_SESSIONS_DB_PATH") or "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "grade_sessions.db"
+)
+_TTL_SECONDS = int(os.getenv("GRADE_SESSION_TTL_SECONDS") or 30 * 24 * 3600)
+_TRIM_EVERY = 200
+MAX_ID_LENGTH = 128
+MAX_PAGE_SIZE = 100
+
+_lock = threading.Lock()
+_counters = {"saved": 0, "rejected": 0, "hits": 0, "not_modified": 0, "misses": 0, "expired": 0}
+_saves_since_trim = 0
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(_DB_PATH, timeout=10.0)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _init_db():
+    conn = _connect()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS grade_sessions (
+            session_id   TEXT PRIMARY KEY,
+            client_id    TEXT,
+            client_ip    TEXT,
+            paper_id     TEXT,
+            question_ids TEXT NOT NULL,
+            score        REAL,
+            max_score    REAL,
+            grade        TEXT,
+            result       TEXT NOT NULL,
+            etag         TEXT NOT NULL,
+            created_at   REAL NOT NULL,
+            updated_at   REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_grade_sessions_client ON grade_sessions (client_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_grade_sessions_updated ON grade_sessions (updated_at)")
+    conn.commit()
+    conn.close()
+    _trim()
+    print(f"[批改会话] 使用 SQLite 存储: {_DB_PATH}")
+
+
+def _trim():
+    with _lock:
+        conn = _connect()
+        cur = conn.execute("DELETE FROM grade_sessions WHERE updated_at < ?", (time.time() - _TTL_SECONDS,))
+        conn.commit()
+        conn.close()
+        _counters["expired"] += cur.rowcount
+
+
+def _summary(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "sessionId": row["session_id"],
+        "paperId": row["paper_id"],
+        "questionIds": json.loads(row["question_ids"]),
+        "score": row["score"],
+        "maxScore": row["max_score"],
+        "grade": row["grade"],
+        "createdAt": row["created_at"],
+        "updatedAt": row["updated_at"],
+    }
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def valid_id(value: Any) -> bool:
+    return isinstance(value, str) and 0 < len(value) <= MAX_ID_LENGTH
+
+
+def save(
+    session_id: str,
+    result: Dict[str, Any],
+    client_id: Optional[str] = None,
+    client_ip: Optional[str] = None,
+    paper_id: Optional[str] = None,
+    question_ids: Optional[List[Any]] = None,
+) -> Optional[str]:
+    """保存（或覆盖）一次批改结果，返回 ETag；该 session id 的未过期记录属于其他所有者（见模块说明）时不写入，返回 None。"""
+    global _saves_since_trim
+    if not valid_id(session_id):
+        return None
+    data = json.dumps(result, ensure_ascii=False)
+    etag = f'"{hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]}"'
+    score, max_score = result.get("score"), result.get("maxScore")
+    now = time.time()
+    with _lock:
+        conn = _connect()
+        cur = conn.execute(
+            """
+            INSERT INTO grade_sessions
+                (session_id, client_id, client_ip, paper_id, question_ids, score, max_score, grade, result, etag, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (session_id) DO UPDATE SET
+                client_id = excluded.client_id, client_ip = excluded.client_ip, paper_id = excluded.paper_id,
+                question_ids = excluded.question_ids, score = excluded.score, max_score = excluded.max_score,
+                grade = excluded.grade, result = excluded.result, etag = excluded.etag, updated_at = excluded.updated_at,
+                created_at = CASE WHEN grade_sessions.updated_at < ? THEN excluded.created_at ELSE grade_sessions.created_at END
+            WHERE grade_sessions.client_id = excluded.client_id
+                OR (grade_sessions.client_id IS NULL AND excluded.client_id IS NULL
+                    AND grade_sessions.client_ip IS excluded.client_ip)
+                OR grade_sessions.updated_at < ?
+            """,
+            (
+                session_id, client_id, client_ip, paper_id,
+                json.dumps([str(q) for q in question_ids or []], ensure_ascii=False),
+                score if isinstance(score, (int, float)) else None,
+                max_score if isinstance(max_score, (int, float)) else None,
+                result.get("grade"), data, etag, now, now, now - _TTL_SECONDS, now - _TTL_SECONDS,
+            ),
+        )
+        conn.commit()
+        conn.close()
+        saved = cur.rowcount > 0
+        _counters["saved" if saved else "rejected"] += 1
+        _saves_since_trim += 1
+        trim = _saves_since_trim >= _TRIM_EVERY
+        if trim:
+            _saves_since_trim = 0
+    if trim:
+        _trim()
+    return etag if saved else None
+
+
+def get(session_id: str, if_none_match: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """按 session id 取回记录：{"etag", "notModified", 摘要字段…, "result"}；if_none_match 与 ETag 相同时不解析结果
+    （notModified 为 True）。不存在或已过期时返回 None。"""
+    if not valid_id(session_id):
+        return None
+    with _lock:
+        conn = _connect()
+        row = conn.execute(
+            "SELECT * FROM grade_sessions WHERE session_id = ? AND updated_at >= ?",
+            (session_id, time.time() - _TTL_SECONDS),
+        ).fetchone()
+        conn.close()
+        if row is None:
+            _counters["misses"] += 1
+            return None
+        not_modified = bool(if_none_match) and row["etag"] in [t.strip() for t in if_none_match.split(",")]
+        _counters["not_modified" if not_modified else "hits"] += 1
+    record = dict(_summary(row), etag=row["etag"], notModified=not_modified)
+    if not not_modified:
+        record["result"] = json.loads(row["result"])
+    return record
+
+
+def list_sessions(client_id: str, limit: int = 20, before: Optional[float] = None) -> Dict[str, Any]:
+    """某客户端的批改历史（摘要，不含报告正文），按创建时间倒序分页：before 为上一页返回的 nextBefore。"""
+    limit = max(1, min(MAX_PAGE_SIZE, limit))
+    sql = "SELECT * FROM grade_sessions WHERE client_id = ? AND updated_at >= ?"
+    args: List[Any] = [client_id, time.time() - _TTL_SECONDS]
+    if before is not None:
+        sql += " AND created_at < ?"
+        args.append(before)
+    sql += " ORDER BY created_at DESC LIMIT ?"
+    args.append(limit + 1)
+    with _lock:
+        conn = _connect()
+        rows = conn.execute(sql, args).fetchall()
+        conn.close()
+    items = [_summary(r) for r in rows[:limit]]
+    return {"items": items, "nextBefore": items[-1]["createdAt"] if len(rows) > limit else None}
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        return dict(_counters, ttl_seconds=_TTL_SECONDS)
+
+
+# ── 模块初始化 ──────────────────────────────────────────────────────────────────
+_init_db()
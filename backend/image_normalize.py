@@ -0,0 +1,278 @@
+"""
+拍照作答图片规整：手机原图动辄数 MB，批改只需要能看清手写字。发给上游之前对每张图片：
+
+- 去掉字节完全相同的重复图片（前端重复添加同一张照片）
+- 按 EXIF 方向摆正（手机竖拍的照片像素本身是横的）
+- 长边缩到 GRADE_IMAGE_MAX_SIDE 像素以内，转灰度，按 GRADE_IMAGE_QUALITY 重新编码为 JPEG / WebP
+- 重新编码后反而更大且无需摆正 / 缩小时保留原图；无法解码的图片（如未装 HEIF 插件时的 HEIC）原样保留
+
+解码与编码在进程池中执行，不阻塞事件循环；未安装 Pillow 时只去重。上传的图片不在主进程中整张读入：
+去重用上传时分块算好的摘要，交给子进程的是分块写出的临时文件路径，而不是 pickle 过去的图片字节。
+每次请求的图片数、去重数、字节数变化与规整耗时记入 report，批改结束后由 note_upstream 连同上游耗时一起打日志并汇总。
+
+环境变量：
+  GRADE_IMAGE_NORMALIZE   - 设为 0 关闭规整（仍去重），默认开启
+  GRADE_IMAGE_MAX_SIDE    - 长边像素上限，默认 1600
+  GRADE_IMAGE_FORMAT      - jpeg 或 webp，默认 jpeg
+  GRADE_IMAGE_QUALITY     - 编码质量，默认 75
+  GRADE_IMAGE_GRAYSCALE   - 设为 0 保留彩色，默认转灰度
+  GRADE_IMAGE_WORKERS     - 进程池大小，默认 2
+"""
+
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+
+from answer_uploads import UploadedImage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow 为可选依赖
+    Image = None
+    ImageOps = None
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_ENABLED = (os.getenv("GRADE_IMAGE_NORMALIZE") or "1").strip().lower() not in ("0", "false", "off")
+_MAX_SIDE = int(os.getenv("GRADE_IMAGE_MAX_SIDE") or 1600)
+_FORMAT = (os.getenv("GRADE_IMAGE_FORMAT") or "jpeg").strip().lower()
+_QUALITY = int(os.getenv("GRADE_IMAGE_QUALITY") or 75)
+_GRAYSCALE = (os.getenv("GRADE_IMAGE_GRAYSCALE") or "1").strip().lower() not in ("0", "false", "off")
+_WORKERS = max(1, int(os.getenv("GRADE_IMAGE_WORKERS") or 2))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_counters: Dict[str, Any] = {
+    "requests": 0,
+    "images": 0,
+    "duplicates": 0,
+    "normalized": 0,
+    "kept_original": 0,
+    "failed": 0,
+    "bytes_before": 0,
+    "bytes_after": 0,
+    "normalize_seconds": 0.0,
+}
+_upstream: Dict[str, List[float]] = {"normalized": [0, 0.0], "original": [0, 0.0]}    # 类型 -> [请求数, 上游总耗时]
+
+
+def _normalize_one(source: Any, max_side: int, fmt: str, quality: int, grayscale: bool) -> Optional[Tuple[bytes, str, bool]]:
+    """（在子进程中执行）source 为图片文件路径或字节；返回 (新图片字节, mime, 是否摆正或缩小过)，无法解码时返回 None。"""
+    try:
+        with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as src:
+            changed = (src.getexif().get(0x0112) or 1) != 1
+            im = ImageOps.exif_transpose(src)
+            if max(im.size) > max_side:
+                im.thumbnail((max_side, max_side), Image.LANCZOS)
+                changed = True
+            im = im.convert("L" if grayscale else "RGB")
+            out = io.BytesIO()
+            if fmt == "webp":
+                im.save(out, "WEBP", quality=quality, method=4)
+                return (out.getvalue(), "image/webp", changed)
+            im.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+            return (out.getvalue(), "image/jpeg", changed)
+    except Exception:
+        return None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn：事件循环进程中有多个线程，fork 出的子进程可能继承被占用的锁
+        _pool = ProcessPoolExecutor(max_workers=_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _read_image(image: Any) -> Optional[Tuple[Any, str, int, bytes]]:
+    """返回 (图片来源, mime, 字节数, 去重摘要)；data URL 无法解析时返回 None。
+
+    上传的图片来源为 UploadedImage 本身（不读入内存），摘要沿用 scan 时算好的；data URL 的来源为解码后的字节。
+    两者的摘要都是 base64 文本的 sha256。
+    """
+    if isinstance(image, UploadedImage):
+        return (image, image.mime, image.size, image.digest.encode("ascii"))
+    if not isinstance(image, str):
+        return None
+    s = image.strip()
+    mime = "image/jpeg"
+    if s.startswith("data:"):
+        idx = s.find(",")
+        if idx == -1:
+            return None
+        header = s[5:idx]
+        if ";" in header:
+            mime = header.split(";")[0].strip().lower() or mime
+        s = s[idx + 1:]
+    try:
+        raw = base64.b64decode(s, validate=False)
+    except (binascii.Error, ValueError):
+        return None
+    return (raw, mime, len(raw), hashlib.sha256(s.encode("utf-8")).hexdigest().encode("ascii"))
+
+
+def _spill(image: UploadedImage) -> str:
+    """把上传的图片分块写到有路径的临时文件（Starlette 的上传临时文件没有路径，子进程打不开），返回路径。"""
+    fd, path = tempfile.mkstemp(prefix="answer-image-")
+    with os.fdopen(fd, "wb") as f:
+        for chunk in image.raw_chunks():
+            f.write(chunk)
+    return path
+
+
+def _wrap_like(original: Any, data: bytes, mime: str) -> Any:
+    """按原图片的形式（data URL 或上传文件）包装新图片。"""
+    if isinstance(original, UploadedImage):
+        image = UploadedImage(io.BytesIO(data), mime, original.filename)
+        image.scan()
+        return image
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def _image_bytes(image: Any) -> int:
+    if isinstance(image, UploadedImage):
+        return image.size
+    return len(image) * 3 // 4 if isinstance(image, str) else 0
+
+
+def _dedupe(images: List[Any], report: Dict[str, Any]) -> List[Tuple[Any, Optional[Tuple[Any, str, int, bytes]]]]:
+    """去掉内容相同的重复图片，返回 [(原条目, _read_image 的结果或 None)]（在线程池中执行）。"""
+    seen = set()
+    unique: List[Tuple[Any, Optional[Tuple[Any, str, int, bytes]]]] = []
+    for image in images:
+        decoded = _read_image(image)
+        if decoded is not None:
+            if decoded[3] in seen:
+                report["duplicates"] += 1
+                continue
+            seen.add(decoded[3])
+            report["bytesBefore"] += decoded[2]
+        else:
+            report["bytesBefore"] += _image_bytes(image)
+        unique.append((image, decoded))
+    return unique
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def available() -> bool:
+    return _ENABLED and Image is not None
+
+
+async def normalize(images: List[Any]) -> Tuple[List[Any], Dict[str, Any]]:
+    """规整一组作答图片（data URL 字符串或 UploadedImage），返回 (新的图片列表, report)。
+
+    解析失败的条目原样保留，交给下游按原逻辑处理。
+    """
+    started = time.monotonic()
+    report: Dict[str, Any] = {"images": len(images), "duplicates": 0, "bytesBefore": 0, "bytesAfter": 0, "normalized": False}
+    unique = await asyncio.to_thread(_dedupe, images, report)
+
+    results: List[Optional[Tuple[bytes, str, bool]]] = [None] * len(unique)
+    todo = [i for i, (_, decoded) in enumerate(unique) if decoded is not None]
+    if available() and todo:
+        loop = asyncio.get_running_loop()
+        spilled: List[str] = []
+        try:
+            sources = []
+            for i in todo:
+                source = unique[i][1][0]
+                if isinstance(source, UploadedImage):
+                    source = await asyncio.to_thread(_spill, source)
+                    spilled.append(source)
+                sources.append(source)
+            pool = _get_pool()
+            done = await asyncio.gather(*(
+                loop.run_in_executor(pool, _normalize_one, source, _MAX_SIDE, _FORMAT, _QUALITY, _GRAYSCALE)
+                for source in sources
+            ))
+            for i, result in zip(todo, done):
+                results[i] = result
+            report["normalized"] = True
+        except Exception as e:
+            # 进程池异常（如子进程被杀）时发原图，不影响批改；下次请求重建进程池
+            print(f"[图片规整] 进程池执行失败，发送原图: {e}")
+            _counters["failed"] += len(todo)
+            if isinstance(e, BrokenProcessPool):
+                shutdown()
+        finally:
+            for path in spilled:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    out: List[Any] = []
+    for (image, decoded), result in zip(unique, results):
+        if result is None or decoded is None:
+            if decoded is not None and report["normalized"]:
+                _counters["failed"] += 1
+            out.append(image)
+            report["bytesAfter"] += decoded[2] if decoded is not None else _image_bytes(image)
+            continue
+        data, mime, changed = result
+        if len(data) >= decoded[2] and not changed:
+            _counters["kept_original"] += 1
+            out.append(image)
+            report["bytesAfter"] += decoded[2]
+            continue
+        _counters["normalized"] += 1
+        out.append(_wrap_like(image, data, mime))
+        report["bytesAfter"] += len(data)
+
+    report["seconds"] = round(time.monotonic() - started, 3)
+    _counters["requests"] += 1
+    _counters["images"] += len(images)
+    _counters["duplicates"] += report["duplicates"]
+    _counters["bytes_before"] += report["bytesBefore"]
+    _counters["bytes_after"] += report["bytesAfter"]
+    _counters["normalize_seconds"] += report["seconds"]
+    return out, report
+
+
+def note_upstream(report: Dict[str, Any], seconds: float, session_id: str = ""):
+    """批改结束后调用：记录本次上游耗时，打印本次请求的字节节省与耗时对比。"""
+    kind = "normalized" if report.get("normalized") else "original"
+    _upstream[kind][0] += 1
+    _upstream[kind][1] += seconds
+    before, after = report["bytesBefore"], report["bytesAfter"]
+    saved = f"{(before - after) / before:.0%}" if before else "0%"
+    other, other_label = ("original", "未规整") if kind == "normalized" else ("normalized", "已规整")
+    n, total = _upstream[other]
+    baseline = f"，{other_label}请求平均 {total / n:.1f}s" if n else ""
+    print(
+        f"[图片规整] session={session_id} {report['images']} 张（去重 {report['duplicates']}），"
+        f"{before / 1024:.0f}KB → {after / 1024:.0f}KB（节省 {saved}），规整耗时 {report['seconds'] * 1000:.0f}ms，"
+        f"上游耗时 {seconds:.1f}s{baseline}"
+    )
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def get_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = dict(
+        _counters,
+        normalize_seconds=round(_counters["normalize_seconds"], 3),
+        enabled=_ENABLED,
+        pillow=Image is not None,
+        format=_FORMAT,
+        max_side=_MAX_SIDE,
+        quality=_QUALITY,
+        grayscale=_GRAYSCALE,
+    )
+    stats["bytes_saved"] = _counters["bytes_before"] - _counters["bytes_after"]
+    stats["upstream_avg_seconds"] = {
+        kind: round(total / n, 3) if n else None for kind, (n, total) in _upstream.items()
+    }
+    return stats
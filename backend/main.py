@@ -1,24 +1,43 @@
-from datetime import date, datetime, timedelta, timezone
+from datetime import date
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
-from fastapi.responses import JSONResponse, Response
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import contextlib
+import contextvars
 import hashlib
 import json
 import os
 import re
 import threading
 import time
-from zoneinfo import ZoneInfo
-import urllib.request
-import urllib.error
-from typing import Optional, List, Dict, Any
+import unicodedata
+import httpx
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple
 from collections import Counter
+from email.utils import formatdate, parsedate_to_datetime
+from functools import lru_cache
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from stats_db import record_submit, get_stats
+import grade_jobs
+import grade_sessions
+import grade_cache
+import gemini_context_cache
+import grade_hedging
+import circuit_breaker
+import gemini_key_pool
+import admission
+import answer_uploads
+import image_normalize
+import prompt_budget
+import prompt_format
+import paper_store
+import paper_watcher
+import papers_snapshot
+import precompress
 
 
 
@@ -39,14 +58,20 @@ def _record_submit_stat(is_essay: bool, client_ip: Optional[str] = None) -> None
     record_submit(is_essay, client_ip)
 
 app = FastAPI()
-app.add_middleware(GZipMiddleware, minimum_size=500)
+# 试卷、索引与 /images 已在加载时预压缩（见 precompress.py），不再经过 GZipMiddleware
+app.add_middleware(
+    precompress.GZipExceptPrecompressed,
+    paths=("/api/paper", "/api/list"),
+    prefixes=("/images/",),
+    minimum_size=precompress.MIN_SIZE,
+)
 
-_papers_index: list = []
-_papers_cache: Dict[str, dict] = {}
-_papers_json_cache: Dict[str, bytes] = {}
-_papers_file_mtime: Dict[str, float] = {}
-_papers_index_json: bytes = b"[]"
-_papers_index_etag: str = '"empty"'
+# /api/list 的索引、响应字节、预压缩版本与 ETag；目录监视重建索引时整体替换（一次赋值），请求方不会读到新旧混合的状态
+_papers_listing: Dict[str, Any] = {"index": [], "json": b"[]", "encoded": {}, "etag": '"empty"'}
+_startup_stats: Dict[str, Any] = {}
+MAX_VALIDATE_PAPERS = 200            # /api/papers/validate 一次最多校验的试卷数
+_paper_conditional_lock = threading.Lock()
+_paper_conditional_stats = {"not_modified": 0, "batch_requests": 0, "batch_checked": 0, "batch_changed": 0, "batch_missing": 0}
 
 # ---------------------------------------------------------
 # 1. 跨域配置 (CORS) - 允许前端访问后端
@@ -57,6 +82,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],      # 前端把试卷详情的 ETag 存入 localStorage，用于批量校验
 )
 
 
@@ -73,55 +99,72 @@ def _sort_key(p):
 
 
 def _build_index():
-    """遍历 data 目录，将所有试卷加载到内存，构建排好序的索引列表。"""
-    global _papers_index, _papers_cache, _papers_json_cache, _papers_file_mtime, _papers_index_json, _papers_index_etag
+    """遍历 data 目录建立试卷存储（见 paper_store.py），构建排好序的索引列表。"""
+    global _papers_listing
     data_dir = get_data_dir()
     if not os.path.isdir(data_dir):
         os.makedirs(data_dir, exist_ok=True)
-        _papers_index = []
-        _papers_cache = {}
-        _papers_json_cache = {}
-        _papers_file_mtime = {}
-        _papers_index_json = b"[]"
-        _papers_index_etag = '"empty"'
+        _papers_listing = {"index": [], "json": b"[]", "encoded": {}, "etag": '"empty"'}
         return
 
-    papers = []
-    cache: Dict[str, dict] = {}
-    json_cache: Dict[str, bytes] = {}
-    mtime_map: Dict[str, float] = {}
-    for filename in os.listdir(data_dir):
-        if not filename.endswith(".json"):
-            continue
-        file_path = os.path.join(data_dir, filename)
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = json.load(f)
-            pid = content.get("id", filename[:-5])
-            cache[pid] = content
-            json_cache[pid] = json.dumps(content, ensure_ascii=False).encode("utf-8")
-            mtime_map[pid] = os.path.getmtime(file_path)
-            papers.append({
-                "id": pid,
-                "name": content.get("name", "未命名试卷"),
-                "year": content.get("year", 2024),
-                "region": content.get("region", "全国"),
-                "examType": content.get("examType", "公务员"),
-            })
-        except Exception as e:
-            print(f"读取文件 {filename} 出错: {e}")
-
-    papers.sort(key=_sort_key)
-    _papers_index = papers
-    _papers_cache = cache
-    _papers_json_cache = json_cache
-    _papers_file_mtime = mtime_map
-    _papers_index_json = json.dumps(papers, ensure_ascii=False).encode("utf-8")
-    _papers_index_etag = f'"{hashlib.md5(_papers_index_json).hexdigest()}"'
+    # 签名未变的试卷直接沿用启动快照（见 papers_snapshot.py），其余并行读取解析；设了内存预算时只建索引
+    started = time.perf_counter()
+    loaded = paper_store.load(data_dir, _build_paper_prompt_prefixes, _prompt_prefix_fingerprint())
+    listing = _publish_papers_listing()
+    papers = listing["index"]
     by_type = Counter((p.get("examType") or "未标注") for p in papers)
     type_line = "，".join(f"{k} {v}份" for k, v in sorted(by_type.items(), key=lambda x: (-x[1], x[0])))
-    print(f"[Startup] 已加载 {len(papers)} 份试卷到内存缓存, index_size={len(_papers_index_json)} bytes, etag={_papers_index_etag}")
+    store = paper_store.get_stats()
+    print(
+        f"[Startup] 已索引 {len(papers)} 份试卷，常驻内存 {store['resident']['json']} 份"
+        f"（{store['resident_bytes'] / 1024 / 1024:.1f}MB），index_size={len(listing['json'])} bytes, etag={listing['etag']}"
+    )
     print(f"[Startup] 按考试类型: {type_line}")
+    print(f"[Startup] 已预拼 {store['resident']['prefixes']} 份试卷的 prompt 前缀（本次重建 {loaded['rebuilt']} 份）")
+    load = papers_snapshot.get_stats()
+    print(
+        f"[Startup] 试卷加载耗时 {(time.perf_counter() - started) * 1000:.0f}ms："
+        f"快照{'命中' if load['snapshot'] else '缺失'}，沿用 {load['reused']} 份，重新加载 {load['loaded']} 份，"
+        f"删除 {load['removed']} 份"
+    )
+
+
+def _publish_papers_listing() -> Dict[str, Any]:
+    """按试卷存储的当前索引生成 /api/list 的响应并整体替换。"""
+    global _papers_listing
+    papers = paper_store.index_entries()
+    papers.sort(key=_sort_key)
+    body = json.dumps(papers, ensure_ascii=False).encode("utf-8")
+    _papers_listing = {
+        "index": papers,
+        "json": body,
+        "encoded": precompress.compress(body),
+        "etag": f'"{hashlib.md5(body).hexdigest()}"',
+    }
+    return _papers_listing
+
+
+def _on_papers_changed(filenames) -> Dict[str, int]:
+    """目录监视发现试卷文件变化时调用（后台线程）：增量更新试卷存储，有变化时重建 /api/list。"""
+    result = paper_store.apply_changes(filenames)
+    if any(result.values()):
+        _publish_papers_listing()
+    return result
+
+
+def _prompt_prefix_fingerprint() -> str:
+    """预拼前缀的输入：PROMPT_PREFIX_VERSION、批改说明与地区评分特征、prompt_format 的编码版本与设置；任一变化时快照中的前缀作废。"""
+    h = hashlib.sha256()
+    for part in (
+        str(PROMPT_PREFIX_VERSION),
+        ESSAY_GRADING_INSTRUCTION,
+        SMALL_QUESTION_GRADING_INSTRUCTION,
+        json.dumps(PROVINCE_GRADING_PROFILE, ensure_ascii=False, sort_keys=True),
+        prompt_format.fingerprint(),
+    ):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
 
 
 @app.on_event("startup")
@@ -130,41 +173,38 @@ def startup_load():
     data_dir = get_data_dir()
     exists = os.path.isdir(data_dir)
     print(f"[Startup] data_dir={data_dir}, exists={exists}, cwd={os.getcwd()}")
+    started = time.perf_counter()
     _build_index()
+    _startup_stats["index_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    # 之后试卷的增删改由后台监视增量处理，请求路径不再检查文件
+    if paper_watcher.start(data_dir, paper_store.file_sigs, _on_papers_changed):
+        paper_store.set_index_complete(True)
+
+
+@app.on_event("shutdown")
+def _stop_paper_watcher():
+    paper_store.set_index_complete(False)
+    paper_watcher.stop()
 
 
 def _refresh_paper_cache_if_stale(paper_id: str) -> None:
-    """若磁盘上的试卷 JSON 比内存缓存新，则重新加载该份试卷（改 data 后无需重启后端）。"""
-    global _papers_cache, _papers_json_cache, _papers_file_mtime
-    data_dir = get_data_dir()
-    file_path = os.path.join(data_dir, f"{paper_id}.json")
-    if not os.path.isfile(file_path):
-        return
-    try:
-        mtime = os.path.getmtime(file_path)
-    except OSError:
-        return
-    prev = _papers_file_mtime.get(paper_id)
-    if prev is not None and mtime <= prev:
+    """若磁盘上的试卷 JSON 比内存缓存新，则重新加载该份试卷（改 data 后无需重启后端）。
+    目录监视运行时（见 paper_watcher.py）由监视负责，这里不做任何文件操作。"""
+    if paper_watcher.active():
         return
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = json.load(f)
-    except Exception as e:
-        print(f"[试卷缓存] 刷新失败 {file_path}: {e}")
-        return
-    pid = content.get("id", paper_id)
-    _papers_cache[pid] = content
-    _papers_json_cache[pid] = json.dumps(content, ensure_ascii=False).encode("utf-8")
-    _papers_file_mtime[pid] = mtime
+    paper_store.refresh_if_stale(paper_id)
 
 
 def _load_paper_by_id(paper_id: str):
-    """优先从内存缓存读取试卷，缓存未命中时回退到磁盘读取。"""
+    """优先从试卷存储读取（已被淘汰的试卷由存储重新读入），未找到时回退到磁盘读取。"""
     _refresh_paper_cache_if_stale(paper_id)
-    if paper_id in _papers_cache:
-        return _papers_cache[paper_id]
+    paper = paper_store.get_paper(paper_id)
+    if paper is not None:
+        return paper
     data_dir = get_data_dir()
+    if paper_watcher.active() or not paper_store.valid_id(paper_id):
+        print(f"试卷未找到: paper_id={paper_id}（不在试卷索引中）")
+        return None
     for base in [data_dir, os.path.abspath("data")]:
         file_path = os.path.join(base, f"{paper_id}.json")
         if os.path.isfile(file_path):
@@ -182,23 +222,14 @@ def _load_paper_by_id(paper_id: str):
 # ---------------------------------------------------------
 @app.get("/api/list")
 def list_papers(request: Request):
-    if_none_match = request.headers.get("if-none-match", "")
-    if if_none_match == _papers_index_etag:
-        return Response(
-            status_code=304,
-            headers={
-                "Cache-Control": "public, max-age=3600, stale-while-revalidate=86400",
-                "ETag": _papers_index_etag,
-            },
-        )
-    return Response(
-        content=_papers_index_json,
-        media_type="application/json",
-        headers={
-            "Cache-Control": "public, max-age=3600, stale-while-revalidate=86400",
-            "ETag": _papers_index_etag,
-        },
-    )
+    listing = _papers_listing
+    headers = {
+        "Cache-Control": "public, max-age=3600, stale-while-revalidate=86400",
+        "ETag": listing["etag"],
+    }
+    if precompress.etag_matches(request.headers.get("if-none-match", ""), listing["etag"]):
+        return precompress.not_modified(request.headers, listing["encoded"], headers)
+    return precompress.response(request.headers, listing["json"], listing["encoded"], headers=headers)
 
 
 # ---------------------------------------------------------
@@ -206,18 +237,28 @@ def list_papers(request: Request):
 # 调用示例：/api/paper?id=gwy_jiangsu_2024_A
 # ---------------------------------------------------------
 @app.get("/api/paper")
-def get_paper(id: str):
+def get_paper(id: str, request: Request):
     paper_id = id.replace(".json", "") if id.endswith(".json") else id
     _refresh_paper_cache_if_stale(paper_id)
-    _cache_headers = {"Cache-Control": "public, max-age=31536000, immutable"}
-
-    if paper_id in _papers_json_cache:
-        return Response(
-            content=_papers_json_cache[paper_id],
-            media_type="application/json",
-            headers=_cache_headers,
-        )
-
+    _cache_headers = {"Cache-Control": "public, max-age=3600, stale-while-revalidate=86400"}
+
+    # 强 ETag 为响应字节的 sha256（加载时算好），试卷原地修改后 ETag 随之变化；校验只查索引，不读试卷内容
+    validator = paper_store.validator(paper_id)
+    if validator is not None:
+        _cache_headers["ETag"] = validator["etag"]
+        _cache_headers["Last-Modified"] = formatdate(validator["mtime"], usegmt=True)
+        if _paper_not_modified(request, validator):
+            with _paper_conditional_lock:
+                _paper_conditional_stats["not_modified"] += 1
+            return precompress.not_modified(request.headers, validator["encodings"], _cache_headers)
+
+    paper_json = paper_store.get_json(paper_id)
+    if paper_json is not None:
+        body, encoded = paper_json
+        return precompress.response(request.headers, body, encoded, headers=_cache_headers)
+
+    if paper_watcher.active() or not paper_store.valid_id(paper_id):
+        raise HTTPException(status_code=404, detail=f"试卷文件不存在: {id}")
     data_dir = get_data_dir()
     file_path = os.path.join(data_dir, f"{paper_id}.json")
     print(f"前端请求读取试卷(缓存未命中): {file_path}")
@@ -233,6 +274,63 @@ def get_paper(id: str):
         raise HTTPException(status_code=500, detail=f"试卷解析失败: {str(e)}")
 
 
+def _paper_not_modified(request: Request, validator: Dict[str, Any]) -> bool:
+    """If-None-Match 优先；没有时按 If-Modified-Since 与文件 mtime（秒级）比较。"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return precompress.etag_matches(if_none_match, validator["etag"])
+    since = request.headers.get("if-modified-since")
+    if not since:
+        return False
+    try:
+        return int(validator["mtime"]) <= parsedate_to_datetime(since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+# ---------------------------------------------------------
+# 3.1 接口：批量校验前端缓存的试卷
+# 请求体：{"papers": [{"id": "gwy_jiangsu_2024_A", "etag": "\"…\""}, ...]}
+# 只返回有变化的试卷（含新内容与新 ETag）和已不存在的试卷 id，未变化的只计数
+# ---------------------------------------------------------
+@app.post("/api/papers/validate")
+def validate_papers(payload: dict):
+    items = payload.get("papers")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="papers 须为 [{id, etag}] 列表")
+    if len(items) > MAX_VALIDATE_PAPERS:
+        raise HTTPException(status_code=400, detail=f"一次最多校验 {MAX_VALIDATE_PAPERS} 份试卷")
+    changed: List[bytes] = []
+    missing: List[str] = []
+    unchanged = 0
+    for item in items:
+        paper_id = item.get("id") if isinstance(item, dict) else None
+        if not isinstance(paper_id, str) or not paper_id:
+            raise HTTPException(status_code=400, detail="papers 中每项须有字符串 id")
+        _refresh_paper_cache_if_stale(paper_id)
+        validator = paper_store.validator(paper_id)
+        paper_json = paper_store.get_json(paper_id) if validator is not None else None
+        if paper_json is None:
+            missing.append(paper_id)
+        elif precompress.etag_matches(str(item.get("etag") or ""), validator["etag"]):
+            unchanged += 1
+        else:
+            # 试卷内容直接拼入预序列化的响应字节，不重新编码
+            head = json.dumps(
+                {"id": paper_id, "etag": validator["etag"], "lastModified": formatdate(validator["mtime"], usegmt=True)},
+                ensure_ascii=False,
+            )
+            changed.append(head[:-1].encode("utf-8") + b', "paper": ' + paper_json[0] + b"}")
+    with _paper_conditional_lock:
+        _paper_conditional_stats["batch_requests"] += 1
+        _paper_conditional_stats["batch_checked"] += len(items)
+        _paper_conditional_stats["batch_changed"] += len(changed)
+        _paper_conditional_stats["batch_missing"] += len(missing)
+    tail = json.dumps({"missing": missing, "unchanged": unchanged}, ensure_ascii=False)
+    body = b'{"changed": [' + b", ".join(changed) + b"], " + tail[1:].encode("utf-8")
+    return Response(content=body, media_type="application/json", headers={"Cache-Control": "no-store"})
+
+
 PROVINCE_GRADING_PROFILE = {
     "全国": {
         "label": "国考",
@@ -363,185 +461,68 @@ def get_submit_stats():
     return get_stats()
 
 
-# ---------------------------------------------------------
-# 4. 接口：提交 AI 批改 (预留位置)
-# ---------------------------------------------------------
-@app.post("/api/grade")
-def grade_essay(request: Request, payload: dict):
-    print("收到前端提交的答案:", payload)
-
-    # 支持传入 paperId 来从 data 中读取试卷（优先从文件加载，兼容 Render 部署）
-    paper = None
-    paper_id = payload.get("paperId") or payload.get("id")
-    if paper_id:
-        paper = _load_paper_by_id(paper_id)
-    elif payload.get("user_answer") and not payload.get("answers") and not payload.get("question_id"):
-        raise HTTPException(
-            status_code=400,
-            detail="请求缺少 paperId 和 question_id，无法加载试卷。请重新部署前端（Vercel 等）并刷新页面后再试；前端需传 paperId、question_id、user_answer 或直接传 answers。",
-        )
-
-    # 如果前端直接提供了 questions 或 materials，就使用前端的覆盖
-    if not paper:
-        if payload.get("questions") or payload.get("materials"):
-            paper = {
-                "id": paper_id or "inline",
-                "name": payload.get("paperName", "inline paper"),
-                "materials": payload.get("materials", []),
-                "questions": payload.get("questions", []),
-            }
-
-    # 收集 answers（前端可以只传 question id -> answer 的映射）
-    answers = payload.get("answers") or {}
-    # 兼容单题提交格式（老格式）
-    if not answers and payload.get("question_id") and payload.get("user_answer"):
-        answers = { payload.get("question_id"): payload.get("user_answer") }
-    # 拍照上传：仅有 answer_images 时也视为有答案，用占位文字满足后续校验
-    answer_images: List[str] = payload.get("answer_images") or []
-    has_images_flag = bool(payload.get("has_images"))
-    img_sizes = [len(img) for img in answer_images] if answer_images else []
-    print(f"[批改] has_images_flag={has_images_flag}, answer_images_count={len(answer_images)}, img_sizes_chars={img_sizes}")
-    if has_images_flag and not answer_images:
-        raise HTTPException(
-            status_code=400,
-            detail="前端标记有图片但未收到图片数据，请稍等图片加载完成（约 1～2 秒）后再点击提交。",
-        )
-    if answer_images and not answers and payload.get("question_id"):
-        answers = { payload.get("question_id"): "（考生上传了作答图片，请根据图片内容批改）" }
-    # 或者前端可能发送 question_id(s) 列表（无答案）
-    question_ids: List[str] = []
-    if answers:
-        question_ids = list(answers.keys())
-    elif payload.get("question_id"):
-        question_ids = [payload.get("question_id")]
-    elif payload.get("question_ids"):
-        question_ids = payload.get("question_ids")
-
-    # 从 paper 中解析出要发给模型的题目信息（根据 id 匹配）
-    questions_for_model: List[Dict[str, Any]] = []
-    paper_questions = (paper.get("questions") if paper else []) or []
+@app.get("/api/stats/grading")
+def get_grading_stats():
+    """返回批改链路计数：singleflight.upstream_calls 为实际发起的上游批改次数，coalesced 为合并后省下的次数；
+    contextCache 为 Gemini 上下文缓存的命中、创建、续期、淘汰与回退次数；hedging 为对冲次数与各上游耗时分位数；
+    breakers 为各上游 / Key 熔断器的状态、窗口内失败率与 p95 耗时；geminiKeys 为各 Key 最近一分钟的 RPM / TPM 利用率；
+    deadline 为超时返回 504 与因剩余时间不足而跳过的上游调用次数；disconnect 为客户端断开后取消的批改、
+    上游调用次数，以及取消时已耗时间与按通常耗时估算省下的上游时间（秒）；admission 为各优先级类别的排队深度、排队耗时与 IP 限速的计数；
+    images 为作答图片规整的去重数、字节节省与规整 / 未规整请求的平均上游耗时；
+    promptTokens 为各段（说明、地区、材料、题目、答案）的估算输入 token、超预算裁剪次数与估算值和上游实际值之比；
+    promptFormat 为材料 / 题目编码的 A/B 设置与两组的平均上游耗时；
+    fanOut 为多题拆分批改的请求数、题目数、失败题数，以及总耗时与各题耗时之和（秒）；
+    sessions 为批改会话的保存、取回、304 与过期清理次数。"""
+    return {
+        "singleflight": dict(_singleflight_stats, inflight=len(_inflight_gradings)),
+        "contextCache": gemini_context_cache.get_stats(),
+        "hedging": grade_hedging.get_stats(),
+        "breakers": circuit_breaker.get_stats(),
+        "geminiKeys": gemini_key_pool.get_stats(),
+        "deadline": dict(_deadline_stats, default_seconds=_GRADE_DEADLINE_SECONDS),
+        "disconnect": {k: round(v, 3) if isinstance(v, float) else v for k, v in _disconnect_stats.items()},
+        "admission": admission.get_stats(),
+        "images": image_normalize.get_stats(),
+        "promptTokens": prompt_budget.get_stats(),
+        "promptFormat": prompt_format.get_stats(),
+        "fanOut": dict({k: round(v, 3) if isinstance(v, float) else v for k, v in _fan_out_stats.items()}, default=_GRADE_FAN_OUT),
+        "sessions": grade_sessions.get_stats(),
+    }
 
-    def find_question_by_id(qid: str) -> Optional[Dict[str, Any]]:
-        for q in paper_questions:
-            if not isinstance(q, dict):
-                continue
-            # 常见的 id 字段名就尝试匹配
-            if q.get("id") == qid or q.get("qid") == qid or str(q.get("id")) == str(qid):
-                return q
-        # 也尝试按索引匹配（用户可能发送 "1" 表示第一题）
-        try:
-            idx = int(qid) - 1
-            if 0 <= idx < len(paper_questions):
-                q = paper_questions[idx]
-                if isinstance(q, dict):
-                    return q
-        except Exception:
-            pass
-        return None
 
-    # 如果没有提供任何 question_ids，但 paper 中有 questions，默认全部批改
-    if not question_ids and paper_questions:
-        for q in paper_questions:
-            if isinstance(q, dict):
-                questions_for_model.append(q)
-    else:
-        for qid in question_ids:
-            qobj = find_question_by_id(qid)
-            if qobj:
-                questions_for_model.append(qobj)
-            else:
-                # 若试卷中未匹配到，尝试 payload 的 question（单题）或 questions（列表）
-                single = payload.get("question")
-                if isinstance(single, dict) and (single.get("id") == qid or single.get("qid") == qid):
-                    questions_for_model.append(single)
-                else:
-                    for q in payload.get("questions", []):
-                        if isinstance(q, dict) and (q.get("id") == qid or q.get("qid") == qid):
-                            questions_for_model.append(q)
-                            break
+@app.get("/api/stats/grade-cache")
+def get_grade_cache_stats():
+    """返回批改结果缓存的命中/未命中/淘汰计数与内存占用。"""
+    return grade_cache.get_stats()
 
-    # 取材料：优先用 payload 中的非空 materials，否则用试卷里的（避免前端传空数组覆盖试卷材料）
-    payload_materials = payload.get("materials")
-    materials = (payload_materials if payload_materials else (paper.get("materials") if paper else [])) or []
-    print(f"[批改] paper_id={paper_id}, paper_loaded={paper is not None}, materials_count={len(materials)}, questions_count={len(questions_for_model)}, answers_keys={list(answers.keys())}")
-    if not materials:
-        print("警告：材料为空，请检查 data 目录是否有对应试卷 JSON 或前端是否传递 materials")
-    # 若材料/题目/答案任一为空，不调用 Gemini，直接返回明确错误（避免模型回复「内容均为空」）
-    if not materials or not questions_for_model or not answers:
-        detail = []
-        if not materials:
-            detail.append("材料为空")
-        if not questions_for_model:
-            detail.append("题目为空")
-        if not answers:
-            detail.append("答案为空")
-        msg = "；".join(detail) + "。请确认：1) 后端 data 目录已部署且含对应试卷 JSON；2) 前端请求带有 paperId 与 answers。"
-        raise HTTPException(status_code=400, detail=msg)
 
-    # 根据题目类型与 materialIds 决定发给 Gemini 的材料：大作文发全卷材料，小题只发对应材料
-    has_essay = any((q.get("type") or "").upper() == "ESSAY" for q in questions_for_model)
-    if has_essay:
-        # 大作文必须发全卷材料：优先用后端试卷文件中的完整 materials，避免前端 payload 漏传或截断
-        paper_materials = (paper.get("materials") if paper else []) or []
-        materials_to_send = list(paper_materials) if paper_materials else list(materials)
-        if not materials_to_send and materials:
-            materials_to_send = list(materials)
-        print(f"[批改] 大作文题，发送材料数: {len(materials_to_send)} (试卷文件: {len(paper_materials)}, payload: {len(materials)})")
-    else:
-        # 小题：只发本题对应的材料。materialIds 从试卷题目 + 前端 payload 两处合并，避免试卷缺字段时误发全卷
-        mid_set = set()
-        for q in questions_for_model:
-            ids = q.get("materialIds") or q.get("material_ids")
-            if ids:
-                mid_set.update(ids if isinstance(ids, list) else [ids])
-        # 兼容前端单题提交：payload 里的 question / questions 也可能带有 materialIds，一并纳入
-        single_q = payload.get("question")
-        if isinstance(single_q, dict):
-            ids = single_q.get("materialIds") or single_q.get("material_ids")
-            if ids:
-                mid_set.update(ids if isinstance(ids, list) else [ids])
-        for q in payload.get("questions") or []:
-            if isinstance(q, dict):
-                ids = q.get("materialIds") or q.get("material_ids")
-                if ids:
-                    mid_set.update(ids if isinstance(ids, list) else [ids])
-        if mid_set:
-            materials_to_send = [m for m in materials if m.get("id") in mid_set]
-            sent_ids = [m.get("id") for m in materials_to_send]
-            print(f"[批改] 小题，按 materialIds 筛选：题目指定 {sorted(mid_set)}，实际发送材料 id={sent_ids}，共 {len(materials_to_send)} 份")
-            if not materials_to_send and materials:
-                print(f"[批改] 警告：题目指定了 materialIds {sorted(mid_set)}，但当前材料列表的 id 为 {[m.get('id') for m in materials]}，无匹配项；将发送 0 份材料，可能影响批改")
-        else:
-            # 未找到任何 materialIds 时才回退为全卷（并打日志便于排查）
-            materials_to_send = list(materials)
-            print(f"[批改] 小题，未找到 materialIds（题目或 payload 均无），回退发送全卷材料共 {len(materials_to_send)} 份；建议在试卷 JSON 或前端传题时补充 materialIds")
+@app.get("/api/stats/startup")
+def get_startup_stats():
+    """返回启动时加载试卷的耗时（index_ms）、挂载 /images 时预压缩图片目录的耗时（images_precompress_ms）
+    与启动快照的使用情况：是否命中、沿用 / 重新加载 / 删除的试卷数、读快照耗时。"""
+    return dict(_startup_stats, papers=paper_store.count(), snapshot=papers_snapshot.get_stats())
 
-    # 后端自统计：按天记录小题/大作文提交量及当日用户 IP（用于每日用户量）
-    try:
-        _record_submit_stat(has_essay, _get_client_ip(request))
-    except Exception as e:
-        print(f"[统计] 写入提交次数失败: {e}")
 
-    # 构造发给模型的简洁上下文（只包含需要的部分）
-    model_input = {
-        "paperId": paper.get("id") if paper else (paper_id or "unknown"),
-        "paperName": paper.get("name") if paper else payload.get("paperName", ""),
-        "region": (paper.get("region") if paper else payload.get("region")) or None,
-        "materials": materials_to_send,
-        "questions": [],
-        "answers": answers,
-    }
+@app.get("/api/stats/papers")
+def get_paper_store_stats():
+    """返回试卷存储的内存预算、常驻试卷数与各形态数量、常驻字节数，以及命中 / 未命中 / 读盘 / 解析 / 前缀生成 / 淘汰计数；
+    precompress 为预压缩的编码、压缩比与按编码的响应次数；conditional 为 /api/paper 的 304 次数与批量校验的请求数、
+    校验 / 有变化 / 已不存在的试卷数；watcher 为目录监视的方式（inotify / poll）、事件数与增量重建次数及耗时。"""
+    with _paper_conditional_lock:
+        conditional = dict(_paper_conditional_stats)
+    return dict(
+        paper_store.get_stats(),
+        precompress=precompress.get_stats(),
+        conditional=conditional,
+        watcher=paper_watcher.get_stats(),
+    )
 
-    for q in questions_for_model:
-        model_input["questions"].append({
-            "id": q.get("id"),
-            "title": q.get("title") or q.get("question") or q.get("text") or q.get("stem"),
-            "requirements": q.get("requirements") or q.get("要求") or "",
-            "maxScore": q.get("maxScore") or q.get("score") or None,
-        })
 
-    # 大作文批改系统提示词（Role + Workflow + Output Constraints）
-    ESSAY_GRADING_INSTRUCTION = """Role: 资深申论阅卷组长 & 文章写作金牌讲师
+# ---------------------------------------------------------
+# 4. 接口：提交 AI 批改 (预留位置)
+# ---------------------------------------------------------
+# 大作文批改系统提示词（Role + Workflow + Output Constraints）
+ESSAY_GRADING_INSTRUCTION = """Role: 资深申论阅卷组长 & 文章写作金牌讲师
 你拥有10年以上的申论大作文阅卷与教学经验。你现在的任务是为考生的大作文提供极其严苛、深度、专业的批改与升格指导。
 
 Workflow (请严格按照以下模块顺序输出)：
@@ -609,8 +590,8 @@ Output Constraints:
 禁忌：严禁AI自己凭空捏造与给定材料毫无关联的论点。所有的论点升华必须建立在给定材料的基础之上。
 """
 
-    # 小题批改系统提示词（Role + Input Data 说明 + Workflow + Output Constraints）
-    SMALL_QUESTION_GRADING_INSTRUCTION = """# Role: 资深申论阅卷组长 & 客观题金牌讲师
+# 小题批改系统提示词（Role + Input Data 说明 + Workflow + Output Constraints）
+SMALL_QUESTION_GRADING_INSTRUCTION = """# Role: 资深申论阅卷组长 & 客观题金牌讲师
 你拥有10年以上的申论阅卷与教学经验。深谙各省公务员考试申论小题（概括题、分析题、提出对策题）"按点给分、见词给分、极度依赖材料原词"的阅卷规则。你的任务是像导师一样手把手教考生如何分析材料，并对考生的答案进行X光级别的优缺点诊断与升格指导。
 
 # Input Data
@@ -687,35 +668,52 @@ Output Constraints:
 - 禁忌：严禁AI在小题中自行发散联想、过度拔高或替换词汇。所有的采分点必须100%忠于<给定材料>的原始表述（去除修饰语后的核心名词/动词）。
 """
 
-    # 每次批改均为独立任务，不复用任何历史对话；在 prompt 首行明确要求仅根据本次请求内容批改
-    grading_session_id = payload.get("gradingSessionId") or ("req-%s" % int(time.time() * 1000))
-    print("[批改] 新对话/独立任务 session=%s" % grading_session_id)
 
-    # 构造 prompt：材料全文发给 Gemini，要求以 Markdown 直接输出（不要求 JSON）
-    prompt_lines = []
-    prompt_lines.append("【重要】本次为全新、独立的批改任务。请仅根据本请求下方提供的「材料」「题目」与「学生答案」进行批改，勿参考、勿引用任何其他对话或历史内容。")
-    if has_essay:
-        prompt_lines.append(ESSAY_GRADING_INSTRUCTION)
-    else:
-        prompt_lines.append(SMALL_QUESTION_GRADING_INSTRUCTION)
-    region = model_input.get("region")
-    province = PROVINCE_GRADING_PROFILE.get(region) or PROVINCE_GRADING_PROFILE["_default"]
+# 预拼前缀的拼接逻辑版本：修改 _question_for_prompt / _prompt_head / _build_prompt_prefix / _build_paper_prompt_prefixes
+# 的输出时加 1，使启动快照中的前缀作废（批改说明与地区评分特征的文字改动会自动生效，见 _prompt_prefix_fingerprint）
+PROMPT_PREFIX_VERSION = 1
+
+
+def _question_for_prompt(q: Dict[str, Any]) -> Dict[str, Any]:
+    """题目发给模型的精简字段。"""
+    return {
+        "id": q.get("id"),
+        "title": q.get("title") or q.get("question") or q.get("text") or q.get("stem"),
+        "requirements": q.get("requirements") or q.get("要求") or "",
+        "maxScore": q.get("maxScore") or q.get("score") or None,
+    }
+
+
+def _region_profile_text(region: Optional[str]) -> str:
+    """prompt 中的地区评分特征段（地区未知时为通用评分参考）。"""
     if region:
-        prompt_lines.append(
+        province = PROVINCE_GRADING_PROFILE.get(region) or PROVINCE_GRADING_PROFILE["_default"]
+        return (
             f"【地区评分特征】本套试卷来自：{province['label']}（{region}）。\n"
             f"- 小题评分特征：{province['small_q']}\n"
             f"- 大作文评分特征：{province['essay']}\n"
             f"- 真实得分分布参考：{province['score_dist']}\n"
             f"请严格按照上述已知特征评分，不得套用其他省份标准。"
         )
+    d = PROVINCE_GRADING_PROFILE["_default"]
+    return (
+        f"【评分参考】地区未知，按通用标准评分。\n"
+        f"- 小题：{d['small_q']}\n"
+        f"- 大作文：{d['essay']}\n"
+        f"- 分数分布参考：{d['score_dist']}"
+    )
+
+
+@lru_cache(maxsize=None)
+def _prompt_head(has_essay: bool, region: Optional[str]) -> str:
+    """prompt 开头的固定部分（批改说明 + 地区评分特征 + 输出格式要求），按（题型, 地区）只拼一次、所有题目共享。"""
+    prompt_lines = []
+    prompt_lines.append("【重要】本次为全新、独立的批改任务。请仅根据本请求下方提供的「材料」「题目」与「学生答案」进行批改，勿参考、勿引用任何其他对话或历史内容。")
+    if has_essay:
+        prompt_lines.append(ESSAY_GRADING_INSTRUCTION)
     else:
-        d = PROVINCE_GRADING_PROFILE["_default"]
-        prompt_lines.append(
-            f"【评分参考】地区未知，按通用标准评分。\n"
-            f"- 小题：{d['small_q']}\n"
-            f"- 大作文：{d['essay']}\n"
-            f"- 分数分布参考：{d['score_dist']}"
-        )
+        prompt_lines.append(SMALL_QUESTION_GRADING_INSTRUCTION)
+    prompt_lines.append(_region_profile_text(region))
     prompt_lines.append(
         "请用 Markdown 格式直接输出你的分析报告（可使用标题、加粗、列表、分段等），不要输出 JSON。"
         "加粗请使用成对的 **文字**，确保每行内 ** 成对闭合，避免漏写导致前端渲染不全。"
@@ -726,45 +724,573 @@ Output Constraints:
     )
     prompt_lines.append("排版：若使用引用块「>」，每个「>」必须位于单独一行的行首（行首可有空格）；粗体「**…**」结束后若要接引用，请先换行再写「>」；多段引用请多行书写，勿在同一行内用空格加「>」串联多段。")
     prompt_lines.append("材料（materials）如下（含完整正文，请依据材料原文评分、给出参考答案与扣分点）：")
-    prompt_lines.append(json.dumps(materials_to_send, ensure_ascii=False))
-    prompt_lines.append("\n题目（questions）如下（每题包含 id、title、requirements、maxScore）：")
-    prompt_lines.append(json.dumps(model_input["questions"], ensure_ascii=False))
+    return "\n".join(prompt_lines)
+
+
+def _build_prompt_prefix(
+    has_essay: bool,
+    region: Optional[str],
+    materials_to_send: List[Dict[str, Any]],
+    questions_for_prompt: List[Dict[str, Any]],
+    variant: str = prompt_format.JSON,
+) -> Dict[str, Any]:
+    """拼接 prompt 中与学生答案无关的部分：head 为共享的说明与地区特征，body 为材料与题目（按 variant 编码，见 prompt_format.py）。
+
+    完整前缀为 head + "\n" + body；同时返回材料/题目编码文本的 sha256（供批改结果缓存键使用）。
+    """
+    encoded = prompt_format.encode(variant, materials_to_send, questions_for_prompt)
+    body = "\n".join([encoded["materials"], encoded["questionsHeader"], encoded["questions"]])
+    return {
+        "head": _prompt_head(has_essay, region),
+        "body": body,
+        "variant": variant,
+        "materialsEnd": len(encoded["materials"]),
+        "materialsDigest": hashlib.sha256(encoded["materials"].encode("utf-8")).hexdigest(),
+        "questionsDigest": hashlib.sha256(encoded["questions"].encode("utf-8")).hexdigest(),
+    }
+
+
+def _build_paper_prompt_prefixes(paper: Dict[str, Any]) -> Dict[tuple, Dict[str, Any]]:
+    """为一份试卷的每道题预先拼好 prompt 前缀（按单题提交、使用试卷自带材料的情形，与 _prepare_grading 的材料筛选一致）。"""
+    pid = paper.get("id")
+    materials = paper.get("materials") or []
+    prefixes: Dict[tuple, Dict[str, Any]] = {}
+    for q in paper.get("questions") or []:
+        if not isinstance(q, dict) or q.get("id") is None:
+            continue
+        has_essay = (q.get("type") or "").upper() == "ESSAY"
+        if has_essay:
+            materials_to_send = list(materials)
+        else:
+            ids = q.get("materialIds") or q.get("material_ids")
+            mid_set = set(ids if isinstance(ids, list) else [ids]) if ids else set()
+            materials_to_send = [m for m in materials if m.get("id") in mid_set] if mid_set else list(materials)
+        variant = prompt_format.variant(f"{pid}/{q.get('id')}")
+        prefix = _build_prompt_prefix(has_essay, paper.get("region") or None, materials_to_send, [_question_for_prompt(q)], variant)
+        prefix["hasEssay"] = has_essay
+        prefix["materialIds"] = [m.get("id") for m in materials_to_send]
+        prefix["contextId"] = hashlib.sha256(
+            (prefix["head"] + prefix["materialsDigest"] + prefix["questionsDigest"]).encode("utf-8")
+        ).hexdigest()
+        prefixes[(pid, str(q.get("id")))] = prefix
+    return prefixes
+
+
+def _build_prompt_suffix(answers: Dict[str, Any], answer_images: List[Any], has_essay: bool) -> str:
+    """prompt 中接在前缀（说明、材料、题目）之后的学生答案部分。"""
+    lines = []
     if answer_images:
-        prompt_lines.append("\n学生答案以图片形式提供，下方有多张图片，请将全部图片均视为同一道题的作答内容，按顺序识别并综合批改。若同时有文字答案则见下方。")
+        lines.append("\n学生答案以图片形式提供，下方有多张图片，请将全部图片均视为同一道题的作答内容，按顺序识别并综合批改。若同时有文字答案则见下方。")
         if has_essay:
-            prompt_lines.append("【大作文字数说明】大作文不识别、不判定字数，一律视为字数符合规定，不因字数扣分。")
+            lines.append("【大作文字数说明】大作文不识别、不判定字数，一律视为字数符合规定，不因字数扣分。")
         else:
-            prompt_lines.append("【图片字数判定规则】每行固定为 25 字，总字数=行数*25。若题目有字数要求，而据此估算的总字数与要求相差超过 20%（过多或过少），则视为字数合适、不扣字数分。")
+            lines.append("【图片字数判定规则】每行固定为 25 字，总字数=行数*25。若题目有字数要求，而据此估算的总字数与要求相差超过 20%（过多或过少），则视为字数合适、不扣字数分。")
         if answers and not (list(answers.values())[0] or "").strip().startswith("（考生上传了作答图片"):
-            prompt_lines.append("学生答案（文字补充）：")
-            prompt_lines.append(json.dumps(answers, ensure_ascii=False))
+            lines.append("学生答案（文字补充）：")
+            lines.append(json.dumps(answers, ensure_ascii=False))
     else:
-        prompt_lines.append("\n学生答案（answers，键为题目id）：")
-        prompt_lines.append(json.dumps(answers, ensure_ascii=False))
-    prompt_lines.append("\n请按上述要求，直接输出完整的 Markdown 分析报告。")
-    prompt = "\n".join(prompt_lines)
+        lines.append("\n学生答案（answers，键为题目id）：")
+        lines.append(json.dumps(answers, ensure_ascii=False))
+    lines.append("\n请按上述要求，直接输出完整的 Markdown 分析报告。")
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=None)
+def _prompt_head_tokens(has_essay: bool, region: Optional[str]) -> Tuple[int, int]:
+    """prompt 开头部分的 token 估算：(批改说明与输出要求, 地区评分特征)。"""
+    region_tokens = prompt_budget.estimate_tokens(_region_profile_text(region))
+    return (prompt_budget.estimate_tokens(_prompt_head(has_essay, region)) - region_tokens, region_tokens)
+
+
+def _prompt_token_sections(
+    has_essay: bool,
+    region: Optional[str],
+    prefix: Dict[str, Any],
+    suffix: str,
+    image_count: int,
+) -> Dict[str, int]:
+    """按段估算 prompt 的输入 token（段名见 prompt_budget.SECTIONS）；材料与题目的估算记在 prefix 上，预拼前缀只算一次。"""
+    instructions, region_tokens = _prompt_head_tokens(has_essay, region)
+    counts = prefix.get("tokens")
+    if counts is None:
+        materials = prompt_budget.estimate_tokens(prefix["body"][:prefix["materialsEnd"]])
+        counts = prefix["tokens"] = (materials, prompt_budget.estimate_tokens(prefix["body"]) - materials)
+    return {
+        "instructions": instructions,
+        "region": region_tokens,
+        "materials": counts[0],
+        "questions": counts[1],
+        "answers": prompt_budget.estimate_tokens(suffix) + prompt_budget.IMAGE_TOKENS * image_count,
+    }
 
-    # 小题 temperature=0.15 / top_p=0.85，大作文 temperature=0.3 / top_p=0.90
+
+# 批改结果缓存键的版本号：修改批改提示词或结果结构后递增，使旧缓存全部失效
+_GRADE_CACHE_VERSION = "1"
+
+
+def _normalize_answer_text(text: Any) -> str:
+    """答案归一化：全角/半角统一（NFKC）并去掉所有空白，使仅有空格、换行或标点宽度差异的答案命中同一缓存。"""
+    s = unicodedata.normalize("NFKC", str(text or ""))
+    return "".join(s.split())
+
+
+def _grading_cache_key(
+    model_input: Dict[str, Any],
+    answers: Dict[str, Any],
+    answer_images: List[Any],
+    materials_digest: str,
+    questions_digest: str,
+    temperature: float,
+    top_p: float,
+) -> str:
+    """批改结果缓存键：试卷、题目、地区、归一化答案、图片摘要、材料/题目内容摘要与生成参数的 sha256。"""
+    image_digests = []
+    for image in answer_images:
+        if isinstance(image, answer_uploads.UploadedImage):
+            image_digests.append(image.digest)
+            continue
+        _, b64 = _parse_data_url(image)
+        image_digests.append(hashlib.sha256((b64 or "").encode("utf-8")).hexdigest())
+    fingerprint = {
+        "v": _GRADE_CACHE_VERSION,
+        "paperId": model_input.get("paperId"),
+        "questionIds": [str(q.get("id")) for q in model_input.get("questions") or []],
+        "region": model_input.get("region"),
+        "answers": {str(k): _normalize_answer_text(v) for k, v in sorted(answers.items(), key=lambda kv: str(kv[0]))},
+        "images": image_digests,
+        "materials": materials_digest,
+        "questions": questions_digest,
+        "generation": {"temperature": temperature, "topP": top_p},
+    }
+    raw = json.dumps(fingerprint, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _prepare_grading(payload: dict) -> Dict[str, Any]:
+    """解析批改请求：加载试卷、匹配题目、筛选材料并拼好 prompt。参数不完整时抛出 400。
+
+    返回的上下文供 _run_grading 调用模型使用（同步函数，含磁盘读取与 prompt 拼接，应在线程池中执行）。
+    """
+    # 支持传入 paperId 来从 data 中读取试卷（优先从文件加载，兼容 Render 部署）
+    paper = None
+    paper_id = payload.get("paperId") or payload.get("id")
+    if paper_id:
+        paper = _load_paper_by_id(paper_id)
+    elif payload.get("user_answer") and not payload.get("answers") and not payload.get("question_id"):
+        raise HTTPException(
+            status_code=400,
+            detail="请求缺少 paperId 和 question_id，无法加载试卷。请重新部署前端（Vercel 等）并刷新页面后再试；前端需传 paperId、question_id、user_answer 或直接传 answers。",
+        )
+
+    # 如果前端直接提供了 questions 或 materials，就使用前端的覆盖
+    if not paper:
+        if payload.get("questions") or payload.get("materials"):
+            paper = {
+                "id": paper_id or "inline",
+                "name": payload.get("paperName", "inline paper"),
+                "materials": payload.get("materials", []),
+                "questions": payload.get("questions", []),
+            }
+
+    # 收集 answers（前端可以只传 question id -> answer 的映射）
+    answers = payload.get("answers") or {}
+    # 兼容单题提交格式（老格式）
+    if not answers and payload.get("question_id") and payload.get("user_answer"):
+        answers = { payload.get("question_id"): payload.get("user_answer") }
+    # 拍照上传：仅有 answer_images 时也视为有答案，用占位文字满足后续校验
+    # （JSON 提交时为 data URL 字符串，multipart 上传时为 answer_uploads.UploadedImage）
+    answer_images: List[Any] = payload.get("answer_images") or []
+    has_images_flag = bool(payload.get("has_images"))
+    img_sizes = [answer_uploads.describe(img) for img in answer_images] if answer_images else []
+    print(f"[批改] has_images_flag={has_images_flag}, answer_images_count={len(answer_images)}, img_sizes_chars={img_sizes}")
+    if has_images_flag and not answer_images:
+        raise HTTPException(
+            status_code=400,
+            detail="前端标记有图片但未收到图片数据，请稍等图片加载完成（约 1～2 秒）后再点击提交。",
+        )
+    if answer_images and not answers and payload.get("question_id"):
+        answers = { payload.get("question_id"): "（考生上传了作答图片，请根据图片内容批改）" }
+    # 或者前端可能发送 question_id(s) 列表（无答案）
+    question_ids: List[str] = []
+    if answers:
+        question_ids = list(answers.keys())
+    elif payload.get("question_id"):
+        question_ids = [payload.get("question_id")]
+    elif payload.get("question_ids"):
+        question_ids = payload.get("question_ids")
+
+    # 从 paper 中解析出要发给模型的题目信息（根据 id 匹配）
+    questions_for_model: List[Dict[str, Any]] = []
+    paper_questions = (paper.get("questions") if paper else []) or []
+
+    def find_question_by_id(qid: str) -> Optional[Dict[str, Any]]:
+        for q in paper_questions:
+            if not isinstance(q, dict):
+                continue
+            # 常见的 id 字段名就尝试匹配
+            if q.get("id") == qid or q.get("qid") == qid or str(q.get("id")) == str(qid):
+                return q
+        # 也尝试按索引匹配（用户可能发送 "1" 表示第一题）
+        try:
+            idx = int(qid) - 1
+            if 0 <= idx < len(paper_questions):
+                q = paper_questions[idx]
+                if isinstance(q, dict):
+                    return q
+        except Exception:
+            pass
+        return None
+
+    # 如果没有提供任何 question_ids，但 paper 中有 questions，默认全部批改
+    if not question_ids and paper_questions:
+        for q in paper_questions:
+            if isinstance(q, dict):
+                questions_for_model.append(q)
+    else:
+        for qid in question_ids:
+            qobj = find_question_by_id(qid)
+            if qobj:
+                questions_for_model.append(qobj)
+            else:
+                # 若试卷中未匹配到，尝试 payload 的 question（单题）或 questions（列表）
+                single = payload.get("question")
+                if isinstance(single, dict) and (single.get("id") == qid or single.get("qid") == qid):
+                    questions_for_model.append(single)
+                else:
+                    for q in payload.get("questions", []):
+                        if isinstance(q, dict) and (q.get("id") == qid or q.get("qid") == qid):
+                            questions_for_model.append(q)
+                            break
+
+    # 取材料：优先用 payload 中的非空 materials，否则用试卷里的（避免前端传空数组覆盖试卷材料）
+    payload_materials = payload.get("materials")
+    materials = (payload_materials if payload_materials else (paper.get("materials") if paper else [])) or []
+    print(f"[批改] paper_id={paper_id}, paper_loaded={paper is not None}, materials_count={len(materials)}, questions_count={len(questions_for_model)}, answers_keys={list(answers.keys())}")
+    if not materials:
+        print("警告：材料为空，请检查 data 目录是否有对应试卷 JSON 或前端是否传递 materials")
+    # 若材料/题目/答案任一为空，不调用 Gemini，直接返回明确错误（避免模型回复「内容均为空」）
+    if not materials or not questions_for_model or not answers:
+        detail = []
+        if not materials:
+            detail.append("材料为空")
+        if not questions_for_model:
+            detail.append("题目为空")
+        if not answers:
+            detail.append("答案为空")
+        msg = "；".join(detail) + "。请确认：1) 后端 data 目录已部署且含对应试卷 JSON；2) 前端请求带有 paperId 与 answers。"
+        raise HTTPException(status_code=400, detail=msg)
+
+    # 根据题目类型与 materialIds 决定发给 Gemini 的材料：大作文发全卷材料，小题只发对应材料
+    has_essay = any((q.get("type") or "").upper() == "ESSAY" for q in questions_for_model)
+    if has_essay:
+        # 大作文必须发全卷材料：优先用后端试卷文件中的完整 materials，避免前端 payload 漏传或截断
+        paper_materials = (paper.get("materials") if paper else []) or []
+        materials_to_send = list(paper_materials) if paper_materials else list(materials)
+        if not materials_to_send and materials:
+            materials_to_send = list(materials)
+        print(f"[批改] 大作文题，发送材料数: {len(materials_to_send)} (试卷文件: {len(paper_materials)}, payload: {len(materials)})")
+    else:
+        # 小题：只发本题对应的材料。materialIds 从试卷题目 + 前端 payload 两处合并，避免试卷缺字段时误发全卷
+        mid_set = set()
+        for q in questions_for_model:
+            ids = q.get("materialIds") or q.get("material_ids")
+            if ids:
+                mid_set.update(ids if isinstance(ids, list) else [ids])
+        # 兼容前端单题提交：payload 里的 question / questions 也可能带有 materialIds，一并纳入
+        single_q = payload.get("question")
+        if isinstance(single_q, dict):
+            ids = single_q.get("materialIds") or single_q.get("material_ids")
+            if ids:
+                mid_set.update(ids if isinstance(ids, list) else [ids])
+        for q in payload.get("questions") or []:
+            if isinstance(q, dict):
+                ids = q.get("materialIds") or q.get("material_ids")
+                if ids:
+                    mid_set.update(ids if isinstance(ids, list) else [ids])
+        if mid_set:
+            materials_to_send = [m for m in materials if m.get("id") in mid_set]
+            sent_ids = [m.get("id") for m in materials_to_send]
+            print(f"[批改] 小题，按 materialIds 筛选：题目指定 {sorted(mid_set)}，实际发送材料 id={sent_ids}，共 {len(materials_to_send)} 份")
+            if not materials_to_send and materials:
+                print(f"[批改] 警告：题目指定了 materialIds {sorted(mid_set)}，但当前材料列表的 id 为 {[m.get('id') for m in materials]}，无匹配项；将发送 0 份材料，可能影响批改")
+        else:
+            # 未找到任何 materialIds 时才回退为全卷（并打日志便于排查）
+            materials_to_send = list(materials)
+            print(f"[批改] 小题，未找到 materialIds（题目或 payload 均无），回退发送全卷材料共 {len(materials_to_send)} 份；建议在试卷 JSON 或前端传题时补充 materialIds")
+
+    # 构造发给模型的简洁上下文（只包含需要的部分）
+    model_input = {
+        "paperId": paper.get("id") if paper else (paper_id or "unknown"),
+        "paperName": paper.get("name") if paper else payload.get("paperName", ""),
+        "region": (paper.get("region") if paper else payload.get("region")) or None,
+        "materials": materials_to_send,
+        "questions": [],
+        "answers": answers,
+    }
+
+    for q in questions_for_model:
+        model_input["questions"].append(_question_for_prompt(q))
+
+    # 每次批改均为独立任务，不复用任何历史对话；在 prompt 首行明确要求仅根据本次请求内容批改
+    grading_session_id = payload.get("gradingSessionId") or ("req-%s" % int(time.time() * 1000))
+    print("[批改] 新对话/独立任务 session=%s" % grading_session_id)
+
+    # 构造 prompt：材料全文发给 Gemini，要求以 Markdown 直接输出（不要求 JSON）
+    # 与答案无关的前缀（说明 + 地区特征 + 材料 + 题目）对试卷自带的单题提交在加载试卷时已预先拼好
+    prefix = None
+    variant = prompt_format.variant(f"{model_input['paperId']}/{','.join(str(q.get('id')) for q in questions_for_model)}")
+    if paper is not None and paper_store.is_current(paper) and not payload_materials and len(questions_for_model) == 1:
+        cached_prefix = paper_store.get_prefix(paper.get("id"), str(questions_for_model[0].get("id")))
+        if (
+            cached_prefix
+            and cached_prefix["variant"] == variant
+            and cached_prefix["hasEssay"] == has_essay
+            and cached_prefix["materialIds"] == [m.get("id") for m in materials_to_send]
+        ):
+            prefix = cached_prefix
+    region = model_input.get("region")
+    if prefix is None:
+        prefix = _build_prompt_prefix(has_essay, region, materials_to_send, model_input["questions"], variant)
+    suffix = _build_prompt_suffix(answers, answer_images, has_essay)
+
+    # 按段估算输入 token；设置了 PROMPT_TOKEN_BUDGET 且超出时，删去与题目关联最弱的材料段落后重拼前缀
+    sections = _prompt_token_sections(has_essay, region, prefix, suffix, len(answer_images))
+    trimmed = None
+    budget = prompt_budget.budget()
+    if budget and sum(sections.values()) > budget:
+        query = "\n".join(f"{q.get('title') or ''}\n{q.get('requirements') or ''}" for q in model_input["questions"])
+        trimmed_materials, trimmed = prompt_budget.trim_materials(materials_to_send, query, sum(sections.values()) - budget)
+        if trimmed["paragraphs"]:
+            before = sum(sections.values())
+            materials_to_send = model_input["materials"] = trimmed_materials
+            prefix = _build_prompt_prefix(has_essay, region, materials_to_send, model_input["questions"], variant)
+            sections = _prompt_token_sections(has_essay, region, prefix, suffix, len(answer_images))
+            print(f"[Token] 超出预算 {budget}：删去 {trimmed['paragraphs']} 段材料，{before} → {sum(sections.values())}")
+    prompt_budget.record(sections, trimmed, variant)
+    print(f"[Token] session={grading_session_id} 估算输入 {sum(sections.values())} tokens（{variant}）: {sections}")
+    prompt = prefix["head"] + "\n" + prefix["body"] + "\n" + suffix
+    # 预拼前缀可在 Gemini 侧建上下文缓存，之后只上传前缀之后的答案部分
+    context_cache = None
+    if prefix.get("contextId"):
+        prefix_text = prefix["head"] + "\n" + prefix["body"]
+        context_cache = {
+            "id": prefix["contextId"],
+            "prefix": prefix_text,
+            "suffix": prompt[len(prefix_text) + 1:],
+            "label": f"{paper.get('id')}/{questions_for_model[0].get('id')}",
+        }
+
+    # 小题 temperature=0.15 / top_p=0.85，大作文 temperature=0.3 / top_p=0.90
     temperature = 0.15 if not has_essay else 0.3
     top_p = 0.85 if not has_essay else 0.90
-    # 有图片时走多模态接口，否则仅文本；Gemini 失败时先尝试钱多多多模态兜底
+    return {
+        "model_input": model_input,
+        "answers": answers,
+        "answer_images": answer_images,
+        "has_essay": has_essay,
+        "prompt": prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+        "grading_session_id": grading_session_id,
+        "context_cache": context_cache,
+        "prompt_tokens": sections,
+        "prompt_format": variant,
+        "cache_key": _grading_cache_key(
+            model_input, answers, answer_images, prefix["materialsDigest"], prefix["questionsDigest"], temperature, top_p
+        ),
+    }
+
+
+_IMAGE_GRADING_UNAVAILABLE = "图片批改服务暂时不可用。请稍后重试，或减少图片数量、改用文字作答后再提交。"
+_GRADING_TIMEOUT_DETAIL = "批改超时：模型响应过慢，未能在时限内完成。请稍后重试。"
+
+# ---------------------------------------------------------
+# 批改时限：/api/grade 与 /api/grade/stream 整体的截止时间（请求头 X-Grade-Timeout 或 payload.timeoutSeconds，缺省 GRADE_DEADLINE_SECONDS），
+# 每次上游调用与重试都只使用剩余时间；剩余时间不够一次调用时直接跳过，到时返回 504
+# ---------------------------------------------------------
+_GRADE_DEADLINE_SECONDS = float(os.getenv("GRADE_DEADLINE_SECONDS") or 120)
+_GRADE_MAX_DEADLINE_SECONDS = float(os.getenv("GRADE_MAX_DEADLINE_SECONDS") or 300)
+_GRADE_MIN_ATTEMPT_SECONDS = float(os.getenv("GRADE_MIN_ATTEMPT_SECONDS") or 5)
+# 当前批改的截止时间（time.monotonic()）；None 表示不限（异步任务）。asyncio 任务创建时会继承该值
+_grading_deadline: contextvars.ContextVar = contextvars.ContextVar("grading_deadline", default=None)
+_deadline_stats = {"timeouts": 0, "skipped_attempts": 0}
+
+
+class _DeadlineExceeded(Exception):
+    """剩余时间不够发起一次上游调用。"""
+
+
+def _grading_deadline_from_request(request: Request, payload: dict) -> float:
+    """客户端可通过请求头 X-Grade-Timeout 或 payload.timeoutSeconds 声明愿意等待的秒数（限制在 [GRADE_MIN_ATTEMPT_SECONDS, GRADE_MAX_DEADLINE_SECONDS]）。"""
+    budget = _GRADE_DEADLINE_SECONDS
+    raw = request.headers.get("x-grade-timeout") or payload.get("timeoutSeconds")
+    if raw:
+        try:
+            budget = float(raw)
+        except (TypeError, ValueError):
+            pass
+    budget = min(_GRADE_MAX_DEADLINE_SECONDS, max(_GRADE_MIN_ATTEMPT_SECONDS, budget))
+    return time.monotonic() + budget
+
+
+def _remaining_budget() -> Optional[float]:
+    deadline = _grading_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _upstream_timeout(default: float) -> float:
+    """本次上游调用可用的超时：不超过剩余时间；剩余时间不足 GRADE_MIN_ATTEMPT_SECONDS 时抛出 _DeadlineExceeded。"""
+    remaining = _remaining_budget()
+    if remaining is None:
+        return default
+    if remaining < _GRADE_MIN_ATTEMPT_SECONDS:
+        _deadline_stats["skipped_attempts"] += 1
+        raise _DeadlineExceeded(f"剩余 {max(0.0, remaining):.1f}s，不足以发起上游调用")
+    return min(default, remaining)
+
+
+def _deadline_exceeded() -> bool:
+    remaining = _remaining_budget()
+    return remaining is not None and remaining < _GRADE_MIN_ATTEMPT_SECONDS
+
+
+def _too_late_for(name: str) -> bool:
+    """剩余时间不够上游 name 通常耗时的一次调用时返回 True（计入跳过次数）；不限时返回 False。"""
+    remaining = _remaining_budget()
+    if remaining is not None and remaining < max(_GRADE_MIN_ATTEMPT_SECONDS, grade_hedging.typical_latency(name)):
+        _deadline_stats["skipped_attempts"] += 1
+        print(f"[批改] 剩余 {max(0.0, remaining):.1f}s，来不及调用 {name}，跳过")
+        return True
+    return False
+
+
+def _order_providers_by_health(providers: List[tuple]) -> List[tuple]:
+    """providers 为 [(名称, 熔断器名, ...), ...]，按熔断器的实时健康度排序（健康度相同时保持给定顺序）。"""
+    ranked = circuit_breaker.order([p[1] for p in providers])
+    return sorted(providers, key=lambda p: ranked.index(p[1]))
+
+
+async def _first_successful_provider(providers: List[tuple]) -> Optional[str]:
+    """providers 为 [(名称, 熔断器名, 无参协程函数), ...]，按健康度排序后依次调用，返回第一个非空结果；全部失败返回 None。
+
+    开启对冲（GRADE_HEDGE=1）时，主上游超过其历史耗时分位数仍未返回，就并行调用下一个上游，
+    先成功者返回，另一个取消（见 grade_hedging.py）；对冲次数受占比上限约束，超出时退回串行兜底。
+    """
+    grade_hedging.note_request()
+    queue = [(name, call) for name, _, call in _order_providers_by_health(providers)]
+    pending: Dict[asyncio.Task, str] = {}
+    started: Dict[asyncio.Task, float] = {}
+    hedge_checked = False
+    hedged = False
+
+    def launch() -> bool:
+        """启动队首上游；剩余时间不够该上游通常耗时的调用直接跳过。全部跳过时返回 False。"""
+        while queue:
+            name, call = queue.pop(0)
+            if _too_late_for(name):
+                continue
+            task = asyncio.create_task(call())
+            pending[task] = name
+            started[task] = time.monotonic()
+            return True
+        return False
+
+    launch()
+    try:
+        while pending:
+            timeout = None
+            if queue and not hedge_checked and grade_hedging.enabled():
+                primary = next(iter(pending))
+                timeout = max(0.0, started[primary] + grade_hedging.hedge_delay(pending[primary]) - time.monotonic())
+            # 上游调用自身的超时不超过剩余时间，这里多留 1 秒让它们先按超时返回，仅作兜底
+            remaining = _remaining_budget()
+            if remaining is not None:
+                if remaining <= -1.0:
+                    print("[批改] 已到截止时间，放弃仍在进行的上游调用")
+                    return None
+                timeout = remaining + 1.0 if timeout is None else min(timeout, remaining + 1.0)
+            done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if remaining is not None and timeout == remaining + 1.0:
+                    continue
+                hedge_checked = True
+                if grade_hedging.try_acquire_hedge():
+                    hedged = True
+                    print(f"[批改] {pending[next(iter(pending))]} {timeout:.1f}s 内未返回，并行请求 {queue[0][0]}（对冲）")
+                    launch()
+                else:
+                    print("[批改] 对冲次数已达上限，继续等待主上游")
+                continue
+            for task in done:
+                name = pending.pop(task)
+                try:
+                    raw = task.result()
+                except Exception as e:
+                    print(f"[批改] {name} 调用异常: {e}")
+                    raw = None
+                if raw:
+                    grade_hedging.record_latency(name, time.monotonic() - started[task])
+                    if hedged:
+                        grade_hedging.note_win(name)
+                    return raw
+                print(f"[批改] {name} 无结果" + ("，尝试下一个上游..." if queue and not pending else ""))
+            if not pending and queue:
+                hedge_checked = True
+                launch()
+        return None
+    except asyncio.CancelledError:
+        # 调用方已放弃（客户端断开）：记录取消时各上游已耗时间，以及按通常耗时估算省下的时间
+        now = time.monotonic()
+        for task, name in pending.items():
+            elapsed = now - started[task]
+            _disconnect_stats["cancelled_upstream_calls"] += 1
+            _disconnect_stats["upstream_seconds_elapsed"] += elapsed
+            _disconnect_stats["upstream_seconds_reclaimed"] += max(0.0, grade_hedging.typical_latency(name) - elapsed)
+        raise
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _call_grading_providers(ctx: Dict[str, Any]) -> Optional[str]:
+    """调用 Gemini / 钱多多（默认 Gemini 优先，按熔断器健康度调整顺序），返回 Markdown 原文；图片批改全部失败时抛出 503。"""
+    _grading_deadline.set(ctx.get("deadline"))
+    prompt = ctx["prompt"]
+    answer_images = ctx["answer_images"]
+    kwargs = {"temperature": ctx["temperature"], "top_p": ctx["top_p"]}
+    context_cache = ctx.get("context_cache")
+    # 有图片时走多模态接口，否则仅文本；Gemini 失败时尝试钱多多（OpenAI 兼容格式支持图片）兜底
     if answer_images:
-        gemini_raw = call_gemini_system_with_images(prompt, answer_images, temperature=temperature, top_p=top_p)
+        gemini_raw = await _first_successful_provider([
+            ("Gemini 多模态", "gemini", lambda: call_gemini_system_with_images(prompt, answer_images, context_cache=context_cache, **kwargs)),
+            ("钱多多多模态", "qianduoduo", lambda: call_qianduoduo_gemini_with_images(prompt, answer_images, **kwargs)),
+        ])
         if not gemini_raw:
-            # 兜底：尝试钱多多多模态（OpenAI 兼容格式支持图片）
-            print("[批改] Gemini 多模态失败，尝试钱多多多模态兜底...")
-            gemini_raw = call_qianduoduo_gemini_with_images(prompt, answer_images, temperature=temperature, top_p=top_p)
-            if not gemini_raw:
-                print("[批改] 钱多多多模态也失败，返回 503")
-                raise HTTPException(
-                    status_code=503,
-                    detail="图片批改服务暂时不可用。请稍后重试，或减少图片数量、改用文字作答后再提交。",
-                )
+            if _deadline_exceeded():
+                _raise_grading_timeout()
+            print("[批改] 多模态上游均失败，返回 503")
+            raise HTTPException(status_code=503, detail=_IMAGE_GRADING_UNAVAILABLE)
     else:
-        gemini_raw = call_gemini_system(prompt, temperature=temperature, top_p=top_p)
-        if not gemini_raw:
-            print("[批改] Google Gemini 无结果，尝试钱多多平台...")
-            gemini_raw = call_qianduoduo_gemini(prompt, temperature=temperature, top_p=top_p)
+        gemini_raw = await _first_successful_provider([
+            ("Gemini", "gemini", lambda: call_gemini_system(prompt, context_cache=context_cache, **kwargs)),
+            ("钱多多", "qianduoduo", lambda: call_qianduoduo_gemini(prompt, **kwargs)),
+        ])
+        # 时限内没拿到结果：返回 504，而不是模拟评分
+        if not gemini_raw and _deadline_exceeded():
+            _raise_grading_timeout()
+    return gemini_raw
+
+
+def _raise_grading_timeout():
+    _deadline_stats["timeouts"] += 1
+    print("[批改] 超过截止时间仍无结果，返回 504")
+    raise HTTPException(status_code=504, detail=_GRADING_TIMEOUT_DETAIL)
+
+
+def _build_grading_result(ctx: Dict[str, Any], gemini_raw: Optional[str]) -> dict:
+    """把模型输出整理成前端使用的结构；模型不可用时返回模拟评分。"""
+    model_input = ctx["model_input"]
+    answers = ctx["answers"]
     if gemini_raw:
         body = gemini_raw.strip()
         # Render 日志：输出 AI 批改结果（便于排查与审计）
@@ -796,123 +1322,817 @@ Output Constraints:
             "modelAnswer": "",
         }
 
-    # 如果没有可用的 Gemini，则走模拟逻辑：根据 answers 生成每题评分
-    # 简单模拟：每题默认分值 100/题数，若有 maxScore 则按 maxScore 分配
-    per_question = {}
-    total_max = 0
-    for q in model_input["questions"]:
-        m = q.get("maxScore")
-        if m:
-            total_max += m
+    # 如果没有可用的 Gemini，则走模拟逻辑：根据 answers 生成每题评分
+    # 简单模拟：每题默认分值 100/题数，若有 maxScore 则按 maxScore 分配
+    per_question = {}
+    total_max = 0
+    for q in model_input["questions"]:
+        m = q.get("maxScore")
+        if m:
+            total_max += m
+        else:
+            total_max += 100
+
+    # 若没有题目信息（paper.questions 为空），则根据 answers 的键生成占位项
+    if not model_input["questions"] and answers:
+        for idx, qid in enumerate(answers.keys(), start=1):
+            per_question[qid] = {
+                "score": 80,
+                "maxScore": 100,
+                "deductions": [{"point": "内容不够具体", "deduct": 20}],
+                "referenceAnswer": "（该试卷未提供题目文本，按学生答案生成的模拟参考）",
+            }
+        return {
+            "score": sum(item["score"] for item in per_question.values()),
+            "maxScore": len(per_question) * 100,
+            "overallEvaluation": "【后端模拟评分】试卷无题目正文，已根据提交的 answers 生成模拟分项。",
+            "perQuestion": per_question,
+            "detailedComments": [],
+        }
+
+    # 普通模拟：按题目逐项生成占位点评
+    for q in model_input["questions"]:
+        qid = q.get("id") or str(len(per_question) + 1)
+        maxs = q.get("maxScore") or 100
+        ans = answers.get(qid, "")
+        # 简单启发：如果有答案长度 > 50 视为得分较高
+        score = int(maxs * (0.8 if len(str(ans)) > 50 else 0.6))
+        per_question[qid] = {
+            "score": score,
+            "maxScore": maxs,
+            "deductions": [{"point": "论证不够丰满", "deduct": max(1, int(maxs * 0.2))}],
+            "referenceAnswer": f"（模拟参考答案，基于题目 {q.get('title')}）",
+        }
+
+    return {
+        "score": sum(v["score"] for v in per_question.values()),
+        "maxScore": sum(v["maxScore"] for v in per_question.values()),
+        "overallEvaluation": "【后端模拟评分】这是一个自动生成的模拟结果，用于在未配置 Gemini 时的占位。",
+        "perQuestion": per_question,
+        "detailedComments": [],
+    }
+
+
+# 进行中的批改（单飞合并）：指纹相同的并发请求共享同一次上游调用
+_inflight_gradings: Dict[str, "asyncio.Task"] = {}
+_inflight_waiters: Dict[str, int] = {}   # 每个进行中的批改还有多少请求在等待结果
+_singleflight_stats = {"upstream_calls": 0, "coalesced": 0}
+
+
+def _forget_inflight_grading(key: str, task: "asyncio.Task") -> None:
+    if _inflight_gradings.get(key) is task:
+        _inflight_gradings.pop(key, None)
+    if not task.cancelled():
+        task.exception()  # 标记异常已取回，避免所有等待方都已断开时打印 "never retrieved"
+
+
+async def _normalize_answer_images(payload: dict) -> Optional[Dict[str, Any]]:
+    """作答图片发给上游前先去重、摆正、缩小并重新编码（见 image_normalize.py），返回本次的规整报告；没有图片时返回 None。"""
+    images = payload.get("answer_images")
+    if not images or not isinstance(images, list):
+        return None
+    payload["answer_images"], report = await image_normalize.normalize(images)
+    return report
+
+
+# ---------------------------------------------------------
+# 准入控制：按 IP 限速，上游批改按小题 / 大作文 / 拍照作答分优先级排队（见 admission.py），超限返回 429 + Retry-After
+# ---------------------------------------------------------
+def _admission_class(ctx: Dict[str, Any]) -> str:
+    if ctx["answer_images"]:
+        return "image"
+    return "essay" if ctx["has_essay"] else "small"
+
+
+def _admission_http_error(e: "admission.Rejected") -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=f"{e.reason}，请 {e.retry_after} 秒后重试。",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+
+def _check_client_rate(request: Request) -> None:
+    try:
+        admission.check_client(_get_client_ip(request))
+    except admission.Rejected as e:
+        print(f"[准入] 拒绝 IP={_get_client_ip(request)}: {e.reason}")
+        raise _admission_http_error(e)
+
+
+@contextlib.asynccontextmanager
+async def _grading_slot(ctx: Dict[str, Any]):
+    """占用一个上游批改槽位；有截止时间时排队不超过剩余时间。后台任务（ctx["background"]）不受队列长度与等待时间限制。"""
+    cls = _admission_class(ctx)
+    max_wait = None
+    if ctx.get("deadline") is not None:
+        max_wait = max(0.0, ctx["deadline"] - time.monotonic() - _GRADE_MIN_ATTEMPT_SECONDS)
+    try:
+        started = await admission.acquire(cls, max_wait, background=bool(ctx.get("background")))
+    except admission.Rejected as e:
+        print(f"[准入] 拒绝 session={ctx['grading_session_id']}: {e.reason}")
+        raise _admission_http_error(e)
+    try:
+        yield
+    finally:
+        admission.release(cls, started)
+
+
+async def _grade_uncached(ctx: Dict[str, Any]) -> dict:
+    async with _grading_slot(ctx):
+        started = time.monotonic()
+        gemini_raw = await _call_grading_providers(ctx)
+    prompt_format.note_upstream(ctx["prompt_format"], time.monotonic() - started)
+    if ctx.get("image_report"):
+        image_normalize.note_upstream(ctx["image_report"], time.monotonic() - started, ctx["grading_session_id"])
+    result = _build_grading_result(ctx, gemini_raw)
+    if gemini_raw and result.get("content"):
+        await run_in_threadpool(grade_cache.put, ctx["cache_key"], result)
+    return result
+
+
+async def _run_grading(ctx: Dict[str, Any]) -> dict:
+    """执行一次完整批改：先查结果缓存；未命中时若已有相同指纹的批改在进行中则直接等待它的结果，
+    否则调用模型并整理结果（只缓存模型真实返回的结果）。"""
+    key = ctx["cache_key"]
+    cached = await run_in_threadpool(grade_cache.get, key)
+    if cached is not None:
+        print(f"[批改缓存] 命中 session={ctx['grading_session_id']}, key={key[:12]}")
+        return cached
+    task = _inflight_gradings.get(key)
+    if task is None:
+        _singleflight_stats["upstream_calls"] += 1
+        task = asyncio.create_task(_grade_uncached(ctx))
+        _inflight_gradings[key] = task
+        task.add_done_callback(lambda t, k=key: _forget_inflight_grading(k, t))
+    else:
+        _singleflight_stats["coalesced"] += 1
+        print(f"[批改合并] 相同答案的批改正在进行，等待其结果 session={ctx['grading_session_id']}, key={key[:12]}")
+    # shield：某个等待方断开不会取消共享的上游调用；最后一个等待方也放弃时才取消
+    _inflight_waiters[key] = _inflight_waiters.get(key, 0) + 1
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        if _inflight_waiters.get(key) == 1 and not task.done():
+            print(f"[批改] 已无请求等待结果，取消上游调用 session={ctx['grading_session_id']}, key={key[:12]}")
+            _disconnect_stats["cancelled_gradings"] += 1
+            task.cancel()
+        raise
+    finally:
+        _inflight_waiters[key] -= 1
+        if not _inflight_waiters[key]:
+            _inflight_waiters.pop(key, None)
+
+
+# ---------------------------------------------------------
+# 客户端断开：批改等待期间定期检查连接，断开后取消仍在进行的上游调用（同一批改的其他等待方不受影响）
+# ---------------------------------------------------------
+_DISCONNECT_POLL_SECONDS = float(os.getenv("GRADE_DISCONNECT_POLL_SECONDS") or 1.0)
+_disconnect_stats = {
+    "disconnects": 0,
+    "stream_disconnects": 0,
+    "cancelled_gradings": 0,
+    "cancelled_upstream_calls": 0,
+    "upstream_seconds_elapsed": 0.0,
+    "upstream_seconds_reclaimed": 0.0,
+}
+
+
+async def _await_unless_disconnected(request: Request, awaitable) -> Any:
+    """等待 awaitable 完成；期间客户端断开则取消它并返回 None。"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=_DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                _disconnect_stats["disconnects"] += 1
+                print(f"[批改] 客户端已断开（{_get_client_ip(request)}），取消批改")
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return None
+    finally:
+        task.cancel()
+
+
+@app.post("/api/grade")
+async def grade_essay(request: Request, payload: dict):
+    print("收到前端提交的答案:", payload)
+    return await _grade_payload(request, payload)
+
+
+@app.post("/api/grade/upload")
+async def grade_essay_upload(request: Request):
+    """multipart/form-data 批改：payload 字段为与 /api/grade 相同的 JSON，作答图片以 images 文件部分上传（见 answer_uploads.py）。"""
+    try:
+        answer_uploads.check_content_length(request.headers)
+    except answer_uploads.UploadRejected as e:
+        raise HTTPException(status_code=e.status, detail=e.detail)
+    if not (request.headers.get("content-type") or "").startswith("multipart/form-data"):
+        raise HTTPException(status_code=415, detail="请以 multipart/form-data 上传。")
+    _check_client_rate(request)
+    form = await request.form(max_files=answer_uploads.max_images() + 1)
+    try:
+        payload, images = await run_in_threadpool(answer_uploads.parse_form, form)
+    except answer_uploads.UploadRejected as e:
+        raise HTTPException(status_code=e.status, detail=e.detail)
+    print("收到上传批改请求:", payload, f"images={[(img.mime, img.size) for img in images]}")
+    payload["answer_images"] = images
+    return await _grade_payload(request, payload, rate_checked=True)
+
+
+async def _grade_payload(request: Request, payload: dict, rate_checked: bool = False):
+    if not rate_checked:
+        _check_client_rate(request)
+    deadline = _grading_deadline_from_request(request, payload)
+    image_report = await _normalize_answer_images(payload)
+    sub_payloads = _fan_out_payloads(payload)
+    if sub_payloads:
+        ctxs = await _prepare_fan_out(sub_payloads, deadline)
+        has_essay = any(c["has_essay"] for c in ctxs.values() if isinstance(c, dict))
+        work = _run_fan_out(ctxs)
+    else:
+        ctx = await run_in_threadpool(_prepare_grading, payload)
+        ctx["deadline"] = deadline
+        ctx["image_report"] = image_report
+        has_essay = ctx["has_essay"]
+        work = _run_grading(ctx)
+
+    # 后端自统计：按天记录小题/大作文提交量及当日用户 IP（用于每日用户量）
+    try:
+        await run_in_threadpool(_record_submit_stat, has_essay, _get_client_ip(request))
+    except Exception as e:
+        print(f"[统计] 写入提交次数失败: {e}")
+
+    # 合并到他人发起的同一批改时，对方的截止时间可能更晚：按本请求自己的截止时间等待
+    try:
+        result = await _await_unless_disconnected(
+            request, asyncio.wait_for(work, timeout=max(0.0, deadline - time.monotonic()) + 2.0)
+        )
+    except asyncio.TimeoutError:
+        _raise_grading_timeout()
+    if result is None:
+        # 客户端已断开，响应不会被收到（499 为 nginx 约定的“客户端关闭连接”）
+        return Response(status_code=499)
+    if not result.get("partial"):
+        await _remember_session(payload, result, _client_id(request, payload), _get_client_ip(request))
+    return result
+
+
+# ---------------------------------------------------------
+# 批改会话：前端带 gradingSessionId 提交时保存批改结果（见 grade_sessions.py），刷新页面后按 id 取回，不必重新批改
+# ---------------------------------------------------------
+def _client_id(request: Request, payload: Optional[dict] = None) -> Optional[str]:
+    """客户端 id（请求头 X-Client-Id 或 payload.clientId，前端自行生成并持久保存），用于查询批改历史。"""
+    value = request.headers.get("x-client-id") or (payload or {}).get("clientId")
+    return value if grade_sessions.valid_id(value) else None
+
+
+async def _remember_session(payload: dict, result: Optional[dict], client_id: Optional[str], client_ip: Optional[str]) -> None:
+    session_id = payload.get("gradingSessionId")
+    if not session_id or not result:
+        return
+    try:
+        saved = await run_in_threadpool(
+            grade_sessions.save, session_id, result, client_id, client_ip,
+            payload.get("paperId") or payload.get("id"), list((payload.get("answers") or {}).keys()),
+        )
+        if saved is None:
+            print(f"[批改会话] 未保存 session={session_id}（id 无效或属于其他客户端）")
+    except Exception as e:
+        print(f"[批改会话] 保存失败 session={session_id}: {e}")
+
+
+@app.get("/api/grade/history")
+async def list_grade_history(request: Request, limit: int = 20, before: Optional[float] = None, clientId: Optional[str] = None):
+    """按客户端 id（请求头 X-Client-Id 或 clientId 参数）分页列出批改历史摘要（不含报告正文），按时间倒序；
+    下一页以上一页返回的 nextBefore 作为 before 参数。完整报告用 GET /api/grade/{sessionId} 取回。"""
+    client_id = _client_id(request, {"clientId": clientId})
+    if not client_id:
+        raise HTTPException(status_code=400, detail="缺少客户端 id（请求头 X-Client-Id 或 clientId 参数）。")
+    page = await run_in_threadpool(grade_sessions.list_sessions, client_id, limit, before)
+    return JSONResponse(content=page, headers={"Cache-Control": "private, no-cache"})
+
+
+# ---------------------------------------------------------
+# 多题拆分批改：answers 含多道题且开启拆分（payload.fanOut 或 GRADE_FAN_OUT）时，每道题单独构造 prompt
+# （只带本题的材料与批改说明，可复用预拼前缀与上下文缓存），并发批改后合并为 perQuestion；
+# 总耗时接近最慢的一道题。拍照作答无法按题拆分图片，不拆分
+# ---------------------------------------------------------
+_GRADE_FAN_OUT = (os.getenv("GRADE_FAN_OUT") or "0").strip().lower() in ("1", "true", "on")
+_fan_out_stats = {"requests": 0, "questions": 0, "failed_questions": 0, "wall_seconds": 0.0, "sum_seconds": 0.0}
+# 合并结果的档位：按已批改题目的得分率，下限与批改说明中的档位判定标准一致；已批改的题目含大作文时按大作文标准
+_FAN_OUT_GRADE_BANDS = {
+    "small": ((0.85, "A档（优秀）"), (0.70, "B档（良好）"), (0.55, "C档（中等）"), (0.40, "D档（待提升）"), (0.0, "E档（较差）")),
+    "essay": ((0.80, "A档（优秀）"), (0.65, "B档（良好）"), (0.52, "C档（中等）"), (0.38, "D档（待提升）"), (0.0, "E档（较差）")),
+}
+
+
+def _fan_out_payloads(payload: dict) -> Optional[List[dict]]:
+    """拆分模式下把多题提交拆成每题一份请求（gradingSessionId 为「原 id/题目 id」）；不拆分时返回 None。"""
+    enabled = payload.get("fanOut")
+    if enabled is None:
+        enabled = _GRADE_FAN_OUT
+    answers = payload.get("answers")
+    if not enabled or not isinstance(answers, dict) or len(answers) < 2 or payload.get("answer_images"):
+        return None
+    session_id = payload.get("gradingSessionId") or ("req-%s" % int(time.time() * 1000))
+    subs = []
+    for qid, answer in answers.items():
+        sub = dict(payload, answers={qid: answer}, gradingSessionId=f"{session_id}/{qid}")
+        sub.pop("question_ids", None)
+        # payload 中其他题的 materialIds 不能并入本题
+        single = payload.get("question")
+        if isinstance(single, dict) and str(single.get("id", single.get("qid"))) != str(qid):
+            sub.pop("question")
+        questions = payload.get("questions")
+        if isinstance(questions, list):
+            own = [q for q in questions if isinstance(q, dict) and str(q.get("id", q.get("qid"))) == str(qid)]
+            if own:
+                sub["questions"] = own
+        subs.append(sub)
+    return subs
+
+
+async def _prepare_fan_out(sub_payloads: List[dict], deadline: Optional[float]) -> Dict[str, Any]:
+    """为每道题构造批改上下文，返回 {题目 id: ctx 或构造失败的 HTTPException}；全部失败时抛出第一个错误。"""
+    prepared = await asyncio.gather(
+        *(run_in_threadpool(_prepare_grading, p) for p in sub_payloads), return_exceptions=True
+    )
+    ctxs: Dict[str, Any] = {}
+    for sub, ctx in zip(sub_payloads, prepared):
+        if isinstance(ctx, BaseException) and not isinstance(ctx, HTTPException):
+            raise ctx
+        if isinstance(ctx, dict):
+            ctx["deadline"] = deadline
+        ctxs[next(iter(sub["answers"]))] = ctx
+    if all(isinstance(c, HTTPException) for c in ctxs.values()):
+        raise next(iter(ctxs.values()))
+    return ctxs
+
+
+def _fan_out_entry(ctx: Dict[str, Any], result: Any) -> Dict[str, Any]:
+    """单题批改结果（或异常）转为 perQuestion 中的一项；失败的题目能确定满分时也带上 maxScore。"""
+    if isinstance(result, BaseException):
+        if isinstance(result, HTTPException):
+            entry = {"error": result.detail, "status": result.status_code}
+        else:
+            entry = {"error": f"批改失败：{result}", "status": 500}
+        if isinstance(ctx, dict):
+            entry["maxScore"] = sum((q.get("maxScore") or 100) for q in ctx["model_input"].get("questions") or []) or None
+        return entry
+    per_question = result.get("perQuestion") or {}
+    entry = dict(next(iter(per_question.values()))) if per_question else {}
+    for key in ("score", "maxScore", "grade", "content", "overallEvaluation"):
+        if result.get(key) not in (None, ""):
+            entry[key] = result[key]
+    entry["gradingSessionId"] = ctx["grading_session_id"]
+    return entry
+
+
+async def _run_fan_out(ctxs: Dict[str, Any]) -> dict:
+    """并发批改各题（各自走结果缓存、单飞合并与准入排队），合并为一个结果；部分题目失败时其余题目照常返回。
+
+    合并结果的 maxScore 含失败的题目，score 与档位只按已批改的题目计算；有题目失败时 partial 为 True，
+    failedQuestions 列出失败的题目 id，这样的结果不保存为批改会话（成功的各题仍按题缓存）。
+    """
+    started = time.monotonic()
+    durations: List[float] = []
+
+    async def _one(ctx: Any) -> dict:
+        if isinstance(ctx, BaseException):
+            raise ctx
+        t = time.monotonic()
+        try:
+            return await _run_grading(ctx)
+        finally:
+            durations.append(time.monotonic() - t)
+
+    results = await asyncio.gather(*(_one(c) for c in ctxs.values()), return_exceptions=True)
+    wall = time.monotonic() - started
+    per_question: Dict[str, Any] = {}
+    contents = []
+    for (qid, ctx), result in zip(ctxs.items(), results):
+        if isinstance(result, asyncio.CancelledError):
+            raise result
+        entry = _fan_out_entry(ctx, result)
+        per_question[qid] = entry
+        if entry.get("content"):
+            contents.append(f"## 题目 {qid}\n\n{entry['content']}")
+    failed = sum(1 for e in per_question.values() if "error" in e)
+    _fan_out_stats["requests"] += 1
+    _fan_out_stats["questions"] += len(per_question)
+    _fan_out_stats["failed_questions"] += failed
+    _fan_out_stats["wall_seconds"] += wall
+    _fan_out_stats["sum_seconds"] += sum(durations)
+    print(f"[拆分批改] {len(per_question)} 题（失败 {failed}），总耗时 {wall:.1f}s，各题耗时之和 {sum(durations):.1f}s")
+    if failed == len(per_question):
+        raise next(r for r in results if isinstance(r, BaseException))
+    body = "\n\n---\n\n".join(contents)
+    failed_questions = [qid for qid, e in per_question.items() if "error" in e]
+    graded = [e for e in per_question.values() if "error" not in e]
+    score = sum(e.get("score") or 0 for e in graded)
+    graded_max = sum(e.get("maxScore") or 0 for e in graded)
+    grade = None
+    if graded_max:
+        has_essay = any(ctxs[qid]["has_essay"] for qid, e in per_question.items() if "error" not in e)
+        bands = _FAN_OUT_GRADE_BANDS["essay" if has_essay else "small"]
+        grade = next(band for ratio, band in bands if score / graded_max >= ratio)
+    evaluations = [f"题目 {qid}：{e['overallEvaluation']}" for qid, e in per_question.items() if e.get("overallEvaluation")]
+    if failed_questions:
+        evaluations.append(f"题目 {'、'.join(failed_questions)} 批改失败，未计入得分与档位，请稍后重新提交。")
+    return {
+        "content": body,
+        "modelRawOutput": body,
+        "score": score,
+        "maxScore": sum(e.get("maxScore") or 0 for e in per_question.values()),
+        "grade": grade,
+        "overallEvaluation": "\n".join(evaluations),
+        "detailedComments": [],
+        "perQuestion": per_question,
+        "modelAnswer": "",
+        "fanOut": True,
+        "partial": bool(failed_questions),
+        "failedQuestions": failed_questions,
+    }
+
+
+# ---------------------------------------------------------
+# 4.1 接口：异步批改任务（提交即返回 jobId，前端轮询结果）
+# ---------------------------------------------------------
+_GRADE_JOB_WORKERS = int(os.getenv("GRADE_JOB_WORKERS") or 4)
+_GRADE_JOB_QUEUE_SIZE = int(os.getenv("GRADE_JOB_QUEUE_SIZE") or 200)
+_grade_job_queue: Optional[asyncio.Queue] = None
+_grade_job_contexts: Dict[str, Dict[str, Any]] = {}
+_grade_job_tasks: List[asyncio.Task] = []
+
+
+async def _execute_grade_job(job_id: str) -> None:
+    """执行一个批改任务：领取 → 准备上下文（重启恢复的任务需重新解析）→ 调用模型 → 写回结果。"""
+    job = await run_in_threadpool(grade_jobs.claim_job, job_id)
+    if not job:
+        _grade_job_contexts.pop(job_id, None)
+        return
+    try:
+        ctx = _grade_job_contexts.pop(job_id, None)
+        if ctx is None:
+            ctx = await run_in_threadpool(_prepare_grading, job["payload"])
+        ctx["background"] = True
+        result = await _run_grading(ctx)
+        await run_in_threadpool(grade_jobs.finish_job, job_id, result)
+        await _remember_session(job["payload"], result, job["payload"].get("clientId"), job["clientIp"])
+        print(f"[批改任务] 完成 job={job_id}")
+    except HTTPException as e:
+        await run_in_threadpool(grade_jobs.fail_job, job_id, str(e.detail), e.status_code)
+        print(f"[批改任务] 失败 job={job_id}, status={e.status_code}, detail={e.detail}")
+    except Exception as e:
+        await run_in_threadpool(grade_jobs.fail_job, job_id, f"批改失败: {e}", 500)
+        print(f"[批改任务] 异常 job={job_id}: {e}")
+
+
+async def _grade_job_worker(worker_no: int) -> None:
+    while True:
+        job_id = await _grade_job_queue.get()
+        try:
+            await _execute_grade_job(job_id)
+        finally:
+            _grade_job_queue.task_done()
+
+
+@app.on_event("startup")
+async def _start_grade_job_workers():
+    """启动固定数量的批改 worker，并把上次未完成的任务重新入队。"""
+    global _grade_job_queue
+    _grade_job_queue = asyncio.Queue(maxsize=_GRADE_JOB_QUEUE_SIZE)
+    for i in range(_GRADE_JOB_WORKERS):
+        _grade_job_tasks.append(asyncio.create_task(_grade_job_worker(i)))
+    pending = await run_in_threadpool(grade_jobs.recover_pending_jobs)
+    for job_id in pending:
+        try:
+            _grade_job_queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            await run_in_threadpool(grade_jobs.fail_job, job_id, "服务重启后任务队列已满，请重新提交。", 503)
+    print(f"[批改任务] workers={_GRADE_JOB_WORKERS}, queue_size={_GRADE_JOB_QUEUE_SIZE}, 恢复未完成任务 {len(pending)} 个")
+
+
+@app.on_event("shutdown")
+async def _stop_grade_job_workers():
+    for task in _grade_job_tasks:
+        task.cancel()
+    _grade_job_tasks.clear()
+
+
+@app.post("/api/grade/jobs", status_code=202)
+async def create_grade_job(request: Request, payload: dict):
+    """提交批改任务：参数校验失败直接返回 400；否则立即返回 jobId，由后台 worker 执行批改。"""
+    print("收到异步批改任务:", {k: v for k, v in payload.items() if k != "answer_images"})
+    _check_client_rate(request)
+    image_report = await _normalize_answer_images(payload)
+    ctx = await run_in_threadpool(_prepare_grading, payload)
+    ctx["image_report"] = image_report
+    if _grade_job_queue is None or _grade_job_queue.full():
+        raise HTTPException(status_code=503, detail="批改任务排队已满，请稍后再试。", headers={"Retry-After": "30"})
+
+    client_ip = _get_client_ip(request)
+    try:
+        await run_in_threadpool(_record_submit_stat, ctx["has_essay"], client_ip)
+    except Exception as e:
+        print(f"[统计] 写入提交次数失败: {e}")
+
+    # 任务完成时按 gradingSessionId 保存结果，客户端 id 随 payload 一起持久化
+    client_id = _client_id(request, payload)
+    if client_id:
+        payload["clientId"] = client_id
+    job_id = await run_in_threadpool(grade_jobs.create_job, payload, client_ip)
+    _grade_job_contexts[job_id] = ctx
+    try:
+        _grade_job_queue.put_nowait(job_id)
+    except asyncio.QueueFull:
+        _grade_job_contexts.pop(job_id, None)
+        await run_in_threadpool(grade_jobs.fail_job, job_id, "批改任务排队已满，请稍后再试。", 503)
+        raise HTTPException(status_code=503, detail="批改任务排队已满，请稍后再试。", headers={"Retry-After": "30"})
+    return JSONResponse(
+        status_code=202,
+        content={"jobId": job_id, "status": "queued"},
+        headers={"Location": f"/api/grade/jobs/{job_id}"},
+    )
+
+
+@app.get("/api/grade/jobs/{job_id}")
+async def get_grade_job(job_id: str):
+    """查询批改任务：status 为 queued / running / done / failed；done 时 result 与 /api/grade 返回结构一致。"""
+    job = await run_in_threadpool(grade_jobs.get_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"批改任务不存在: {job_id}")
+    return job
+
+
+@app.get("/api/grade/{session_id}")
+async def get_grade_session(session_id: str, request: Request):
+    """按 gradingSessionId 取回已保存的批改结果（与 /api/grade 返回结构相同），支持 ETag / If-None-Match。"""
+    record = await run_in_threadpool(grade_sessions.get, session_id, request.headers.get("if-none-match"))
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"批改记录不存在或已过期: {session_id}")
+    headers = {"ETag": record["etag"], "Cache-Control": "private, no-cache"}
+    if record["notModified"]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=record["result"], headers=headers)
+
+
+# ---------------------------------------------------------
+# 4.2 接口：流式批改（SSE），边生成边推送报告正文
+# 事件：chunk（正文片段）→ grade（档位/估分区间行输出后立即推送）→ result（与 /api/grade 相同的完整结构）
+# 出错时推送 error 事件
+# ---------------------------------------------------------
+def _sse_event(event: str, data: Any) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+async def _stream_grading_providers(ctx: Dict[str, Any]) -> AsyncIterator[str]:
+    """按健康度排序后依次流式调用 Gemini / 钱多多；仅当前一个上游没有任何输出时才切换到下一个。
+
+    剩余时间不够某个上游通常耗时的调用时跳过它；整个上游流不超过截止时间（而不只是每次读取），
+    到时关闭上游流并抛出 _DeadlineExceeded。
+    """
+    kwargs = {"temperature": ctx["temperature"], "top_p": ctx["top_p"]}
+    providers = _order_providers_by_health([
+        ("Gemini", "gemini", lambda: stream_gemini_system(ctx["prompt"], ctx["answer_images"], context_cache=ctx.get("context_cache"), **kwargs)),
+        ("钱多多", "qianduoduo", lambda: stream_qianduoduo_gemini(ctx["prompt"], ctx["answer_images"], **kwargs)),
+    ])
+    for name, _, stream in providers:
+        if _too_late_for(name):
+            continue
+        produced = False
+        upstream = stream()
+        try:
+            while True:
+                remaining = _remaining_budget()
+                try:
+                    async with asyncio.timeout(None if remaining is None else max(0.0, remaining)):
+                        text = await anext(upstream)
+                except StopAsyncIteration:
+                    break
+                except TimeoutError:
+                    raise _DeadlineExceeded(f"{name} 流式输出超过截止时间") from None
+                produced = True
+                yield text
+        finally:
+            await upstream.aclose()
+        if produced:
+            return
+        print(f"[流式批改] {name} 无输出，尝试下一个上游...")
+
+
+async def _grade_event_stream(ctx: Dict[str, Any]) -> AsyncIterator[bytes]:
+    cached = await run_in_threadpool(grade_cache.get, ctx["cache_key"])
+    if cached is not None:
+        print(f"[批改缓存] 流式命中 session={ctx['grading_session_id']}, key={ctx['cache_key'][:12]}")
+        yield _sse_event("chunk", {"text": cached.get("content") or ""})
+        yield _sse_event("grade", {"grade": cached.get("grade"), "score": cached.get("score"), "maxScore": cached.get("maxScore")})
+        await _remember_stream_session(ctx, cached)
+        yield _sse_event("result", cached)
+        return
+    try:
+        async with _grading_slot(ctx):
+            async for event in _grade_event_stream_uncached(ctx):
+                yield event
+    except HTTPException as e:
+        yield _sse_event("error", {"status": e.status_code, "detail": e.detail})
+
+
+async def _grade_event_stream_uncached(ctx: Dict[str, Any]) -> AsyncIterator[bytes]:
+    _grading_deadline.set(ctx.get("deadline"))
+    body = ""
+    grade_sent = False
+    started = time.monotonic()
+    # 客户端断开时 StreamingResponse 会取消本生成器，上游流随之关闭（见 stream_gemini_system 的 aclose）
+    timed_out = False
+    try:
+        async for text in _stream_grading_providers(ctx):
+            body += text
+            yield _sse_event("chunk", {"text": text})
+            if not grade_sent and "\n" in text:
+                # 只解析已完整输出的行，避免把半截的“估分区间”解析成错误分数
+                finished = body[: body.rfind("\n") + 1]
+                grade = _parse_grade_from_markdown(finished)
+                score, max_score = _parse_score_from_markdown(finished)
+                if grade and score is not None:
+                    grade_sent = True
+                    yield _sse_event("grade", {"grade": grade, "score": score, "maxScore": max_score})
+    except _DeadlineExceeded as e:
+        print(f"[流式批改] {e}")
+        timed_out = True
+    except (asyncio.CancelledError, GeneratorExit):
+        _disconnect_stats["stream_disconnects"] += 1
+        _disconnect_stats["upstream_seconds_elapsed"] += time.monotonic() - started
+        print(f"[流式批改] 客户端已断开，停止上游流 session={ctx['grading_session_id']}")
+        raise
+    prompt_format.note_upstream(ctx["prompt_format"], time.monotonic() - started)
+    if ctx.get("image_report"):
+        image_normalize.note_upstream(ctx["image_report"], time.monotonic() - started, ctx["grading_session_id"])
+    if timed_out or (not body and _deadline_exceeded()):
+        # 到时仍未输出完的报告不完整，不缓存、不保存
+        _deadline_stats["timeouts"] += 1
+        print("[流式批改] 超过截止时间仍无完整结果")
+        yield _sse_event("error", {"status": 504, "detail": _GRADING_TIMEOUT_DETAIL})
+        return
+    if not body and ctx["answer_images"]:
+        print("[流式批改] 图片批改所有上游均失败")
+        yield _sse_event("error", {"status": 503, "detail": _IMAGE_GRADING_UNAVAILABLE})
+        return
+    result = _build_grading_result(ctx, body or None)
+    if body and result.get("content"):
+        await run_in_threadpool(grade_cache.put, ctx["cache_key"], result)
+    await _remember_stream_session(ctx, result)
+    yield _sse_event("result", result)
+
+
+async def _remember_stream_session(ctx: Dict[str, Any], result: dict) -> None:
+    session = ctx.get("session")
+    if session:
+        await _remember_session(session["payload"], result, session["clientId"], session["clientIp"])
+
+
+@app.post("/api/grade/stream")
+async def grade_essay_stream(request: Request, payload: dict):
+    """与 /api/grade 参数相同，以 text/event-stream 返回批改过程；参数校验失败仍直接返回 400。"""
+    print("收到流式批改请求:", {k: v for k, v in payload.items() if k != "answer_images"})
+    _check_client_rate(request)
+    deadline = _grading_deadline_from_request(request, payload)
+    image_report = await _normalize_answer_images(payload)
+    ctx = await run_in_threadpool(_prepare_grading, payload)
+    ctx["deadline"] = deadline
+    ctx["image_report"] = image_report
+    ctx["session"] = {"payload": payload, "clientId": _client_id(request, payload), "clientIp": _get_client_ip(request)}
+    # 槽位在流开始后才占用（排队超时以 error 事件告知）；此时已满则直接 429
+    try:
+        admission.check_capacity(_admission_class(ctx))
+    except admission.Rejected as e:
+        raise _admission_http_error(e)
+    try:
+        await run_in_threadpool(_record_submit_stat, ctx["has_essay"], _get_client_ip(request))
+    except Exception as e:
+        print(f"[统计] 写入提交次数失败: {e}")
+    return StreamingResponse(
+        _grade_event_stream(ctx),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _get_gemini_api_keys() -> List[str]:
+    """返回 Gemini API Key 列表（下标即 Key 序号）：GEMINI_API_KEY、GEMINI_API_KEY_FALLBACK，再加 GEMINI_API_KEYS 中的 Key。"""
+    return gemini_key_pool.configured_keys()
+
+
+def _estimate_prompt_tokens(prompt: str, image_count: int = 0) -> int:
+    """估算请求的输入 token 数，用于 Key 的 TPM 令牌桶（估算规则见 prompt_budget.estimate_tokens，每张图按 258 token 计）。"""
+    return prompt_budget.estimate_tokens(prompt) + prompt_budget.IMAGE_TOKENS * image_count
+
+
+async def _acquire_gemini_key(tokens: int, tried: set) -> Optional[int]:
+    """按权重轮询选一个未试过、未熔断且令牌桶有余量的 Key（都没有余量时短暂排队），返回 Key 序号；没有可用 Key 时返回 None。"""
+    idx = await gemini_key_pool.acquire(tokens, tried, lambda i: not circuit_breaker.is_open(_gemini_key_breaker(i)))
+    if idx is None and not tried:
+        print("Gemini 所有 Key 均在本地限流或熔断中，跳过 Gemini。")
+    return idx
+
+
+def _gemini_key_breaker(idx: int) -> str:
+    return f"gemini#{idx}"
+
+
+def _gemini_breakers_allow() -> bool:
+    """Gemini 整体熔断、或所有 Key 都在熔断中时返回 False（半开时会占用一个探测名额）。"""
+    n = len(_get_gemini_api_keys())
+    if n and all(circuit_breaker.is_open(_gemini_key_breaker(i)) for i in range(n)):
+        return False
+    return circuit_breaker.allow("gemini")
+
+
+def _record_upstream_call(provider: str, key_breaker: Optional[str], status: Optional[int], started: float):
+    """把一次上游 HTTP 调用计入熔断器：status 为 None 表示网络错误或超时；429 时对应 Key 立即熔断。"""
+    latency = time.monotonic() - started
+    ok = status is not None and status < 500 and status != 429
+    circuit_breaker.record(provider, ok, latency)
+    if key_breaker:
+        if status == 429:
+            circuit_breaker.record_quota(key_breaker, latency)
         else:
-            total_max += 100
+            circuit_breaker.record(key_breaker, ok, latency)
 
-    # 若没有题目信息（paper.questions 为空），则根据 answers 的键生成占位项
-    if not model_input["questions"] and answers:
-        for idx, qid in enumerate(answers.keys(), start=1):
-            per_question[qid] = {
-                "score": 80,
-                "maxScore": 100,
-                "deductions": [{"point": "内容不够具体", "deduct": 20}],
-                "referenceAnswer": "（该试卷未提供题目文本，按学生答案生成的模拟参考）",
-            }
-        return {
-            "score": sum(item["score"] for item in per_question.values()),
-            "maxScore": len(per_question) * 100,
-            "overallEvaluation": "【后端模拟评分】试卷无题目正文，已根据提交的 answers 生成模拟分项。",
-            "perQuestion": per_question,
-            "detailedComments": [],
-        }
 
-    # 普通模拟：按题目逐项生成占位点评
-    for q in model_input["questions"]:
-        qid = q.get("id") or str(len(per_question) + 1)
-        maxs = q.get("maxScore") or 100
-        ans = answers.get(qid, "")
-        # 简单启发：如果有答案长度 > 50 视为得分较高
-        score = int(maxs * (0.8 if len(str(ans)) > 50 else 0.6))
-        per_question[qid] = {
-            "score": score,
-            "maxScore": maxs,
-            "deductions": [{"point": "论证不够丰满", "deduct": max(1, int(maxs * 0.2))}],
-            "referenceAnswer": f"（模拟参考答案，基于题目 {q.get('title')}）",
-        }
+# ---------------------------------------------------------
+# 上游 HTTP 连接池：每个上游（gemini / qianduoduo）一个共享的 AsyncClient，
+# 复用 keep-alive 长连接，避免每次批改都重新做 TCP+TLS 握手；等待上游期间不占用线程池。
+# ---------------------------------------------------------
+_UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE") or 100)
+_UPSTREAM_KEEPALIVE_SECONDS = float(os.getenv("UPSTREAM_KEEPALIVE_SECONDS") or 60)
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def _get_http_client(upstream: str) -> httpx.AsyncClient:
+    """返回某个上游的共享 AsyncClient（首次使用时创建）。"""
+    client = _http_clients.get(upstream)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=_UPSTREAM_POOL_SIZE,
+                max_keepalive_connections=_UPSTREAM_POOL_SIZE,
+                keepalive_expiry=_UPSTREAM_KEEPALIVE_SECONDS,
+            ),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+        )
+        _http_clients[upstream] = client
+    return client
 
-    return {
-        "score": sum(v["score"] for v in per_question.values()),
-        "maxScore": sum(v["maxScore"] for v in per_question.values()),
-        "overallEvaluation": "【后端模拟评分】这是一个自动生成的模拟结果，用于在未配置 Gemini 时的占位。",
-        "perQuestion": per_question,
-        "detailedComments": [],
-    }
 
+async def _post_upstream(upstream: str, url: str, data: Any, headers: Dict[str, str], timeout: float) -> tuple:
+    """经共享连接池 POST 到上游，返回 (status_code, 响应文本)。timeout 为本次调用的总读超时（秒）。"""
+    return await _request_upstream(upstream, "POST", url, data, headers, timeout)
 
-def _get_gemini_api_keys() -> List[str]:
-    """返回 Gemini API Key 列表：优先新账号(GEMINI_API_KEY)，其次老账号(GEMINI_API_KEY_FALLBACK)。"""
-    keys: List[str] = []
-    primary = (os.getenv("GEMINI_API_KEY") or "").strip()
-    if primary:
-        keys.append(primary)
-    fallback = (os.getenv("GEMINI_API_KEY_FALLBACK") or "").strip()
-    if fallback and fallback != primary:
-        keys.append(fallback)
-    return keys
-
-
-_gemini_disabled_until: Optional[float] = None
-_gemini_disabled_lock = threading.Lock()
-
-
-def _is_gemini_temporarily_disabled() -> bool:
-    """是否处于“额度已用完”的临时禁用窗口内。"""
-    global _gemini_disabled_until
-    with _gemini_disabled_lock:
-        if not _gemini_disabled_until:
-            return False
-        now = time.time()
-        if now >= _gemini_disabled_until:
-            # 冷却期已过，自动恢复
-            _gemini_disabled_until = None
-            return False
-        return True
 
+async def _request_upstream(
+    upstream: str, method: str, url: str, data: Any, headers: Dict[str, str], timeout: float
+) -> tuple:
+    """经共享连接池向上游发请求，返回 (status_code, 响应文本)。"""
+    timeout = _upstream_timeout(timeout)
+    client = _get_http_client(upstream)
+    resp = await asyncio.wait_for(
+        client.request(
+            method,
+            url,
+            content=data,
+            headers=headers,
+            timeout=httpx.Timeout(timeout, connect=min(10.0, timeout)),
+        ),
+        timeout + 1.0,
+    )
+    return (resp.status_code, resp.text)
 
-def _mark_gemini_quota_exhausted():
-    """当所有 Gemini Key 都返回额度/限流错误时，禁用至“下一次太平洋时间 0 点”或指定冷却期。"""
-    global _gemini_disabled_until
 
-    # 如果显式配置了 GEMINI_COOLDOWN_SECONDS，则优先生效（兼容自定义需求）
-    cooldown_env = os.getenv("GEMINI_COOLDOWN_SECONDS")
-    if cooldown_env:
+@app.on_event("shutdown")
+async def _close_http_clients():
+    """关闭所有上游连接池。"""
+    for client in list(_http_clients.values()):
         try:
-            cooldown = int(cooldown_env)
-        except Exception:
-            cooldown = 0
-        if cooldown > 0:
-            with _gemini_disabled_lock:
-                _gemini_disabled_until = time.time() + cooldown
-            return
+            await client.aclose()
+        except Exception as e:
+            print(f"[连接池] 关闭失败: {e}")
+    _http_clients.clear()
 
-    # 否则按需求：禁用到“下一次太平洋时间（PT）0 点”
-    try:
-        now_utc = datetime.now(timezone.utc)
-        pt_tz = ZoneInfo("America/Los_Angeles")
-        now_pt = now_utc.astimezone(pt_tz)
-        next_midnight_pt = (now_pt + timedelta(days=1)).replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
-        next_midnight_utc = next_midnight_pt.astimezone(timezone.utc)
-        disabled_until_ts = next_midnight_utc.timestamp()
-    except Exception as e:
-        # 如果计算 PT 时间失败，则退回到一个保守的 24 小时冷却
-        print("计算 Gemini 冷却至 PT 午夜失败，退回 24 小时冷却:", e)
-        disabled_until_ts = time.time() + 24 * 3600
 
-    with _gemini_disabled_lock:
-        _gemini_disabled_until = disabled_until_ts
+@app.on_event("shutdown")
+async def _stop_image_workers():
+    """关闭图片规整进程池。"""
+    image_normalize.shutdown()
 
 
-def call_qianduoduo_gemini(
+async def call_qianduoduo_gemini(
     prompt: str,
     content_parts: Optional[List[Any]] = None,
     *,
@@ -950,45 +2170,57 @@ def call_qianduoduo_gemini(
         "top_p": top_p,
         "max_tokens": 65536,
     }
-    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-    headers = {
+    data = answer_uploads.encode_json(payload)
+    headers = answer_uploads.content_headers(data, {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}",
-    }
-    req = urllib.request.Request(url, data=data, headers=headers)
-    try:
-        with urllib.request.urlopen(req, timeout=120) as resp:
-            raw = resp.read().decode("utf-8")
-            if not raw or not raw.strip():
-                print("钱多多 API 返回空 body")
-                return None
-            try:
-                obj = json.loads(raw)
-            except Exception:
-                return raw
-            err = obj.get("error")
-            if err:
-                print("钱多多 API 错误:", err)
-                return None
-            choices = obj.get("choices") or []
-            if not choices:
-                print("钱多多 API 无 choices")
-                return None
-            message = (choices[0] or {}).get("message") or {}
-            content = (message.get("content") or "").strip()
-            return content if content else None
-    except urllib.error.HTTPError as e:
-        print("call_qianduoduo_gemini HTTPError:", e.code, e.reason)
+    })
+    if not circuit_breaker.allow("qianduoduo"):
+        print("钱多多熔断中，当前请求直接跳过。")
         return None
+    started = time.monotonic()
+    status = None
+    try:
+        status, raw = await _post_upstream("qianduoduo", url, data, headers, timeout=120)
+        _record_upstream_call("qianduoduo", None, status, started)
+        if status >= 400:
+            print("call_qianduoduo_gemini HTTPError:", status, raw[:200])
+            return None
+        if not raw or not raw.strip():
+            print("钱多多 API 返回空 body")
+            return None
+        try:
+            obj = json.loads(raw)
+        except Exception:
+            return raw
+        err = obj.get("error")
+        if err:
+            print("钱多多 API 错误:", err)
+            return None
+        choices = obj.get("choices") or []
+        if not choices:
+            print("钱多多 API 无 choices")
+            return None
+        message = (choices[0] or {}).get("message") or {}
+        content = (message.get("content") or "").strip()
+        return content if content else None
     except Exception as e:
+        if status is None and not isinstance(e, _DeadlineExceeded):
+            _record_upstream_call("qianduoduo", None, None, started)
         print("call_qianduoduo_gemini failed:", e)
         return None
+    finally:
+        if status is None:          # 请求未发出（超过截止时间、被取消）：归还可能占用的半开探测名额
+            circuit_breaker.release_probe("qianduoduo")
 
 
-def _build_openai_content_parts(prompt: str, image_data_list: List[str]) -> List[Dict[str, Any]]:
-    """把 prompt 文本与 data URL 列表转成 OpenAI 多模态 content 数组。"""
+def _build_openai_content_parts(prompt: str, image_data_list: List[Any]) -> List[Dict[str, Any]]:
+    """把 prompt 文本与 data URL 列表转成 OpenAI 多模态 content 数组（上传的图片放占位符，序列化时展开）。"""
     parts: List[Dict[str, Any]] = [{"type": "text", "text": prompt}]
     for data_url in image_data_list:
+        if isinstance(data_url, answer_uploads.UploadedImage):
+            parts.append({"type": "image_url", "image_url": {"url": data_url.data_url()}})
+            continue
         mime, b64 = _parse_data_url(data_url)
         if not b64:
             continue
@@ -999,9 +2231,9 @@ def _build_openai_content_parts(prompt: str, image_data_list: List[str]) -> List
     return parts
 
 
-def call_qianduoduo_gemini_with_images(
+async def call_qianduoduo_gemini_with_images(
     prompt: str,
-    image_data_list: List[str],
+    image_data_list: List[Any],
     *,
     temperature: float = 0.3,
     top_p: float = 0.9,
@@ -1010,7 +2242,7 @@ def call_qianduoduo_gemini_with_images(
     parts = _build_openai_content_parts(prompt, image_data_list)
     if len(parts) <= 1:
         return None
-    return call_qianduoduo_gemini(prompt, content_parts=parts, temperature=temperature, top_p=top_p)
+    return await call_qianduoduo_gemini(prompt, content_parts=parts, temperature=temperature, top_p=top_p)
 
 
 def _is_quota_or_rate_limit_error(http_code: Optional[int], error_obj: Optional[dict]) -> bool:
@@ -1044,27 +2276,153 @@ def _parse_data_url(data_url: str) -> tuple:
     return ("image/jpeg", s)
 
 
-def call_gemini_system_with_images(
-    prompt: str,
-    image_data_list: List[str],
-    *,
-    temperature: float = 0.3,
-    top_p: float = 0.9,
+# ---------------------------------------------------------
+# Gemini 上下文缓存（cachedContents）：同一道题的固定前缀只上传一次，之后的请求引用缓存名
+# 登记与淘汰见 gemini_context_cache.py；缓存不存在或不可用时自动改发完整 prompt
+# ---------------------------------------------------------
+_CONTEXT_CACHE_MISS_STATUS = (400, 403, 404)
+
+
+async def _delete_gemini_context_cache(base_endpoint: str, api_key: str, name: str) -> None:
+    try:
+        status, raw = await _request_upstream(
+            "gemini", "DELETE", base_endpoint.rstrip("/") + f"/v1beta/{name}?key={api_key}", None, {}, timeout=15
+        )
+        if status >= 400 and status != 404:
+            print(f"[上下文缓存] 删除 {name} 失败: {status} {raw[:200]}")
+    except Exception as e:
+        print(f"[上下文缓存] 删除 {name} 失败: {e}")
+
+
+async def _refresh_gemini_context_cache(base_endpoint: str, key_idx: int, api_key: str, prefix_id: str, name: str) -> None:
+    ttl = gemini_context_cache.TTL_SECONDS
+    try:
+        status, raw = await _request_upstream(
+            "gemini",
+            "PATCH",
+            base_endpoint.rstrip("/") + f"/v1beta/{name}?key={api_key}&updateMask=ttl",
+            json.dumps({"ttl": f"{ttl}s"}).encode("utf-8"),
+            {"Content-Type": "application/json"},
+            timeout=15,
+        )
+    except Exception as e:
+        print(f"[上下文缓存] 续期 {name} 失败: {e}")
+        gemini_context_cache.touch(key_idx, prefix_id, 0)
+        return
+    if status == 404:
+        gemini_context_cache.forget(key_idx, prefix_id)
+    elif status >= 400:
+        print(f"[上下文缓存] 续期 {name} 失败: {status} {raw[:200]}")
+        gemini_context_cache.touch(key_idx, prefix_id, 0)
+    else:
+        gemini_context_cache.touch(key_idx, prefix_id, ttl)
+
+
+async def _resolve_gemini_context_cache(
+    base_endpoint: str, model_name: str, key_idx: int, api_key: str, context_cache: Optional[Dict[str, str]]
 ) -> Optional[str]:
-    """带图片的多模态调用 Gemini；优先主 Key，遇限流/配额用备用 Key 重试；若所有 Key 都额度用完，则进入冷却期。"""
-    if _is_gemini_temporarily_disabled():
-        print("Gemini 已标记为额度用完（多模态），当前请求直接跳过 Gemini。")
+    """返回本次请求可引用的 cachedContents 名称；需要时创建或续期。没有可用缓存时返回 None。"""
+    if not context_cache or not gemini_context_cache.enabled():
         return None
-    api_keys = _get_gemini_api_keys()
-    if not api_keys:
-        print("GEMINI not configured (GEMINI_API_KEY missing)")
+    prefix_id = context_cache["id"]
+    entry = gemini_context_cache.lookup(key_idx, prefix_id)
+    if entry:
+        if entry["refresh"] and gemini_context_cache.begin_refresh(key_idx, prefix_id):
+            asyncio.create_task(_refresh_gemini_context_cache(base_endpoint, key_idx, api_key, prefix_id, entry["name"]))
+        return entry["name"]
+    if not gemini_context_cache.begin_create(key_idx, prefix_id):
         return None
-    base_endpoint = os.getenv("GEMINI_ENDPOINT", "https://generativelanguage.googleapis.com")
-    model_name = "gemini-3-flash-preview"
+    body = {
+        "model": f"models/{model_name}",
+        "displayName": context_cache.get("label") or prefix_id[:32],
+        "contents": [{"role": "user", "parts": [{"text": context_cache["prefix"]}]}],
+        "ttl": f"{gemini_context_cache.TTL_SECONDS}s",
+    }
+    try:
+        status, raw = await _post_upstream(
+            "gemini",
+            base_endpoint.rstrip("/") + f"/v1beta/cachedContents?key={api_key}",
+            json.dumps(body, ensure_ascii=False).encode("utf-8"),
+            {"Content-Type": "application/json"},
+            timeout=30,
+        )
+        name = (json.loads(raw) or {}).get("name") if status < 400 else None
+    except Exception as e:
+        print(f"[上下文缓存] 创建失败: {e}")
+        gemini_context_cache.abandon_create(key_idx, prefix_id)
+        return None
+    if not name:
+        print(f"[上下文缓存] 创建失败: {status} {raw[:200]}")
+        if status in _CONTEXT_CACHE_MISS_STATUS:
+            gemini_context_cache.reject(key_idx, prefix_id)
+        else:
+            gemini_context_cache.abandon_create(key_idx, prefix_id)
+        return None
+    print(f"[上下文缓存] 已创建 {name} ({context_cache.get('label')})")
+    api_keys = _get_gemini_api_keys()
+    for old_idx, old_name in gemini_context_cache.store(key_idx, prefix_id, name):
+        if old_idx < len(api_keys):
+            asyncio.create_task(_delete_gemini_context_cache(base_endpoint, api_keys[old_idx], old_name))
+    return name
 
+
+async def _send_gemini_request(
+    url: str,
+    payload: Dict[str, Any],
+    *,
+    base_endpoint: str,
+    model_name: str,
+    key_idx: int,
+    api_key: str,
+    context_cache: Optional[Dict[str, str]],
+    timeout: float,
+    stream: bool = False,
+    data: Any = None,
+) -> httpx.Response:
+    """发送 generateContent / streamGenerateContent 请求。
+
+    有可用的上下文缓存时，首段文本换成只含答案的后缀并引用缓存名；缓存失效（400/403/404）时改发完整 payload。
+    stream=True 时返回未读取正文的响应，调用方负责 aclose()。data 为 answer_uploads.encode_json 预先序列化好的完整 payload（可选）。
+    """
+    timeout = _upstream_timeout(timeout)
+    client = _get_http_client("gemini")
+    headers = {"Content-Type": "application/json"}
+    http_timeout = httpx.Timeout(timeout, connect=min(10.0, timeout))
+    cached_name = await _resolve_gemini_context_cache(base_endpoint, model_name, key_idx, api_key, context_cache)
+    if cached_name:
+        parts = payload["contents"][0]["parts"]
+        cached_payload = {
+            "cachedContent": cached_name,
+            "contents": [{"role": "user", "parts": [{"text": context_cache["suffix"]}] + parts[1:]}],
+            "generationConfig": payload["generationConfig"],
+        }
+        cached_data = answer_uploads.encode_json(cached_payload)
+        req = client.build_request(
+            "POST", url, content=cached_data, headers=answer_uploads.content_headers(cached_data, headers), timeout=http_timeout
+        )
+        resp = await (client.send(req, stream=True) if stream else asyncio.wait_for(client.send(req), timeout + 1.0))
+        if resp.status_code not in _CONTEXT_CACHE_MISS_STATUS:
+            return resp
+        raw = (await resp.aread()).decode("utf-8", errors="replace")
+        await resp.aclose()
+        print(f"[上下文缓存] {cached_name} 不可用（{resp.status_code}），改发完整 prompt: {raw[:200]}")
+        gemini_context_cache.forget(key_idx, context_cache["id"])
+    if data is None:
+        data = answer_uploads.encode_json(payload)
+    timeout = _upstream_timeout(timeout)
+    req = client.build_request("POST", url, content=data, headers=answer_uploads.content_headers(data, headers), timeout=httpx.Timeout(timeout, connect=min(10.0, timeout)))
+    return await (client.send(req, stream=True) if stream else asyncio.wait_for(client.send(req), timeout + 1.0))
+
+
+def _build_gemini_image_parts(prompt: str, image_data_list: List[Any]) -> List[Dict[str, Any]]:
+    """把 prompt 文本与 data URL 列表转成 Gemini 多模态 parts 数组（解析失败的图片跳过；上传的图片放占位符，序列化时展开）。"""
     parts: List[Dict[str, Any]] = [{"text": prompt}]
     parsed_count = 0
     for i, data_url in enumerate(image_data_list):
+        if isinstance(data_url, answer_uploads.UploadedImage):
+            parsed_count += 1
+            parts.append({"inlineData": {"mimeType": data_url.mime, "data": data_url.base64_field()}})
+            continue
         mime, b64 = _parse_data_url(data_url)
         if not b64:
             print(f"[多模态] 第{i+1}张图片解析失败，data_url前50字符: {(data_url or '')[:50]}")
@@ -1078,82 +2436,133 @@ def call_gemini_system_with_images(
             }
         })
     print(f"[多模态] 共{len(image_data_list)}张图片, 成功解析{parsed_count}张")
+    return parts
+
+
+async def call_gemini_system_with_images(
+    prompt: str,
+    image_data_list: List[Any],
+    *,
+    temperature: float = 0.3,
+    top_p: float = 0.9,
+    context_cache: Optional[Dict[str, str]] = None,
+) -> Optional[str]:
+    """带图片的多模态调用 Gemini；优先主 Key，遇限流/配额用备用 Key 重试；Key 与上游的熔断见 circuit_breaker.py。"""
+    api_keys = _get_gemini_api_keys()
+    if not api_keys:
+        print("GEMINI not configured (GEMINI_API_KEY missing)")
+        return None
+    base_endpoint = os.getenv("GEMINI_ENDPOINT", "https://generativelanguage.googleapis.com")
+    model_name = "gemini-3-flash-preview"
+
+    parts = _build_gemini_image_parts(prompt, image_data_list)
     if len(parts) <= 1:
         print("[多模态] 所有图片解析失败，无法带图批改")
         return None
+    if not _gemini_breakers_allow():
+        print("Gemini 熔断中（多模态），当前请求直接跳过 Gemini。")
+        return None
 
     payload = {
         "contents": [{"role": "user", "parts": parts}],
         "generationConfig": {"temperature": temperature, "topP": top_p, "maxOutputTokens": 65536},
     }
-    data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    data = answer_uploads.encode_json(payload)
+    estimated_tokens = _estimate_prompt_tokens(prompt, len(parts) - 1)
     print(f"[多模态] Gemini 请求体大小: {len(data)} 字节 ({len(data)/1024/1024:.2f} MB)")
 
-    for idx, api_key in enumerate(api_keys):
+    tried: set = set()
+    while True:
+        idx = await _acquire_gemini_key(estimated_tokens, tried)
+        if idx is None:
+            circuit_breaker.release_probe("gemini")
+            break
+        tried.add(idx)
+        api_key = api_keys[idx]
+        key_breaker = _gemini_key_breaker(idx)
+        if not circuit_breaker.allow(key_breaker):
+            gemini_key_pool.release(idx, estimated_tokens)
+            print(f"Gemini Key#{idx} 熔断中，跳过")
+            continue
         url = base_endpoint.rstrip("/") + f"/v1beta/models/{model_name}:generateContent?key={api_key}"
-        req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+        started = time.monotonic()
+        status = None
+        used_tokens = 0         # 上游未返回 usageMetadata（报错、超时、无法解析）时按 0 结算，退回预扣的 token
         try:
-            with urllib.request.urlopen(req, timeout=90) as resp:
-                raw = resp.read().decode("utf-8")
-                if not raw or not raw.strip():
-                    print("Gemini API 返回空 body")
-                    continue
-                try:
-                    obj = json.loads(raw)
-                except Exception:
-                    return raw
-                err = obj.get("error")
-                if err:
-                    print("Gemini API 错误:", err)
-                    if _is_quota_or_rate_limit_error(None, err):
-                        if idx + 1 < len(api_keys):
-                            print("配额/限流，尝试备用 API Key")
-                            continue
-                        print("Gemini 所有 Key 多模态额度均已用完，进入冷却期。")
-                        _mark_gemini_quota_exhausted()
-                    return None
-                candidates = obj.get("candidates") or []
-                if not candidates:
-                    print("Gemini API 无 candidates")
-                    return None
-                first = candidates[0] or {}
-                content = first.get("content") or {}
-                texts = []
-                for p in content.get("parts") or []:
-                    if isinstance(p, dict) and "text" in p:
-                        texts.append(p["text"])
-                merged = "\n".join(texts).strip()
-                return merged if merged else None
-        except urllib.error.HTTPError as e:
-            print("call_gemini_system_with_images HTTPError:", e.code, e.reason)
-            if _is_quota_or_rate_limit_error(e.code, None):
-                if idx + 1 < len(api_keys):
-                    print("配额/限流，尝试备用 API Key")
-                    continue
-                print("Gemini 所有 Key 多模态 HTTP 限流/额度已用完，进入冷却期。")
-                _mark_gemini_quota_exhausted()
-            return None
+            resp = await _send_gemini_request(
+                url, payload, base_endpoint=base_endpoint, model_name=model_name, key_idx=idx, api_key=api_key,
+                context_cache=context_cache, timeout=90, data=data,
+            )
+            status, raw = resp.status_code, resp.text
+            _record_upstream_call("gemini", key_breaker, status, started)
+            if status >= 400:
+                print("call_gemini_system_with_images HTTPError:", status, raw[:200])
+                if _is_quota_or_rate_limit_error(status, None):
+                    if len(tried) < len(api_keys):
+                        print("配额/限流，尝试备用 API Key")
+                        continue
+                    print("Gemini 所有 Key 多模态 HTTP 限流/额度已用完，均已熔断，等待探测恢复。")
+                return None
+            if not raw or not raw.strip():
+                print("Gemini API 返回空 body")
+                continue
+            try:
+                obj = json.loads(raw)
+            except Exception:
+                return raw
+            usage = obj.get("usageMetadata") or {}
+            used_tokens = int(usage.get("promptTokenCount") or 0)
+            prompt_budget.note_actual(estimated_tokens, used_tokens)
+            err = obj.get("error")
+            if err:
+                print("Gemini API 错误:", err)
+                if _is_quota_or_rate_limit_error(None, err):
+                    circuit_breaker.record_quota(key_breaker, time.monotonic() - started)
+                    if len(tried) < len(api_keys):
+                        print("配额/限流，尝试备用 API Key")
+                        continue
+                    print("Gemini 所有 Key 多模态额度均已用完，均已熔断，等待探测恢复。")
+                return None
+            candidates = obj.get("candidates") or []
+            if not candidates:
+                print("Gemini API 无 candidates")
+                return None
+            first = candidates[0] or {}
+            content = first.get("content") or {}
+            texts = []
+            for p in content.get("parts") or []:
+                if isinstance(p, dict) and "text" in p:
+                    texts.append(p["text"])
+            merged = "\n".join(texts).strip()
+            return merged if merged else None
         except Exception as e:
+            if status is None and not isinstance(e, _DeadlineExceeded):
+                _record_upstream_call("gemini", key_breaker, None, started)
             print("call_gemini_system_with_images failed:", e)
             return None
+        finally:
+            if status is None:      # 请求未发出（超过截止时间、被取消）；已回报结果时熔断器不在半开，归还为空操作
+                circuit_breaker.release_probe(key_breaker)
+                circuit_breaker.release_probe("gemini")
+            gemini_key_pool.settle(idx, estimated_tokens, used_tokens)
     return None
 
 
-def call_gemini_system(
+async def call_gemini_system(
     prompt: str,
     *,
     temperature: float = 0.3,
     top_p: float = 0.9,
+    context_cache: Optional[Dict[str, str]] = None,
 ) -> Optional[str]:
-    """调用 Google Gemini 接口；优先主 Key，遇限流/配额用备用 Key 重试；若所有 Key 都额度用完，则进入冷却期。"""
-    if _is_gemini_temporarily_disabled():
-        print("Gemini 已标记为额度用完（纯文本），当前请求直接跳过 Gemini。")
-        return None
-
+    """调用 Google Gemini 接口；优先主 Key，遇限流/配额用备用 Key 重试；Key 与上游的熔断见 circuit_breaker.py。"""
     api_keys = _get_gemini_api_keys()
     if not api_keys:
         print("GEMINI not configured (GEMINI_API_KEY missing)")
         return None
+    if not _gemini_breakers_allow():
+        print("Gemini 熔断中（纯文本），当前请求直接跳过 Gemini。")
+        return None
     base_endpoint = os.getenv("GEMINI_ENDPOINT", "https://generativelanguage.googleapis.com")
     model_name = "gemini-3-flash-preview"
 
@@ -1171,66 +2580,285 @@ def call_gemini_system(
         },
     }
     data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-
-    for idx, api_key in enumerate(api_keys):
+    estimated_tokens = _estimate_prompt_tokens(prompt)
+
+    tried: set = set()
+    while True:
+        idx = await _acquire_gemini_key(estimated_tokens, tried)
+        if idx is None:
+            circuit_breaker.release_probe("gemini")
+            break
+        tried.add(idx)
+        api_key = api_keys[idx]
+        key_breaker = _gemini_key_breaker(idx)
+        if not circuit_breaker.allow(key_breaker):
+            gemini_key_pool.release(idx, estimated_tokens)
+            print(f"Gemini Key#{idx} 熔断中，跳过")
+            continue
         url = base_endpoint.rstrip("/") + f"/v1beta/models/{model_name}:generateContent?key={api_key}"
-        req = urllib.request.Request(
-            url,
-            data=data,
-            headers={"Content-Type": "application/json"},
-        )
+        started = time.monotonic()
+        status = None
+        used_tokens = 0         # 上游未返回 usageMetadata（报错、超时、无法解析）时按 0 结算，退回预扣的 token
         try:
-            with urllib.request.urlopen(req, timeout=60) as resp:
-                raw = resp.read().decode("utf-8")
-                if not raw or not raw.strip():
-                    print("Gemini API 返回空 body")
-                    continue
-                try:
-                    obj = json.loads(raw)
-                except Exception:
-                    return raw
-                err = obj.get("error")
-                if err:
-                    print("Gemini API 错误:", err)
-                    if _is_quota_or_rate_limit_error(None, err):
-                        if idx + 1 < len(api_keys):
-                            print("配额/限流，尝试备用 API Key")
-                            continue
-                        print("Gemini 所有 Key 文本额度均已用完，进入冷却期。")
-                        _mark_gemini_quota_exhausted()
-                    return None
-                candidates = obj.get("candidates") or []
-                if not candidates:
-                    print("Gemini API 无 candidates，原始响应:", raw[:500])
-                    return None
-                first = candidates[0] or {}
-                content = first.get("content") or {}
-                parts = content.get("parts") or []
-                texts = []
-                for p in parts:
-                    if isinstance(p, dict) and "text" in p:
-                        texts.append(p["text"])
-                merged = "\n".join(texts).strip()
-                if not merged:
-                    print("Gemini 候选内容无文本，可能被安全过滤。finishReason:", first.get("finishReason"))
-                    return None
-                return merged
-        except urllib.error.HTTPError as e:
-            print("call_gemini_system HTTPError:", e.code, e.reason)
-            if _is_quota_or_rate_limit_error(e.code, None):
-                if idx + 1 < len(api_keys):
-                    print("配额/限流，尝试备用 API Key")
-                    continue
-                print("Gemini 所有 Key 文本 HTTP 限流/额度已用完，进入冷却期。")
-                _mark_gemini_quota_exhausted()
-            return None
+            resp = await _send_gemini_request(
+                url, payload, base_endpoint=base_endpoint, model_name=model_name, key_idx=idx, api_key=api_key,
+                context_cache=context_cache, timeout=60, data=data,
+            )
+            status, raw = resp.status_code, resp.text
+            _record_upstream_call("gemini", key_breaker, status, started)
+            if status >= 400:
+                print("call_gemini_system HTTPError:", status, raw[:200])
+                if _is_quota_or_rate_limit_error(status, None):
+                    if len(tried) < len(api_keys):
+                        print("配额/限流，尝试备用 API Key")
+                        continue
+                    print("Gemini 所有 Key 文本 HTTP 限流/额度已用完，均已熔断，等待探测恢复。")
+                return None
+            if not raw or not raw.strip():
+                print("Gemini API 返回空 body")
+                continue
+            try:
+                obj = json.loads(raw)
+            except Exception:
+                return raw
+            usage = obj.get("usageMetadata") or {}
+            used_tokens = int(usage.get("promptTokenCount") or 0)
+            prompt_budget.note_actual(estimated_tokens, used_tokens)
+            err = obj.get("error")
+            if err:
+                print("Gemini API 错误:", err)
+                if _is_quota_or_rate_limit_error(None, err):
+                    circuit_breaker.record_quota(key_breaker, time.monotonic() - started)
+                    if len(tried) < len(api_keys):
+                        print("配额/限流，尝试备用 API Key")
+                        continue
+                    print("Gemini 所有 Key 文本额度均已用完，均已熔断，等待探测恢复。")
+                return None
+            candidates = obj.get("candidates") or []
+            if not candidates:
+                print("Gemini API 无 candidates，原始响应:", raw[:500])
+                return None
+            first = candidates[0] or {}
+            content = first.get("content") or {}
+            parts = content.get("parts") or []
+            texts = []
+            for p in parts:
+                if isinstance(p, dict) and "text" in p:
+                    texts.append(p["text"])
+            merged = "\n".join(texts).strip()
+            if not merged:
+                print("Gemini 候选内容无文本，可能被安全过滤。finishReason:", first.get("finishReason"))
+                return None
+            return merged
         except Exception as e:
+            if status is None and not isinstance(e, _DeadlineExceeded):
+                _record_upstream_call("gemini", key_breaker, None, started)
             print("call_gemini_system failed:", e)
             return None
+        finally:
+            if status is None:      # 请求未发出（超过截止时间、被取消）；已回报结果时熔断器不在半开，归还为空操作
+                circuit_breaker.release_probe(key_breaker)
+                circuit_breaker.release_probe("gemini")
+            gemini_key_pool.settle(idx, estimated_tokens, used_tokens)
     return None
 
 
+# ---------------------------------------------------------
+# 流式调用：Gemini streamGenerateContent（alt=sse）与钱多多 stream=true，逐段产出文本
+# ---------------------------------------------------------
+async def _iter_sse_data(resp: httpx.Response) -> AsyncIterator[str]:
+    """逐条读取上游 SSE 响应中的 data 字段。"""
+    async for line in resp.aiter_lines():
+        if line.startswith("data:"):
+            yield line[5:].strip()
+
+
+async def stream_gemini_system(
+    prompt: str,
+    image_data_list: Optional[List[Any]] = None,
+    *,
+    temperature: float = 0.3,
+    top_p: float = 0.9,
+    context_cache: Optional[Dict[str, str]] = None,
+) -> AsyncIterator[str]:
+    """流式调用 Gemini（可带图片），逐段产出文本；Key 切换规则与 call_gemini_system 一致，仅在首段输出前切换。"""
+    api_keys = _get_gemini_api_keys()
+    if not api_keys:
+        print("GEMINI not configured (GEMINI_API_KEY missing)")
+        return
+    base_endpoint = os.getenv("GEMINI_ENDPOINT", "https://generativelanguage.googleapis.com")
+    model_name = "gemini-3-flash-preview"
+
+    if image_data_list:
+        parts = _build_gemini_image_parts(prompt, image_data_list)
+        if len(parts) <= 1:
+            print("[多模态] 所有图片解析失败，无法带图批改")
+            return
+    else:
+        parts = [{"text": prompt}]
+    payload = {
+        "contents": [{"role": "user", "parts": parts}],
+        "generationConfig": {"temperature": temperature, "topP": top_p, "maxOutputTokens": 65536},
+    }
+    data = answer_uploads.encode_json(payload)
+    estimated_tokens = _estimate_prompt_tokens(prompt, len(parts) - 1)
+    timeout = 90 if image_data_list else 60
+    if not _gemini_breakers_allow():
+        print("Gemini 熔断中（流式），当前请求直接跳过 Gemini。")
+        return
+
+    tried: set = set()
+    while True:
+        idx = await _acquire_gemini_key(estimated_tokens, tried)
+        if idx is None:
+            circuit_breaker.release_probe("gemini")
+            break
+        tried.add(idx)
+        api_key = api_keys[idx]
+        key_breaker = _gemini_key_breaker(idx)
+        if not circuit_breaker.allow(key_breaker):
+            gemini_key_pool.release(idx, estimated_tokens)
+            print(f"Gemini Key#{idx} 熔断中，跳过")
+            continue
+        url = base_endpoint.rstrip("/") + f"/v1beta/models/{model_name}:streamGenerateContent?alt=sse&key={api_key}"
+        started = time.monotonic()
+        status = None
+        used_tokens = 0         # 上游未返回 usageMetadata（报错、超时、无法解析）时按 0 结算，退回预扣的 token
+        try:
+            resp = await _send_gemini_request(
+                url, payload, base_endpoint=base_endpoint, model_name=model_name, key_idx=idx, api_key=api_key,
+                context_cache=context_cache, timeout=timeout, stream=True, data=data,
+            )
+            try:
+                status = resp.status_code
+                _record_upstream_call("gemini", key_breaker, status, started)
+                if resp.status_code >= 400:
+                    raw = (await resp.aread()).decode("utf-8", errors="replace")
+                    print("stream_gemini_system HTTPError:", resp.status_code, raw[:200])
+                    if _is_quota_or_rate_limit_error(resp.status_code, None):
+                        if len(tried) < len(api_keys):
+                            print("配额/限流，尝试备用 API Key")
+                            continue
+                        print("Gemini 所有 Key 流式 HTTP 限流/额度已用完，均已熔断，等待探测恢复。")
+                    return
+                async for item in _iter_sse_data(resp):
+                    try:
+                        obj = json.loads(item)
+                    except Exception:
+                        continue
+                    usage = obj.get("usageMetadata") or {}
+                    used_tokens = int(usage.get("promptTokenCount") or 0) or used_tokens
+                    err = obj.get("error")
+                    if err:
+                        print("Gemini 流式 API 错误:", err)
+                        return
+                    for cand in (obj.get("candidates") or [])[:1]:
+                        for p in ((cand or {}).get("content") or {}).get("parts") or []:
+                            if isinstance(p, dict) and p.get("text"):
+                                yield p["text"]
+                return
+            finally:
+                await resp.aclose()
+        except Exception as e:
+            if status is None and not isinstance(e, _DeadlineExceeded):
+                _record_upstream_call("gemini", key_breaker, None, started)
+            print("stream_gemini_system failed:", e)
+            return
+        finally:
+            if status is None:      # 请求未发出（超过截止时间、被取消）；已回报结果时熔断器不在半开，归还为空操作
+                circuit_breaker.release_probe(key_breaker)
+                circuit_breaker.release_probe("gemini")
+            gemini_key_pool.settle(idx, estimated_tokens, used_tokens)
+            prompt_budget.note_actual(estimated_tokens, used_tokens)
+
+
+async def stream_qianduoduo_gemini(
+    prompt: str,
+    image_data_list: Optional[List[Any]] = None,
+    *,
+    temperature: float = 0.3,
+    top_p: float = 0.9,
+) -> AsyncIterator[str]:
+    """流式调用钱多多（OpenAI 兼容 stream=true），逐段产出 delta.content。"""
+    api_key = (os.getenv("QIANDUODUO_API_KEY") or "").strip()
+    base_endpoint = (os.getenv("QIANDUODUO_ENDPOINT") or "").strip().rstrip("/")
+    if not api_key or not base_endpoint:
+        print("钱多多未配置 (QIANDUODUO_API_KEY / QIANDUODUO_ENDPOINT 缺失)")
+        return
+    model_name = (os.getenv("QIANDUODUO_MODEL") or "gemini-2.5-flash").strip()
+
+    if image_data_list:
+        content = _build_openai_content_parts(prompt, image_data_list)
+        if len(content) <= 1:
+            return
+    else:
+        content = prompt
+    payload = {
+        "model": model_name,
+        "messages": [{"role": "user", "content": content}],
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_tokens": 65536,
+        "stream": True,
+    }
+    data = answer_uploads.encode_json(payload)
+    headers = answer_uploads.content_headers(data, {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    })
+    try:
+        timeout = _upstream_timeout(120.0)
+    except _DeadlineExceeded as e:
+        print("stream_qianduoduo_gemini skipped:", e)
+        return
+    if not circuit_breaker.allow("qianduoduo"):
+        print("钱多多熔断中（流式），当前请求直接跳过。")
+        return
+    client = _get_http_client("qianduoduo")
+    started = time.monotonic()
+    status = None
+    try:
+        async with client.stream(
+            "POST",
+            base_endpoint + "/v1/chat/completions",
+            content=data,
+            headers=headers,
+            timeout=httpx.Timeout(timeout, connect=min(10.0, timeout)),
+        ) as resp:
+            status = resp.status_code
+            _record_upstream_call("qianduoduo", None, status, started)
+            if resp.status_code >= 400:
+                raw = (await resp.aread()).decode("utf-8", errors="replace")
+                print("stream_qianduoduo_gemini HTTPError:", resp.status_code, raw[:200])
+                return
+            async for item in _iter_sse_data(resp):
+                if item == "[DONE]":
+                    return
+                try:
+                    obj = json.loads(item)
+                except Exception:
+                    continue
+                if obj.get("error"):
+                    print("钱多多流式 API 错误:", obj.get("error"))
+                    return
+                for choice in (obj.get("choices") or [])[:1]:
+                    text = ((choice or {}).get("delta") or {}).get("content")
+                    if text:
+                        yield text
+    except Exception as e:
+        if status is None and not isinstance(e, _DeadlineExceeded):
+            _record_upstream_call("qianduoduo", None, None, started)
+        print("stream_qianduoduo_gemini failed:", e)
+    finally:
+        if status is None:          # 请求未发出（超过截止时间、被取消）：归还可能占用的半开探测名额
+            circuit_breaker.release_probe("qianduoduo")
+
+
 # 题目 Markdown 中的图片路径为 /images/...，放在所有 API 路由之后挂载
 _images_dir = os.path.join(get_data_dir(), "images")
 if os.path.isdir(_images_dir):
-    app.mount("/images", StaticFiles(directory=_images_dir), name="images")
\ No newline at end of file
+    _images_started = time.perf_counter()
+    app.mount("/images", precompress.PrecompressedStaticFiles(directory=_images_dir), name="images")
+    # 挂载时逐个压缩图片目录下的文件（按最高质量），图片多时会明显拖慢启动
+    _startup_stats["images_precompress_ms"] = round((time.perf_counter() - _images_started) * 1000, 1)
+    print(f"[Startup] /images 预压缩耗时 {_startup_stats['images_precompress_ms']}ms")
\ No newline at end of file
@@ -0,0 +1,358 @@
+"""
+试卷存储：索引常驻内存，试卷内容按内存预算懒加载、按最近最少使用淘汰。
+
+每份试卷在内存中有三种形态，按需生成、分别计入预算：
+- json：/api/paper 的响应字节（预序列化）及其预压缩版本（见 precompress.py）
+- paper：解析后的 dict，批改时才需要，由 json 字节解析
+- prefixes：该卷各题预拼好的 prompt 前缀，批改时才需要，由 paper 生成（生成函数由 main 传入）
+超出 PAPERS_MEMORY_BUDGET_MB 时按最近最少使用整份淘汰（刚访问的那份即使单独超出预算也保留），
+被淘汰的试卷下次访问时从 data 目录重新读取。
+目录监视（见 paper_watcher.py）发现的增删改经 apply_changes 增量更新，运行期间索引即为全部试卷。
+
+预算为 0（默认）时不淘汰：启动时经快照（见 papers_snapshot.py）全部加载，行为与全量常驻相同。
+预算大于 0 时启动只建索引（只读快照头部；快照过期的试卷读入后按预算留作热数据），适合多 worker 的小实例——
+每个 uvicorn worker 各有一份存储，预算按单个 worker 计。
+
+环境变量：
+  PAPERS_MEMORY_BUDGET_MB  - 每个 worker 试卷内容的内存预算（MB），默认 0（不限，全部常驻）
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import papers_snapshot
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_BUDGET_BYTES = int(float(os.getenv("PAPERS_MEMORY_BUDGET_MB") or 0) * 1024 * 1024)
+
+_lock = threading.Lock()
+_data_dir = ""
+_prefix_builder: Optional[Callable[[Dict[str, Any]], Dict[tuple, Dict[str, Any]]]] = None
+_index: Dict[str, Dict[str, Any]] = {}     # pid -> {"file", "sig", "mtime", "meta", "etag", "encodings"}（常驻）
+_resident: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()   # pid -> {"json", "encoded", "paper", "prefixes", "size"}
+_resident_bytes = 0
+_index_complete = False     # 目录监视运行中时索引即为全部试卷，不在索引中的 id 不再去磁盘查找（见 paper_watcher.py）
+_SAFE_ID = re.compile(r"[A-Za-z0-9_-]{1,128}")     # 不在索引中的 id 拼成文件名前须满足（不含路径分隔符与 ..）
+_counters = {
+    "hits": 0,
+    "misses": 0,
+    "disk_loads": 0,
+    "parses": 0,
+    "prefix_builds": 0,
+    "evictions": 0,
+    "evicted_bytes": 0,
+}
+
+
+def _meta(pid: str, content: Dict[str, Any]) -> Dict[str, Any]:
+    """索引条目（/api/list 的一项）。"""
+    return {
+        "id": pid,
+        "name": content.get("name", "未命名试卷"),
+        "year": content.get("year", 2024),
+        "region": content.get("region", "全国"),
+        "examType": content.get("examType", "公务员"),
+    }
+
+
+def _size(item: Dict[str, Any]) -> int:
+    """估算一份试卷常驻形态的内存：响应字节及压缩版本 + 解析后的 dict（约等于 JSON 长度）+ 前缀正文（说明部分各题共用，不计）。"""
+    n = len(item["json"]) + sum(len(v) for v in item["encoded"].values())
+    if item.get("paper") is not None:
+        n += len(item["json"])
+    for prefix in (item.get("prefixes") or {}).values():
+        n += sys.getsizeof(prefix["body"])
+    return n
+
+
+def _put_locked(pid: str, item: Dict[str, Any]):
+    global _resident_bytes
+    old = _resident.pop(pid, None)
+    if old is not None:
+        _resident_bytes -= old["size"]
+    item["size"] = _size(item)
+    _resident[pid] = item
+    _resident_bytes += item["size"]
+    _evict_locked()
+
+
+def _drop_locked(pid: str):
+    global _resident_bytes
+    item = _resident.pop(pid, None)
+    if item is not None:
+        _resident_bytes -= item["size"]
+
+
+def _evict_locked():
+    global _resident_bytes
+    if not _BUDGET_BYTES:
+        return
+    while _resident_bytes > _BUDGET_BYTES and len(_resident) > 1:
+        _, item = _resident.popitem(last=False)
+        _resident_bytes -= item["size"]
+        _counters["evictions"] += 1
+        _counters["evicted_bytes"] += item["size"]
+
+
+def _index_entry(name: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+    if "meta" not in entry:
+        entry["meta"] = _meta(entry["pid"], entry["content"])
+    info = {k: entry[k] for k in ("sig", "mtime", "meta", "etag", "encodings")}
+    info["file"] = name
+    return info
+
+
+def _load_from_disk(pid: str) -> Optional[Dict[str, Any]]:
+    """未常驻的试卷从 data 目录读入，返回常驻形态（不含前缀）。
+
+    已在索引中的试卷同时更新其索引条目；不在索引中的 id 须通过 valid_id 才按「{pid}.json」查找，读到也不加入索引
+    （索引只由启动加载与目录监视维护，请求中的 id 不会进入 /api/list）。
+    """
+    info = _index.get(pid)
+    if info is None and (_index_complete or not valid_id(pid)):
+        return None
+    name = info["file"] if info else f"{pid}.json"
+    if not os.path.isfile(os.path.join(_data_dir, name)):
+        return None
+    entry = papers_snapshot.load_file(_data_dir, name)
+    if entry is None:
+        return None
+    with _lock:
+        _counters["disk_loads"] += 1
+        if info is not None:
+            _index[entry["pid"]] = _index_entry(name, entry)
+    return {"json": entry["json"], "encoded": entry["encoded"], "paper": entry["content"], "prefixes": None, "mtime": entry["mtime"]}
+
+
+def _get(pid: str, need_paper: bool, need_prefixes: bool) -> Optional[Dict[str, Any]]:
+    """取常驻形态，按需补齐 paper / prefixes 并计入预算；试卷不存在时返回 None。"""
+    with _lock:
+        item = _resident.get(pid)
+        if item is not None:
+            _resident.move_to_end(pid)
+            _counters["hits"] += 1
+            if (not need_paper or item["paper"] is not None) and (not need_prefixes or item["prefixes"] is not None):
+                return item
+        else:
+            _counters["misses"] += 1
+    if item is None:
+        item = _load_from_disk(pid)
+        if item is None:
+            return None
+        if not need_paper and not need_prefixes:
+            item["paper"] = None
+    else:
+        item = dict(item)
+    if (need_paper or need_prefixes) and item["paper"] is None:
+        item["paper"] = json.loads(item["json"])
+        with _lock:
+            _counters["parses"] += 1
+    if need_prefixes and item["prefixes"] is None:
+        item["prefixes"] = _prefix_builder(item["paper"])
+        with _lock:
+            _counters["prefix_builds"] += 1
+    with _lock:
+        current = _resident.get(pid)
+        if current is not None and current["json"] is item["json"] and (
+            (current["paper"] is not None) >= (item["paper"] is not None)
+            and (current["prefixes"] is not None) >= (item["prefixes"] is not None)
+        ):
+            return current     # 并发请求已补齐
+        _put_locked(pid, item)
+    return item
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def load(
+    data_dir: str,
+    prefix_builder: Callable[[Dict[str, Any]], Dict[tuple, Dict[str, Any]]],
+    prefix_fingerprint: str,
+) -> Dict[str, Any]:
+    """启动时建立索引（预算为 0 时同时全部常驻），返回 {"rebuilt": 本次重建前缀的试卷数}。"""
+    global _data_dir, _prefix_builder, _index, _resident, _resident_bytes
+    full = not _BUDGET_BYTES
+    entries, dirty = papers_snapshot.load(data_dir, prefix_fingerprint, full=full)
+    index: Dict[str, Dict[str, Any]] = {}
+    resident: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    rebuilt = 0
+    for name, entry in entries.items():
+        pid = entry["pid"]
+        index[pid] = _index_entry(name, entry)
+        if "json" not in entry:
+            continue
+        if full and "prefixes" not in entry:
+            entry["prefixes"] = prefix_builder(entry["content"])
+            rebuilt += 1
+        item = {
+            "json": entry["json"],
+            "encoded": entry["encoded"],
+            "paper": entry["content"],
+            "prefixes": entry.get("prefixes"),
+        }
+        item["size"] = _size(item)
+        resident[pid] = item
+    if dirty and full:
+        papers_snapshot.write(entries, prefix_fingerprint)
+    elif dirty and entries:
+        print("[Startup] 试卷快照已过期（懒加载模式不重写），可运行 python scripts/build_papers_snapshot.py 更新")
+    with _lock:
+        _data_dir = data_dir
+        _prefix_builder = prefix_builder
+        _index = index
+        _resident = resident
+        _resident_bytes = sum(item["size"] for item in resident.values())
+        _evict_locked()
+    return {"rebuilt": rebuilt}
+
+
+def index_entries() -> List[Dict[str, Any]]:
+    with _lock:
+        return [dict(info["meta"]) for info in _index.values()]
+
+
+def count() -> int:
+    return len(_index)
+
+
+def mtime(pid: str) -> Optional[float]:
+    info = _index.get(pid)
+    return info["mtime"] if info else None
+
+
+def validator(pid: str) -> Optional[Dict[str, Any]]:
+    """条件请求用的校验信息 {"etag": 响应字节的 sha256 强 ETag, "mtime": 文件 mtime, "encodings": 有预压缩版本的编码}，
+    只查常驻的索引，不读试卷内容；试卷不存在时返回 None。"""
+    info = _index.get(pid)
+    return {"etag": info["etag"], "mtime": info["mtime"], "encodings": info["encodings"]} if info else None
+
+
+def get_json(pid: str) -> Optional[Tuple[bytes, Dict[str, bytes]]]:
+    """/api/paper 的响应字节及其预压缩版本 {编码: 字节}。"""
+    item = _get(pid, need_paper=False, need_prefixes=False)
+    return (item["json"], item["encoded"]) if item else None
+
+
+def get_paper(pid: str) -> Optional[Dict[str, Any]]:
+    """解析后的试卷（调用方不得修改）。"""
+    item = _get(pid, need_paper=True, need_prefixes=False)
+    return item["paper"] if item else None
+
+
+def get_prefix(pid: str, qid: str) -> Optional[Dict[str, Any]]:
+    """某题预拼好的 prompt 前缀（见 main._build_paper_prompt_prefixes）。"""
+    item = _get(pid, need_paper=True, need_prefixes=True)
+    return item["prefixes"].get((pid, qid)) if item else None
+
+
+def is_current(paper: Dict[str, Any]) -> bool:
+    """paper 是否为存储中该卷当前的解析结果（而非前端传来的内联试卷或已过期的旧版本）。"""
+    with _lock:
+        item = _resident.get(paper.get("id"))
+        return item is not None and item["paper"] is paper
+
+
+def refresh_if_stale(pid: str):
+    """磁盘上的试卷比存储中新时重新读入（改 data 后无需重启后端）；新文件（{pid}.json）同样读入，但不加入索引。"""
+    info = _index.get(pid)
+    if info is None and not valid_id(pid):
+        return
+    path = os.path.join(_data_dir, info["file"] if info else f"{pid}.json")
+    try:
+        current = os.path.getmtime(path)
+    except OSError:
+        return
+    if info is not None:
+        known = info["mtime"]
+    else:
+        with _lock:
+            known = (_resident.get(pid) or {}).get("mtime")
+    if known is not None and current <= known:
+        return
+    item = _load_from_disk(pid)
+    if item is None:
+        print(f"[试卷缓存] 刷新失败 {path}")
+        return
+    with _lock:
+        _put_locked(pid, item)
+
+
+def valid_id(pid: Any) -> bool:
+    """id 能否安全地拼成 data 目录下的文件名（字母、数字、下划线与连字符）。"""
+    return isinstance(pid, str) and _SAFE_ID.fullmatch(pid) is not None
+
+
+def set_index_complete(complete: bool):
+    global _index_complete
+    _index_complete = complete
+
+
+def file_sigs() -> Dict[str, tuple]:
+    """索引中每个文件的签名 {文件名: (大小, mtime_ns)}。"""
+    with _lock:
+        return {info["file"]: info["sig"] for info in _index.values()}
+
+
+def apply_changes(filenames: Iterable[str]) -> Dict[str, int]:
+    """重新检查这些文件：新增 / 修改的读入后替换索引条目与常驻内容（前缀在下次批改时重建），已删除的移出。
+    新索引先在副本上改好再整体替换，读取方不会看到改了一半的索引。返回 {"added", "changed", "removed"} 数量。"""
+    global _index
+    with _lock:
+        by_file = {info["file"]: pid for pid, info in _index.items()}
+    loaded: Dict[str, Dict[str, Any]] = {}
+    removed = []
+    for name in filenames:
+        pid = by_file.get(name)
+        try:
+            st = os.stat(os.path.join(_data_dir, name))
+        except FileNotFoundError:
+            if pid is not None:
+                removed.append(pid)
+            continue
+        if pid is not None and _index[pid]["sig"] == (st.st_size, st.st_mtime_ns):
+            continue
+        entry = papers_snapshot.load_file(_data_dir, name)
+        if entry is not None:       # 读到半写的文件时跳过，等下一次事件
+            loaded[name] = entry
+    result = {"added": 0, "changed": 0, "removed": 0}
+    if not loaded and not removed:
+        return result
+    with _lock:
+        index = dict(_index)
+        for pid in removed:
+            index.pop(pid, None)
+            _drop_locked(pid)
+            result["removed"] += 1
+        for name, entry in loaded.items():
+            old_pid = by_file.get(name)
+            if old_pid is not None and old_pid != entry["pid"]:     # 文件内的 id 被改掉
+                index.pop(old_pid, None)
+                _drop_locked(old_pid)
+            result["changed" if old_pid is not None else "added"] += 1
+            index[entry["pid"]] = _index_entry(name, entry)
+            _put_locked(entry["pid"], {
+                "json": entry["json"], "encoded": entry["encoded"], "paper": entry["content"], "prefixes": None,
+            })
+        _index = index
+    return result
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        forms = {"json": 0, "paper": 0, "prefixes": 0}
+        for item in _resident.values():
+            forms["json"] += 1
+            forms["paper"] += item["paper"] is not None
+            forms["prefixes"] += item["prefixes"] is not None
+        return dict(
+            _counters,
+            budget_bytes=_BUDGET_BYTES or None,
+            resident_bytes=_resident_bytes,
+            papers=len(_index),
+            resident=forms,
+            index_complete=_index_complete,
+        )
@@ -0,0 +1,159 @@
+"""
+试卷目录监视：后台线程监视 data 目录下 *.json 的新增、修改与删除，只重新加载变化的试卷，
+由调用方（main._on_papers_changed）据此重建并整体替换 /api/list 的索引字节与 ETag。
+监视运行期间试卷以内存中的索引为准，/api/paper 与 /api/grade 的请求路径不再逐次 stat 试卷文件。
+
+- inotify：使用 watchfiles（uvicorn[standard] 自带；Linux 上为 inotify，macOS 为 FSEvents），
+  同一批改动在 PAPERS_WATCH_DEBOUNCE_MS 内合并为一次重建
+- 轮询：未安装 watchfiles、监视启动失败（如 inotify 句柄数达到上限）或 PAPERS_WATCH=poll 时，
+  每 PAPERS_WATCH_POLL_SECONDS 秒扫描一次目录，按文件大小与 mtime_ns 对比索引
+- 监视启动后先按轮询方式对账一次，补上启动加载与开始监视之间的改动
+- 只看 data 目录顶层的 *.json（images 子目录与编辑器临时文件不处理）；读到半写的文件时跳过，等下一次事件重试
+
+环境变量：
+  PAPERS_WATCH                - auto（默认，优先 inotify）、poll（只轮询）或 off（关闭，回到每次请求检查文件 mtime）
+  PAPERS_WATCH_POLL_SECONDS   - 轮询间隔秒数，默认 5
+  PAPERS_WATCH_DEBOUNCE_MS    - inotify 事件合并窗口毫秒数，默认 500
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import papers_snapshot
+
+try:
+    import watchfiles
+except ImportError:  # watchfiles 为可选依赖，未安装时轮询
+    watchfiles = None
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_MODE = (os.getenv("PAPERS_WATCH") or "auto").strip().lower()
+_POLL_SECONDS = max(0.1, float(os.getenv("PAPERS_WATCH_POLL_SECONDS") or 5))
+_DEBOUNCE_MS = int(os.getenv("PAPERS_WATCH_DEBOUNCE_MS") or 500)
+
+_lock = threading.Lock()
+_thread: Optional[threading.Thread] = None
+_stop = threading.Event()
+_active_mode: Optional[str] = None      # 实际使用的方式：inotify / poll；未运行时为 None
+_counters: Dict[str, Any] = {
+    "events": 0,
+    "scans": 0,
+    "reindexes": 0,
+    "files": 0,
+    "errors": 0,
+    "last_reindex_ms": None,
+    "last_reindex_at": None,
+}
+
+
+def _apply(on_change: Callable[[Iterable[str]], Dict[str, int]], names: Iterable[str]):
+    names = sorted(set(names))
+    if not names:
+        return
+    started = time.perf_counter()
+    try:
+        result = on_change(names)
+    except Exception as e:
+        with _lock:
+            _counters["errors"] += 1
+        print(f"[试卷监视] 重建索引失败: {e}")
+        return
+    if not any(result.values()):
+        return
+    with _lock:
+        _counters["reindexes"] += 1
+        _counters["files"] += len(names)
+        _counters["last_reindex_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        _counters["last_reindex_at"] = time.time()
+    print(f"[试卷监视] {', '.join(f'{k} {v}' for k, v in result.items())}（{_counters['last_reindex_ms']}ms）")
+
+
+def _reconcile(data_dir: str, file_sigs: Callable[[], Dict[str, tuple]], on_change):
+    """扫描目录，与索引中的文件签名对比，把新增 / 修改 / 删除的文件交给 on_change。"""
+    try:
+        files = papers_snapshot.scan(data_dir)
+    except OSError as e:
+        with _lock:
+            _counters["errors"] += 1
+        print(f"[试卷监视] 扫描失败: {e}")
+        return
+    known = file_sigs()
+    with _lock:
+        _counters["scans"] += 1
+    changed = [name for name, (sig, _) in files.items() if known.get(name) != sig]
+    changed.extend(name for name in known if name not in files)
+    _apply(on_change, changed)
+
+
+def _run_inotify(data_dir: str, on_change) -> bool:
+    """返回 False 表示 watchfiles 无法启动，需改为轮询。"""
+    try:
+        for changes in watchfiles.watch(
+            data_dir, stop_event=_stop, debounce=_DEBOUNCE_MS, recursive=False, raise_interrupt=False
+        ):
+            names = {
+                os.path.basename(path) for _, path in changes
+                if path.endswith(".json") and os.path.dirname(os.path.abspath(path)) == os.path.abspath(data_dir)
+            }
+            with _lock:
+                _counters["events"] += len(changes)
+            _apply(on_change, names)
+    except Exception as e:
+        if _stop.is_set():
+            return True
+        with _lock:
+            _counters["errors"] += 1
+        print(f"[试卷监视] inotify 监视失败，改为轮询: {e}")
+        return False
+    return True
+
+
+def _run(data_dir: str, file_sigs, on_change):
+    global _active_mode
+    _reconcile(data_dir, file_sigs, on_change)
+    if _MODE != "poll" and watchfiles is not None:
+        _active_mode = "inotify"
+        if _run_inotify(data_dir, on_change):
+            return
+    _active_mode = "poll"
+    while not _stop.wait(_POLL_SECONDS):
+        _reconcile(data_dir, file_sigs, on_change)
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def start(
+    data_dir: str,
+    file_sigs: Callable[[], Dict[str, tuple]],
+    on_change: Callable[[Iterable[str]], Dict[str, int]],
+) -> bool:
+    """启动后台监视线程；PAPERS_WATCH=off 或已在运行时返回 False。
+
+    file_sigs 返回索引中 {文件名: (大小, mtime_ns)}；on_change 收到变化的文件名列表，重新加载后返回各类变化的数量。"""
+    global _thread
+    if _MODE == "off" or (_thread is not None and _thread.is_alive()):
+        return False
+    _stop.clear()
+    _thread = threading.Thread(target=_run, args=(data_dir, file_sigs, on_change), name="paper-watcher", daemon=True)
+    _thread.start()
+    return True
+
+
+def stop():
+    global _thread, _active_mode
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+    _thread = None
+    _active_mode = None
+
+
+def active() -> bool:
+    """监视是否在运行（运行时请求路径不再检查试卷文件）。"""
+    return _thread is not None and _thread.is_alive()
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        return dict(_counters, mode=_active_mode, configured=_MODE, poll_seconds=_POLL_SECONDS)
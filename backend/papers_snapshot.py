@@ -0,0 +1,173 @@
+"""
+试卷语料启动快照：把 data 目录每份试卷的文件签名（大小、mtime）、索引条目、解析结果、预序列化的响应字节
+与预拼的 prompt 前缀写进一个文件，启动时一次读入，不再逐个 json.load + json.dumps + 预拼前缀。
+
+- 构建：python scripts/build_papers_snapshot.py（部署构建命令中执行）；全量加载时快照缺失或过期，加载完成后自动重写
+- 文件分两段：头部（签名、索引条目与 ETag，很小）+ 正文（试卷内容与前缀）；懒加载模式（见 paper_store.py）只读头部
+- 校验：逐个比对目录中 *.json 的文件名、大小与 mtime_ns，签名一致的试卷直接沿用快照，
+  新增 / 修改的试卷用线程池并行读取与解析（快照缺失时即全部试卷），已删除的试卷丢弃
+- 预拼前缀还依赖 prompt 构造代码与 PROMPT_FORMAT 设置：快照记录调用方给出的前缀指纹，不一致时只丢弃前缀部分
+- 响应字节的预压缩版本（见 precompress.py）随试卷一起存入快照；预压缩设置变化时视为没有快照
+- 快照为本机生成的 pickle 文件，只从本地路径读取；版本号或格式不符时视为没有快照
+
+环境变量：
+  PAPERS_SNAPSHOT_PATH   - 快照文件路径，默认 backend/papers_snapshot.pkl；设为 off 关闭快照（每次全量并行加载）
+  PAPERS_LOAD_WORKERS    - 并行加载试卷的线程数，默认 8
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import precompress
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_PATH = (os.getenv("PAPERS_SNAPSHOT_PATH") or "").strip() or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "papers_snapshot.pkl"
+)
+if _PATH.lower() == "off":
+    _PATH = ""
+_WORKERS = max(1, int(os.getenv("PAPERS_LOAD_WORKERS") or 8))
+_VERSION = 4
+_HEADER_KEYS = ("pid", "sig", "mtime", "meta", "etag", "encodings")
+_BODY_KEYS = ("content", "json", "encoded", "prefixes")
+
+_last_load: Dict[str, Any] = {}     # 最近一次启动加载的情况，见 get_stats
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def load_file(data_dir: str, filename: str) -> Optional[Dict[str, Any]]:
+    """读取并解析一份试卷，返回条目（pid、sig、mtime、content、json、encoded 及 etag、encodings，不含前缀与索引条目）；
+    出错时打日志并返回 None。"""
+    try:
+        with open(os.path.join(data_dir, filename), "rb") as f:
+            st = os.fstat(f.fileno())
+            content = json.loads(f.read())
+        body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+        encoded = precompress.compress(body)
+        return {
+            "pid": content.get("id", filename[:-5]),
+            "sig": (st.st_size, st.st_mtime_ns),
+            "mtime": st.st_mtime,
+            "content": content,
+            "json": body,
+            "encoded": encoded,
+            "etag": f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+            "encodings": tuple(encoded),
+        }
+    except Exception as e:
+        print(f"读取文件 {filename} 出错: {e}")
+        return None
+
+
+def scan(data_dir: str) -> Dict[str, Tuple[Tuple[int, int], float]]:
+    """目录中每个 *.json 的 (签名 (大小, mtime_ns), mtime)。"""
+    files = {}
+    with os.scandir(data_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".json") and entry.is_file():
+                st = entry.stat()
+                files[entry.name] = ((st.st_size, st.st_mtime_ns), st.st_mtime)
+    return files
+
+
+def load(data_dir: str, prefix_fingerprint: str, full: bool = True) -> Tuple[Dict[str, Dict[str, Any]], bool]:
+    """返回 ({文件名: 条目}, 快照是否需要重写)。
+
+    条目含 pid、sig、mtime，沿用快照的条目还有 meta（索引条目）；full=True 时所有条目都有 content（解析后的试卷）、
+    json（响应字节）与 encoded（预压缩版本），prefixes 仅在快照沿用且前缀指纹一致时存在，缺失时由调用方补齐。
+    full=False 时只读快照头部，沿用的条目不含试卷内容；新增 / 修改的试卷仍会读入（含 content、json 与 encoded）。"""
+    started = time.perf_counter()
+    files = scan(data_dir)
+    snapshot = None
+    if _PATH and os.path.isfile(_PATH):
+        try:
+            with open(_PATH, "rb") as f:
+                snapshot = pickle.load(f)
+                if (
+                    not isinstance(snapshot, dict)
+                    or snapshot.get("version") != _VERSION
+                    or snapshot.get("precompress") != precompress.fingerprint()
+                ):
+                    snapshot = None
+                elif full:
+                    for name, body in pickle.load(f).items():
+                        snapshot["files"][name].update(body)
+        except Exception as e:
+            print(f"[Startup] 试卷快照读取失败，改为逐个加载: {e}")
+            snapshot = None
+    read_seconds = time.perf_counter() - started
+
+    cached = snapshot["files"] if snapshot else {}
+    keep_prefixes = bool(snapshot) and snapshot.get("prefixFingerprint") == prefix_fingerprint
+    entries: Dict[str, Dict[str, Any]] = {}
+    stale: List[str] = []
+    for name, (sig, mtime) in files.items():
+        entry = cached.get(name)
+        if entry is not None and entry["sig"] == sig and (not full or "json" in entry):
+            if not keep_prefixes:
+                entry.pop("prefixes", None)
+            entries[name] = entry
+        else:
+            stale.append(name)
+    if stale:
+        with ThreadPoolExecutor(max_workers=min(_WORKERS, len(stale))) as pool:
+            for name, entry in zip(stale, pool.map(lambda n: load_file(data_dir, n), stale)):
+                if entry is not None:
+                    entries[name] = entry
+    _last_load.clear()
+    _last_load.update(
+        snapshot=bool(snapshot),
+        reused=len(files) - len(stale),
+        loaded=len(stale),
+        removed=len(set(cached) - set(files)),
+        prefixes_reused=keep_prefixes,
+        read_ms=round(read_seconds * 1000, 1),
+        load_ms=round((time.perf_counter() - started) * 1000, 1),
+    )
+    dirty = bool(_PATH) and (not snapshot or bool(stale) or not keep_prefixes or len(cached) != len(entries))
+    return entries, dirty
+
+
+def write(entries: Dict[str, Dict[str, Any]], prefix_fingerprint: str):
+    """写入快照（先写临时文件再替换，其他进程不会读到半个文件）。条目须含 load 返回的全部字段及 meta、prefixes。"""
+    if not _PATH:
+        return
+    started = time.perf_counter()
+    tmp = f"{_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            header = {name: {k: e[k] for k in _HEADER_KEYS} for name, e in entries.items()}
+            body = {name: {k: e[k] for k in _BODY_KEYS} for name, e in entries.items()}
+            pickle.dump(
+                {
+                    "version": _VERSION,
+                    "precompress": precompress.fingerprint(),
+                    "prefixFingerprint": prefix_fingerprint,
+                    "files": header,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            pickle.dump(body, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, _PATH)
+        _last_load["write_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        print(f"[Startup] 已写入试卷快照 {_PATH}（{os.path.getsize(_PATH) / 1024 / 1024:.1f}MB，{_last_load['write_ms']}ms）")
+    except Exception as e:
+        print(f"[Startup] 试卷快照写入失败: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def path() -> str:
+    return _PATH
+
+
+def get_stats() -> Dict[str, Any]:
+    return dict(_last_load, path=_PATH or None)
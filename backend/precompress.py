@@ -0,0 +1,238 @@
+"""
+预压缩响应：试卷 JSON（/api/paper）、试卷索引（/api/list）与 /images 静态文件在加载时按最高压缩级别各压缩一次
+（br 与 gzip），请求时按 Accept-Encoding 直接返回对应字节，不再由 GZipMiddleware 每次重新压缩。
+
+- 压缩后节省不足 PRECOMPRESS_MIN_SAVING 的内容不保留压缩版本；PNG / JPEG 等本身已压缩的文件不尝试压缩
+- 协商：按 Accept-Encoding 的 q 值选择，q 相同时优先 br；都不接受时返回原始字节。
+  有压缩版本的响应一律带 Vary: Accept-Encoding，Content-Length 为实际发送的字节数
+- 压缩版本的 ETag 改为弱 ETag（W/ 前缀，与 nginx gzip 的做法相同），客户端带回时仍按同一份内容校验
+- 上述路由不经过 GZipMiddleware（见 GZipExceptPrecompressed）
+- 最高质量的 brotli 每份试卷约 40ms 且不能多线程并行，压缩版本随试卷存入启动快照（见 papers_snapshot.py），
+  应在构建时生成快照
+- /images 静态文件选中原始编码时直接返回 StaticFiles 的 FileResponse（按块发送文件），不把文件读进内存
+
+环境变量：
+  PRECOMPRESS                  - 设为 0 关闭预压缩（回到 GZipMiddleware 按请求压缩），默认开启
+  PRECOMPRESS_MIN_SAVING       - 压缩版本至少节省的比例，默认 0.1
+  PRECOMPRESS_BROTLI_QUALITY   - brotli 压缩质量 0–11，默认 11
+"""
+
+import gzip
+import mimetypes
+import os
+import threading
+from typing import Any, Collection, Dict, Optional, Tuple
+
+import brotli
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_ENABLED = (os.getenv("PRECOMPRESS") or "1").strip().lower() not in ("0", "false", "off")
+_MIN_SAVING = float(os.getenv("PRECOMPRESS_MIN_SAVING") or 0.1)
+_BROTLI_QUALITY = int(os.getenv("PRECOMPRESS_BROTLI_QUALITY") or 11)
+MIN_SIZE = 500                     # 与 GZipMiddleware 的 minimum_size 一致，更小的内容不压缩
+ENCODINGS = ("br", "gzip")         # q 值相同时的优先顺序
+_PRECOMPRESSED_TYPES = (
+    "image/png", "image/jpeg", "image/gif", "image/webp", "image/avif",
+    "audio/", "video/", "font/woff", "application/zip", "application/gzip", "application/pdf",
+)
+
+_lock = threading.Lock()
+_counters: Dict[str, Any] = {
+    "compressed": 0,
+    "skipped": 0,
+    "bytes_in": 0,
+    "bytes_out": {name: 0 for name in ENCODINGS},
+    "served": {name: 0 for name in ENCODINGS + ("identity",)},
+}
+
+
+def _encode(name: str, data: bytes) -> bytes:
+    if name == "br":
+        return brotli.compress(data, quality=_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _weak(etag: str) -> str:
+    return etag if not etag or etag.startswith("W/") else f"W/{etag}"
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def enabled() -> bool:
+    return _ENABLED
+
+
+def fingerprint() -> str:
+    """预压缩设置（启用的编码与压缩级别），变化时快照中的压缩版本作废。"""
+    return f"{','.join(ENCODINGS) if _ENABLED else 'off'}/{_MIN_SAVING}/{_BROTLI_QUALITY}"
+
+
+def compress(data: bytes, media_type: str = "application/json") -> Dict[str, bytes]:
+    """返回 {编码: 压缩后字节}，只含节省达到 PRECOMPRESS_MIN_SAVING 的编码；关闭预压缩时返回空 dict。"""
+    if not _ENABLED or len(data) < MIN_SIZE or media_type.startswith(_PRECOMPRESSED_TYPES):
+        with _lock:
+            _counters["skipped"] += 1
+        return {}
+    variants = {}
+    for name in ENCODINGS:
+        encoded = _encode(name, data)
+        if len(encoded) <= len(data) * (1 - _MIN_SAVING):
+            variants[name] = encoded
+    with _lock:
+        _counters["compressed" if variants else "skipped"] += 1
+        _counters["bytes_in"] += len(data)
+        for name, encoded in variants.items():
+            _counters["bytes_out"][name] += len(encoded)
+    return variants
+
+
+def negotiate(accept_encoding: str, variants: Collection[str]) -> Optional[str]:
+    """按 Accept-Encoding 从 variants（{编码: 字节} 或编码名列表）中选出编码；都不接受时返回 None（发送原始字节）。"""
+    if not variants or not accept_encoding:
+        return None
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for name in ENCODINGS:
+        q = weights.get(name, weights.get("*", 0.0))
+        if name in variants and q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def _note_served(encoding: Optional[str]):
+    with _lock:
+        _counters["served"][encoding or "identity"] += 1
+
+
+def _encoded_response(
+    encoding: str, variants: Dict[str, bytes], media_type: str, headers: Dict[str, str], status_code: int
+) -> Response:
+    headers["Content-Encoding"] = encoding
+    if "ETag" in headers:
+        headers["ETag"] = _weak(headers["ETag"])
+    _note_served(encoding)
+    return Response(content=variants[encoding], status_code=status_code, media_type=media_type, headers=headers)
+
+
+def response(
+    request_headers: Headers,
+    body: bytes,
+    variants: Dict[str, bytes],
+    media_type: str = "application/json",
+    headers: Optional[Dict[str, str]] = None,
+    status_code: int = 200,
+) -> Response:
+    """按请求的 Accept-Encoding 返回原始或预压缩的 body；有压缩版本时带 Vary，压缩版本的 ETag 改为弱 ETag。"""
+    headers = dict(headers or {})
+    encoding = negotiate(request_headers.get("accept-encoding", ""), variants)
+    if variants:
+        headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        return _encoded_response(encoding, variants, media_type, headers, status_code)
+    _note_served(None)
+    return Response(content=body, status_code=status_code, media_type=media_type, headers=headers)
+
+
+def not_modified(request_headers: Headers, variants: Collection[str], headers: Dict[str, str]) -> Response:
+    """304 响应：ETag 与 Vary 与对应的 200 响应一致（variants 只需给出有哪些编码）。"""
+    headers = dict(headers)
+    if variants:
+        headers["Vary"] = "Accept-Encoding"
+        if negotiate(request_headers.get("accept-encoding", ""), variants) and "ETag" in headers:
+            headers["ETag"] = _weak(headers["ETag"])
+    return Response(status_code=304, headers=headers)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 是否包含 etag（弱比较：忽略 W/ 前缀）。"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles，挂载时把目录下可压缩的文件各压缩一次；文件变化（大小或 mtime 不同）后首次访问时重新压缩。"""
+
+    def __init__(self, *, directory: str, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self._variants: Dict[str, Tuple[Tuple[int, int], Dict[str, bytes]]] = {}
+        if _ENABLED:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    self._lookup(path, os.stat(path))
+
+    def _lookup(self, full_path: str, stat_result: os.stat_result) -> Dict[str, bytes]:
+        sig = (stat_result.st_size, stat_result.st_mtime_ns)
+        cached = self._variants.get(full_path)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+        media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+        variants: Dict[str, bytes] = {}
+        if not media_type.startswith(_PRECOMPRESSED_TYPES) and stat_result.st_size >= MIN_SIZE:
+            with open(full_path, "rb") as f:
+                variants = compress(f.read(), media_type)
+        self._variants[full_path] = (sig, variants)
+        return variants
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        file_response = super().file_response(full_path, stat_result, scope, status_code)
+        variants = self._lookup(str(full_path), stat_result) if _ENABLED else {}
+        request_headers = Headers(scope=scope)
+        if not variants or request_headers.get("range"):
+            return file_response
+        headers = {k: v for k, v in file_response.headers.items() if k not in ("content-length", "content-type", "accept-ranges")}
+        headers["ETag"] = headers.pop("etag")
+        if not isinstance(file_response, FileResponse):     # 304
+            return not_modified(request_headers, variants, headers)
+        encoding = negotiate(request_headers.get("accept-encoding", ""), variants)
+        if not encoding:
+            file_response.headers.add_vary_header("Accept-Encoding")
+            _note_served(None)
+            return file_response
+        headers["Vary"] = "Accept-Encoding"
+        return _encoded_response(encoding, variants, file_response.media_type, headers, status_code)
+
+
+class GZipExceptPrecompressed(GZipMiddleware):
+    """GZipMiddleware，但不处理已预压缩的路由（其响应由 response() 自行协商编码）。"""
+
+    def __init__(self, app, paths: Tuple[str, ...] = (), prefixes: Tuple[str, ...] = (), **kwargs):
+        super().__init__(app, **kwargs)
+        self._paths = frozenset(paths)
+        self._prefixes = tuple(prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if _ENABLED and scope["type"] == "http":
+            path = scope.get("path", "")
+            if path in self._paths or path.startswith(self._prefixes):
+                await self.app(scope, receive, send)
+                return
+        await super().__call__(scope, receive, send)
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        stats: Dict[str, Any] = dict(
+            _counters, bytes_out=dict(_counters["bytes_out"]), served=dict(_counters["served"])
+        )
+    stats["enabled"] = _ENABLED
+    stats["encodings"] = list(ENCODINGS)
+    stats["ratio"] = {
+        name: round(n / stats["bytes_in"], 3) for name, n in stats["bytes_out"].items() if stats["bytes_in"]
+    }
+    return stats
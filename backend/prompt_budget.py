@@ -0,0 +1,173 @@
+"""
+批改 prompt 的 token 估算、分段统计与超预算裁剪。
+
+- estimate_tokens：本地估算 token 数，按中日韩字符、英文单词、数字、标点分别计（不调用上游 countTokens）
+- 每次批改按段落统计输入 token：instructions（批改说明）、region（地区评分特征）、materials（材料）、
+  questions（题目）、answers（学生答案与图片）；上游返回 usageMetadata 后用 note_actual 记录估算偏差
+- 预算模式（PROMPT_TOKEN_BUDGET > 0）：估算超出预算时，把材料按段落与题目文字的相关度排序，
+  从最不相关的段落开始删去（删去处留省略标记），直到不超预算或已删去 PROMPT_TRIM_MAX_RATIO 比例的材料
+
+环境变量：
+  PROMPT_TOKEN_BUDGET          - 输入 token 预算，默认 0（不裁剪，只统计）
+  PROMPT_TRIM_MAX_RATIO        - 最多删去的材料 token 比例，默认 0.4
+  PROMPT_CJK_TOKENS_PER_CHAR   - 每个中日韩字符折算的 token 数，默认 1.0
+"""
+
+import math
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET") or 0)
+_TRIM_MAX_RATIO = float(os.getenv("PROMPT_TRIM_MAX_RATIO") or 0.4)
+_CJK_TOKENS_PER_CHAR = float(os.getenv("PROMPT_CJK_TOKENS_PER_CHAR") or 1.0)
+IMAGE_TOKENS = 258                 # Gemini 每张图片固定折算的 token 数
+SECTIONS = ("instructions", "region", "materials", "questions", "answers")
+TRIM_MARKER = "……（此处材料与题目关联较弱，已省略）"
+
+_CJK = "\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef"    # 中日韩文字与全角标点
+_PIECE_RE = re.compile(rf"([{_CJK}]+)|([A-Za-z]+)|(\d+)|(\s+)|(.)", re.S)
+_TERM_RE = re.compile(rf"[{_CJK}]+|[A-Za-z]+|\d+")
+
+_lock = threading.Lock()
+_counters: Dict[str, Any] = {
+    "requests": 0,
+    "tokens": {name: 0 for name in SECTIONS},
+    "max_total": 0,
+    "over_budget": 0,
+    "trimmed": 0,
+    "trimmed_paragraphs": 0,
+    "trimmed_tokens": 0,
+}
+_by_variant: Dict[str, List[int]] = {}     # 材料编码（见 prompt_format）-> [请求数, 估算总 token]
+_accuracy = {"samples": 0, "estimated": 0, "actual": 0}
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数：中日韩字符按 PROMPT_CJK_TOKENS_PER_CHAR 计，英文约 4 个字母 1 个，数字约 3 位 1 个，
+    标点与其他符号各 1 个，空格不计、连续换行计 1 个。"""
+    if not text:
+        return 0
+    tokens = 0.0
+    for cjk, word, digits, space, _ in _PIECE_RE.findall(text):
+        if cjk:
+            tokens += len(cjk) * _CJK_TOKENS_PER_CHAR
+        elif word:
+            tokens += math.ceil(len(word) / 4)
+        elif digits:
+            tokens += math.ceil(len(digits) / 3)
+        elif space:
+            tokens += 1 if "\n" in space else 0
+        else:
+            tokens += 1
+    return int(math.ceil(tokens))
+
+
+def _terms(text: str) -> set:
+    """相关度计算用的词项：中日韩文本取相邻两字，英文单词与数字取整体。"""
+    terms = set()
+    for run in _TERM_RE.findall(text or ""):
+        if run[0] >= "\u3000":
+            terms.update(run[i:i + 2] for i in range(max(1, len(run) - 1)))
+        else:
+            terms.add(run.lower())
+    return terms
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def budget() -> int:
+    return _BUDGET
+
+
+def trim_materials(
+    materials: List[Dict[str, Any]], query: str, excess_tokens: int
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """按与 query（题目文字）的相关度从低到高删去材料段落，目标删去 excess_tokens 个 token。
+
+    返回 (新的材料列表, {"paragraphs": 删去段落数, "tokens": 删去 token 数})；不修改传入的材料。
+    每份材料至少保留一个段落；删去的连续段落合并为一个省略标记。
+    """
+    query_terms = _terms(query)
+    candidates = []         # (相关度, -token 数, 材料序号, 段落序号, token 数)
+    paragraphs: List[List[str]] = []
+    total = 0
+    for mi, m in enumerate(materials):
+        paras = str(m.get("content") or "").split("\n")
+        paragraphs.append(paras)
+        for pi, p in enumerate(paras):
+            if not p.strip():
+                continue
+            n = estimate_tokens(p)
+            total += n
+            terms = _terms(p)
+            score = len(terms & query_terms) / math.sqrt(len(terms)) if terms else 0.0
+            candidates.append((score, -n, mi, pi, n))
+    limit = min(excess_tokens, int(total * _TRIM_MAX_RATIO))
+    removed: Dict[int, set] = {}
+    removed_tokens = 0
+    for _, _, mi, pi, n in sorted(candidates):
+        if removed_tokens >= limit:
+            break
+        kept = sum(1 for j, p in enumerate(paragraphs[mi]) if p.strip() and j not in removed.get(mi, ()))
+        if kept <= 1:
+            continue
+        removed.setdefault(mi, set()).add(pi)
+        removed_tokens += n
+    out = []
+    for mi, m in enumerate(materials):
+        drop = removed.get(mi)
+        if not drop:
+            out.append(m)
+            continue
+        lines: List[str] = []
+        for pi, p in enumerate(paragraphs[mi]):
+            if pi not in drop:
+                lines.append(p)
+            elif not lines or lines[-1] != TRIM_MARKER:
+                lines.append(TRIM_MARKER)
+        out.append(dict(m, content="\n".join(lines)))
+    return out, {"paragraphs": sum(len(s) for s in removed.values()), "tokens": removed_tokens}
+
+
+def record(sections: Dict[str, int], trimmed: Optional[Dict[str, int]] = None, variant: str = ""):
+    """记录一次批改请求的分段 token 估算（trimmed 为本次裁剪结果，variant 为材料编码）。"""
+    total = sum(sections.values())
+    with _lock:
+        _counters["requests"] += 1
+        entry = _by_variant.setdefault(variant or "default", [0, 0])
+        entry[0] += 1
+        entry[1] += total
+        for name in SECTIONS:
+            _counters["tokens"][name] += sections.get(name, 0)
+        _counters["max_total"] = max(_counters["max_total"], total)
+        if _BUDGET and total > _BUDGET:
+            _counters["over_budget"] += 1
+        if trimmed and trimmed.get("paragraphs"):
+            _counters["trimmed"] += 1
+            _counters["trimmed_paragraphs"] += trimmed["paragraphs"]
+            _counters["trimmed_tokens"] += trimmed["tokens"]
+
+
+def note_actual(estimated: int, actual: int):
+    """上游返回 usageMetadata.promptTokenCount 后调用，用于评估估算偏差。"""
+    if estimated <= 0 or actual <= 0:
+        return
+    with _lock:
+        _accuracy["samples"] += 1
+        _accuracy["estimated"] += estimated
+        _accuracy["actual"] += actual
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        n = _counters["requests"]
+        stats: Dict[str, Any] = dict(_counters, tokens=dict(_counters["tokens"]), budget=_BUDGET)
+        stats["avg_tokens"] = {name: round(v / n) for name, v in _counters["tokens"].items()} if n else {}
+        stats["actual_to_estimated"] = (
+            round(_accuracy["actual"] / _accuracy["estimated"], 3) if _accuracy["estimated"] else None
+        )
+        stats["accuracy_samples"] = _accuracy["samples"]
+        stats["avg_total_by_format"] = {name: round(total / n) for name, (n, total) in _by_variant.items() if n}
+    return stats
@@ -0,0 +1,171 @@
+"""
+prompt 中材料与题目的编码方式：json（原样 json.dumps）或 compact（精简纯文本）。
+
+compact 编码：
+- 每份材料一个「【标题】」小节，正文去掉 HTML 标签（<u> 保留，题目常引用“划线句子”），实体转义还原，
+  连续空白合并、空行删除；正文开头与标题重复时去掉
+- 表格按行输出，单元格以「 | 」分隔，rowspan / colspan 展开为重复值，保证每行自成一条完整记录
+- 题目输出为「【题目 id】满分 N 分」+ 题干 + 要求（要求已包含在题干中时省略）
+
+A/B 切换（PROMPT_FORMAT）：json / compact / ab。ab 时按（试卷, 题目）的哈希把 PROMPT_FORMAT_AB_PERCENT% 的题目分到
+compact，同一道题始终落在同一组（预拼前缀与 Gemini 上下文缓存保持稳定）。两组的估算 token 见 prompt_budget，
+上游耗时见本模块 get_stats。离线对比全部试卷的 token 数：python scripts/compare_prompt_formats.py
+
+环境变量：
+  PROMPT_FORMAT             - json / compact / ab，默认 json
+  PROMPT_FORMAT_AB_PERCENT  - ab 模式下分到 compact 的百分比，默认 50
+"""
+
+import hashlib
+import html
+import json
+import os
+import re
+import threading
+from typing import Any, Dict, List
+
+# ── 环境变量配置 ────────────────────────────────────────────────────────────────
+_MODE = (os.getenv("PROMPT_FORMAT") or "json").strip().lower()
+_AB_PERCENT = int(os.getenv("PROMPT_FORMAT_AB_PERCENT") or 50)
+JSON, COMPACT = "json", "compact"
+ENCODING_VERSION = 1        # 修改 json / compact 编码结果时加 1，使快照中预拼的前缀作废
+
+_TABLE_RE = re.compile(r"<table\b.*?</table>", re.S | re.I)
+_ROW_RE = re.compile(r"<tr\b[^>]*>(.*?)</tr>", re.S | re.I)
+_CELL_RE = re.compile(r"<t[hd]\b([^>]*)>(.*?)</t[hd]>", re.S | re.I)
+_SPAN_RE = re.compile(r"\b(row|col)span\s*=\s*[\"']?(\d+)", re.I)
+_BLOCK_TAG_RE = re.compile(r"</?(?:p|div|br|li|ul|ol|h[1-6]|blockquote|section)\b[^>]*>", re.I)
+_TAG_RE = re.compile(r"<(?!/?u>)[^>]+>", re.I)
+_TABLE_SLOT_RE = re.compile(r"\x00(\d+)\x00")
+
+_lock = threading.Lock()
+_upstream: Dict[str, List[float]] = {JSON: [0, 0.0], COMPACT: [0, 0.0]}    # 编码 -> [请求数, 上游总耗时]
+
+
+def _inline(fragment: str) -> str:
+    """单元格 / 行内文字：去标签（保留 <u>）、还原实体并合并空白。"""
+    return " ".join(html.unescape(_TAG_RE.sub("", _BLOCK_TAG_RE.sub(" ", fragment))).split())
+
+
+def _render_table(table_html: str) -> str:
+    rows: List[List[str]] = []
+    pending: Dict[int, List[Any]] = {}      # 列号 -> [文字, 还要向下占用的行数]（rowspan）
+    for row_html in _ROW_RE.findall(table_html):
+        row: List[str] = []
+        cells = iter(_CELL_RE.findall(row_html))
+        col = 0
+        while True:
+            if col in pending:
+                text, left = pending[col]
+                row.append(text)
+                if left <= 1:
+                    del pending[col]
+                else:
+                    pending[col][1] = left - 1
+                col += 1
+                continue
+            cell = next(cells, None)
+            if cell is None:
+                break
+            attrs, inner = cell
+            spans = {k.lower(): int(v) for k, v in _SPAN_RE.findall(attrs)}
+            text = _inline(inner)
+            for _ in range(max(1, spans.get("col", 1))):
+                row.append(text)
+                if spans.get("row", 1) > 1:
+                    pending[col] = [text, spans["row"] - 1]
+                col += 1
+        if any(row):
+            rows.append(row)
+    return "\n".join(" | ".join(row) for row in rows)
+
+
+def render_text(content: str) -> str:
+    """材料正文转精简纯文本。"""
+    tables: List[str] = []
+
+    def _stash(m: "re.Match") -> str:
+        tables.append(_render_table(m.group(0)))
+        return f"\n\x00{len(tables) - 1}\x00\n"
+
+    s = _TABLE_RE.sub(_stash, content or "")
+    s = html.unescape(_TAG_RE.sub("", _BLOCK_TAG_RE.sub("\n", s)))
+    lines = (" ".join(line.split()) for line in s.split("\n"))
+    s = "\n".join(line for line in lines if line).replace("</u><u>", "")
+    return _TABLE_SLOT_RE.sub(lambda m: tables[int(m.group(1))], s)
+
+
+def render_materials(materials: List[Dict[str, Any]]) -> str:
+    parts = []
+    for m in materials:
+        title = str(m.get("title") or m.get("id") or "").strip()
+        text = render_text(str(m.get("content") or ""))
+        if title and text.startswith(title):
+            text = text[len(title):].lstrip("：: \n")
+        parts.append(f"【{title}】\n{text}" if title else text)
+    return "\n\n".join(parts)
+
+
+def render_questions(questions: List[Dict[str, Any]]) -> str:
+    """questions 为 main._question_for_prompt 的输出（id、title、requirements、maxScore）。"""
+    parts = []
+    for q in questions:
+        head = f"【题目 {q.get('id')}】" + (f"满分 {q['maxScore']} 分" if q.get("maxScore") else "")
+        title = render_text(str(q.get("title") or ""))
+        requirements = render_text(str(q.get("requirements") or ""))
+        lines = [head, title]
+        if requirements and requirements not in title:
+            lines.append(f"要求：{requirements}")
+        parts.append("\n".join(line for line in lines if line))
+    return "\n\n".join(parts)
+
+
+# ── 公开接口 ────────────────────────────────────────────────────────────────────
+def fingerprint() -> str:
+    """编码规则版本与 PROMPT_FORMAT 设置，变化时预拼的前缀作废。"""
+    return f"{ENCODING_VERSION}/{_MODE}/{_AB_PERCENT}"
+
+
+def variant(key: str) -> str:
+    """该题使用的编码（key 为「试卷 id/题目 id」）。"""
+    if _MODE == COMPACT:
+        return COMPACT
+    if _MODE == "ab":
+        bucket = int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16) % 100
+        return COMPACT if bucket < _AB_PERCENT else JSON
+    return JSON
+
+
+def encode(variant_name: str, materials: List[Dict[str, Any]], questions: List[Dict[str, Any]]) -> Dict[str, str]:
+    """返回 {"materials": 材料部分, "questions": 题目部分, "questionsHeader": 题目前的说明行}。"""
+    if variant_name == COMPACT:
+        return {
+            "materials": render_materials(materials),
+            "questionsHeader": "\n题目（questions）如下：",
+            "questions": render_questions(questions),
+        }
+    return {
+        "materials": json.dumps(materials, ensure_ascii=False),
+        "questionsHeader": "\n题目（questions）如下（每题包含 id、title、requirements、maxScore）：",
+        "questions": json.dumps(questions, ensure_ascii=False),
+    }
+
+
+def note_upstream(variant_name: str, seconds: float):
+    """记录一次批改的上游耗时（按编码分组，用于 A/B 对比）。"""
+    with _lock:
+        entry = _upstream.setdefault(variant_name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "mode": _MODE,
+            "ab_percent": _AB_PERCENT if _MODE == "ab" else None,
+            "upstream": {
+                name: {"requests": n, "avg_seconds": round(total / n, 3) if n else None}
+                for name, (n, total) in _upstream.items()
+            },
+        }
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""对比 /api/grade 构造 prompt 的 CPU 开销：使用加载时预拼好的前缀 vs 每次请求现拼。
+
+用法（在 backend 目录下）：
+    python scripts/bench_prompt_prefix.py [paper_id] [次数]
+默认试卷 gwy_neimenggu_2019_General（约 37KB），每道题各跑 2000 次。
+"""
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ["PAPERS_MEMORY_BUDGET_MB"] = "0"     # 全部常驻，只比较拼 prompt 本身
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+import paper_store  # noqa: E402
+
+
+def _bench(paper_id: str, qids, rounds: int) -> float:
+    """返回每次 _prepare_grading 的平均 CPU 时间（微秒）。"""
+    sink = io.StringIO()
+    start = time.process_time()
+    with contextlib.redirect_stdout(sink):
+        for i in range(rounds):
+            for qid in qids:
+                main._prepare_grading({"paperId": paper_id, "answers": {qid: "一是加强统筹协调；二是完善配套政策。"}})
+            if i % 100 == 0:
+                sink.seek(0)
+                sink.truncate()
+    return (time.process_time() - start) / (rounds * len(qids)) * 1e6
+
+
+def run():
+    paper_id = sys.argv[1] if len(sys.argv) > 1 else "gwy_neimenggu_2019_General"
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    with contextlib.redirect_stdout(io.StringIO()):
+        main._build_index()
+    paper = paper_store.get_paper(paper_id)
+    if not paper:
+        raise SystemExit(f"试卷不存在: {paper_id}")
+    qids = [str(q.get("id")) for q in paper.get("questions") or []]
+    size = len(paper_store.get_json(paper_id)[0])
+    print(f"试卷 {paper_id}（{size} 字节，{len(qids)} 道题），每道题 {rounds} 次")
+
+    get_prefix = paper_store.get_prefix
+    with_prefix = _bench(paper_id, qids, rounds)
+    paper_store.get_prefix = lambda pid, qid: None
+    try:
+        without_prefix = _bench(paper_id, qids, rounds)
+    finally:
+        paper_store.get_prefix = get_prefix
+
+    print(f"现拼 prompt：   {without_prefix:8.1f} µs/请求")
+    print(f"预拼前缀：     {with_prefix:8.1f} µs/请求")
+    print(f"每次请求节省： {without_prefix - with_prefix:8.1f} µs（{(1 - with_prefix / without_prefix) * 100:.0f}%）")
+
+
+if __name__ == "__main__":
+    run()
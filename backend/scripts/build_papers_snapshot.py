@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""生成试卷启动快照（见 papers_snapshot.py），部署时在构建命令中执行，服务冷启动时一次读入全部试卷。
+
+用法（在 backend 目录下）：
+    python scripts/build_papers_snapshot.py [--force]
+快照已是最新时不重写；--force 删除旧快照后全量重建。
+"""
+
+import contextlib
+import io
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ["PAPERS_MEMORY_BUDGET_MB"] = "0"     # 全量加载才会写快照（懒加载模式只读快照头部）
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+import paper_store  # noqa: E402
+import papers_snapshot  # noqa: E402
+
+
+def run():
+    path = papers_snapshot.path()
+    if not path:
+        raise SystemExit("PAPERS_SNAPSHOT_PATH=off，未启用快照")
+    if "--force" in sys.argv[1:] and os.path.exists(path):
+        os.remove(path)
+    started = time.perf_counter()
+    main._build_index()
+    stats = papers_snapshot.get_stats()
+    print(
+        f"{paper_store.count()} 份试卷，{(time.perf_counter() - started) * 1000:.0f}ms："
+        f"沿用 {stats['reused']} 份，重新加载 {stats['loaded']} 份，"
+        + (f"快照已写入 {path}" if "write_ms" in stats else f"快照已是最新 {path}")
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""离线对比材料 / 题目两种编码（json、compact，见 prompt_format.py）的估算输入 token。
+
+对 data 目录下每份试卷，分别用两种编码调用 main._build_paper_prompt_prefixes（按单题提交、使用试卷自带材料），
+用 prompt_budget.estimate_tokens 估算每道题前缀中材料 + 题目部分（不含批改说明与地区特征）的 token 数并汇总。
+
+用法（在 backend 目录下）：
+    python scripts/compare_prompt_formats.py [显示节省最多的前 N 份试卷，默认 10]
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+import prompt_budget  # noqa: E402
+import prompt_format  # noqa: E402
+
+
+def _paper_tokens(paper, mode: str):
+    """返回 (题目数, 该编码下各题材料 + 题目部分的 token 总数)。"""
+    prompt_format._MODE = mode
+    prefixes = main._build_paper_prompt_prefixes(paper)
+    return len(prefixes), sum(prompt_budget.estimate_tokens(p["body"]) for p in prefixes.values())
+
+
+def run():
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rows = []
+    data_dir = os.path.join(BACKEND_DIR, "data")
+    for name in sorted(os.listdir(data_dir)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(data_dir, name), encoding="utf-8") as f:
+            paper = json.load(f)
+        if not isinstance(paper, dict):
+            continue
+        count, as_json = _paper_tokens(paper, prompt_format.JSON)
+        _, compact = _paper_tokens(paper, prompt_format.COMPACT)
+        if count:
+            rows.append((paper.get("id") or name[:-5], count, as_json, compact))
+    if not rows:
+        raise SystemExit(f"{data_dir} 下没有试卷")
+
+    questions = sum(r[1] for r in rows)
+    total_json = sum(r[2] for r in rows)
+    total_compact = sum(r[3] for r in rows)
+    ratios = sorted(1 - r[3] / r[2] for r in rows if r[2])
+    print(f"试卷 {len(rows)} 份，题目 {questions} 道（每道题按单题提交估算材料 + 题目部分）")
+    print(f"json：    {total_json:>12,} tokens（平均每题 {total_json / questions:,.0f}）")
+    print(f"compact： {total_compact:>12,} tokens（平均每题 {total_compact / questions:,.0f}）")
+    print(f"总节省：  {total_json - total_compact:>12,} tokens（{(1 - total_compact / total_json) * 100:.1f}%）")
+    print(f"按试卷的节省比例：中位数 {ratios[len(ratios) // 2] * 100:.1f}%，最小 {ratios[0] * 100:.1f}%，最大 {ratios[-1] * 100:.1f}%")
+    print(f"\n节省最多的 {top} 份试卷：")
+    for pid, count, as_json, compact in sorted(rows, key=lambda r: r[3] - r[2])[:top]:
+        print(f"  {pid:<40} {count:>2} 题  {as_json:>8,} → {compact:>8,}（-{(1 - compact / as_json) * 100:.0f}%）")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""本地 Gemini 桩服务：模拟 cachedContents 的创建 / 查询 / 续期 / 删除与 generateContent，用于验证上下文缓存逻辑。
+
+用法（在 backend 目录下）：
+    python scripts/stub_gemini_server.py [端口]       # 默认 8765
+    GEMINI_ENDPOINT=http://127.0.0.1:8765 GEMINI_API_KEY=stub uvicorn main:app
+
+generateContent 引用不存在的 cachedContent 时返回 404，与真实接口一致；
+GET /stub/stats 返回各接口的调用次数与最近一次请求体，DELETE /stub/caches 清空全部缓存（模拟过期），
+state.delay_seconds 为 generateContent 的模拟耗时（测试中直接修改）。
+"""
+
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Tuple
+
+_MIN_CACHE_CHARS = 0   # 模拟模型对缓存内容的最小长度要求（真实接口按 token 数限制）
+
+
+class StubState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.caches: Dict[str, Dict[str, Any]] = {}
+        self.calls: Dict[str, int] = {"create": 0, "patch": 0, "delete": 0, "generate": 0, "generate_cached": 0, "stream": 0}
+        self.last_generate: Dict[str, Any] = {}
+        self.delay_seconds = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"calls": dict(self.calls), "caches": sorted(self.caches), "lastGenerate": self.last_generate}
+
+
+def _reply_text(body: Dict[str, Any], cache: Dict[str, Any]) -> str:
+    prompt = "".join(p.get("text", "") for c in body.get("contents") or [] for p in c.get("parts") or [])
+    prefix = "".join(p.get("text", "") for c in cache.get("contents") or [] for p in c.get("parts") or []) if cache else ""
+    return f"## 总评\n\n**得分**：8/10\n\n（桩服务：前缀 {len(prefix)} 字，请求 {len(prompt)} 字）"
+
+
+def _make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, obj: Any, content_type: str = "application/json"):
+            data = obj if isinstance(obj, bytes) else json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self) -> Dict[str, Any]:
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+        def _path(self) -> Tuple[str, str]:
+            path, _, query = self.path.partition("?")
+            return path, query
+
+        def _error(self, status: int, message: str, reason: str):
+            self._send(status, {"error": {"code": status, "message": message, "status": reason}})
+
+        def do_GET(self):
+            path, _ = self._path()
+            if path == "/stub/stats":
+                return self._send(200, state.stats())
+            m = re.fullmatch(r"/v1beta/(cachedContents/[\w-]+)", path)
+            with state.lock:
+                cache = state.caches.get(m.group(1)) if m else None
+            if not cache:
+                return self._error(404, "CachedContent not found", "NOT_FOUND")
+            self._send(200, {k: v for k, v in cache.items() if k != "contents"})
+
+        def do_PATCH(self):
+            path, _ = self._path()
+            body = self._body()
+            m = re.fullmatch(r"/v1beta/(cachedContents/[\w-]+)", path)
+            with state.lock:
+                state.calls["patch"] += 1
+                cache = state.caches.get(m.group(1)) if m else None
+                if cache:
+                    cache["expireTime"] = time.time() + float(str(body.get("ttl") or "3600s").rstrip("s"))
+            if not cache:
+                return self._error(404, "CachedContent not found", "NOT_FOUND")
+            self._send(200, {"name": cache["name"], "expireTime": cache["expireTime"]})
+
+        def do_DELETE(self):
+            path, _ = self._path()
+            if path == "/stub/caches":
+                with state.lock:
+                    state.caches.clear()
+                return self._send(200, {})
+            m = re.fullmatch(r"/v1beta/(cachedContents/[\w-]+)", path)
+            with state.lock:
+                state.calls["delete"] += 1
+                cache = state.caches.pop(m.group(1), None) if m else None
+            if not cache:
+                return self._error(404, "CachedContent not found", "NOT_FOUND")
+            self._send(200, {})
+
+        def do_POST(self):
+            path, _ = self._path()
+            body = self._body()
+            if path == "/v1beta/cachedContents":
+                text = "".join(p.get("text", "") for c in body.get("contents") or [] for p in c.get("parts") or [])
+                if len(text) < _MIN_CACHE_CHARS:
+                    return self._error(400, "Cached content is too small", "INVALID_ARGUMENT")
+                name = f"cachedContents/{uuid.uuid4().hex[:16]}"
+                ttl = float(str(body.get("ttl") or "3600s").rstrip("s"))
+                with state.lock:
+                    state.calls["create"] += 1
+                    state.caches[name] = dict(body, name=name, expireTime=time.time() + ttl)
+                return self._send(200, {"name": name, "model": body.get("model")})
+
+            m = re.fullmatch(r"/v1beta/models/([\w.-]+):(generateContent|streamGenerateContent)", path)
+            if not m:
+                return self._error(404, "Not found", "NOT_FOUND")
+            cache = None
+            with state.lock:
+                state.calls["stream" if m.group(2) == "streamGenerateContent" else "generate"] += 1
+                state.last_generate = body
+                if body.get("cachedContent"):
+                    cache = state.caches.get(body["cachedContent"])
+                    if cache and cache["expireTime"] < time.time():
+                        state.caches.pop(body["cachedContent"], None)
+                        cache = None
+                    if cache:
+                        state.calls["generate_cached"] += 1
+            if state.delay_seconds:
+                time.sleep(state.delay_seconds)
+            if body.get("cachedContent") and not cache:
+                return self._error(404, f"CachedContent not found: {body['cachedContent']}", "NOT_FOUND")
+            reply = {"candidates": [{"content": {"role": "model", "parts": [{"text": _reply_text(body, cache)}]}}]}
+            if m.group(2) == "streamGenerateContent":
+                return self._send(200, f"data: {json.dumps(reply, ensure_ascii=False)}\n\n".encode("utf-8"), "text/event-stream")
+            self._send(200, reply)
+
+    return Handler
+
+
+def start_stub_server(port: int = 0) -> Tuple[ThreadingHTTPServer, StubState]:
+    """在后台线程启动桩服务，返回 (server, state)；port=0 时随机端口，见 server.server_address。"""
+    state = StubState()
+    server = ThreadingHTTPServer(("127.0.0.1", port), _make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+if __name__ == "__main__":
+    srv, _ = start_stub_server(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
+    print(f"Gemini 桩服务已启动: http://127.0.0.1:{srv.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        srv.shutdown()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""测试批改准入控制：总并发与类别并发上限、等待队列已满 / 等待超时被拒、释放后按队列交接槽位、
+按权重调度并随等待时间老化（防止低权重类别饿死）、按 IP 限速。"""
+import asyncio
+import types
+
+import pytest
+
+import admission
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def _setup(monkeypatch, concurrency: int = 2, **limits) -> _Clock:
+    """limits 为 {类别: (并发上限, 队列长度, 权重)}；时钟冻结，只在测试中手动推进。"""
+    clock = _Clock()
+    monkeypatch.setattr(admission, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(admission, "_CONCURRENCY", concurrency)
+    monkeypatch.setattr(admission, "_active", 0)
+    monkeypatch.setattr(admission, "_AGING_SECONDS", 10.0)
+    classes = {}
+    defaults = {"small": (concurrency, 4, 6), "essay": (1, 2, 2), "image": (1, 2, 2)}
+    for name, (limit, queue_size, weight) in dict(defaults, **limits).items():
+        c = admission._Class(name, name.upper(), limit, queue_size, weight)
+        c.limit, c.queue_size, c.weight = limit, queue_size, weight
+        classes[name] = c
+    monkeypatch.setattr(admission, "_classes", classes)
+    return clock
+
+
+async def _spin():
+    """让出事件循环几轮，使已分到槽位的等待者从 asyncio.wait 中返回。"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_concurrency_caps_and_queue_handoff(monkeypatch):
+    _setup(monkeypatch, concurrency=2)
+
+    async def scenario():
+        # 大作文只能占 1 个槽位，第 2 个大作文排队；剩余的槽位留给小题
+        essay = await admission.acquire("essay")
+        queued_essay = asyncio.create_task(admission.acquire("essay"))
+        await _spin()
+        assert not queued_essay.done()
+        small = await admission.acquire("small")
+        assert admission.get_stats()["active"] == 2
+
+        # 总并发已满：小题也要排队；释放大作文槽位后交给排队时间更久、权重更高的那个
+        queued_small = asyncio.create_task(admission.acquire("small"))
+        await _spin()
+        admission.release("essay", essay)
+        await _spin()
+        assert queued_small.done() and not queued_essay.done()
+
+        admission.release("small", small)
+        await _spin()
+        assert queued_essay.done()
+        admission.release("small", queued_small.result())
+        admission.release("essay", queued_essay.result())
+        stats = admission.get_stats()
+        assert stats["active"] == 0
+        assert stats["classes"]["essay"]["admitted"] == 2 and stats["classes"]["essay"]["queued"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_and_wait_timeout_are_rejected(monkeypatch):
+    _setup(monkeypatch, concurrency=1, small=(1, 1, 6))
+
+    async def scenario():
+        held = await admission.acquire("small")
+        waiter = asyncio.create_task(admission.acquire("small", max_wait=5))
+        await _spin()
+
+        # 队列已满：立即拒绝，check_capacity 同样拒绝
+        with pytest.raises(admission.Rejected) as full:
+            await admission.acquire("small")
+        assert full.value.retry_after >= 1
+        with pytest.raises(admission.Rejected):
+            admission.check_capacity("small")
+
+        # 后台任务不受队列长度限制
+        background = asyncio.create_task(admission.acquire("small", background=True))
+        await _spin()
+        assert not background.done()
+
+        waiter.cancel()
+        background.cancel()
+        await asyncio.gather(waiter, background, return_exceptions=True)
+
+        # 等待超时：被拒绝，且不残留在队列中
+        with pytest.raises(admission.Rejected):
+            await admission.acquire("small", max_wait=0.01)
+        admission.release("small", held)
+        stats = admission.get_stats()["classes"]["small"]
+        assert stats["queued_now"] == 0 and stats["active"] == 0
+        assert stats["rejected_full"] == 2 and stats["rejected_timeout"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_weighted_priority_with_aging(monkeypatch):
+    clock = _setup(monkeypatch, concurrency=1)
+
+    async def handoff(essay_waited: float) -> str:
+        """占满唯一槽位，大作文先排队 essay_waited 秒、小题再排队，释放后返回拿到槽位的类别。"""
+        held = await admission.acquire("image")
+        essay = asyncio.create_task(admission.acquire("essay", background=True))
+        await _spin()
+        clock.now += essay_waited
+        small = asyncio.create_task(admission.acquire("small", background=True))
+        await _spin()
+        admission.release("image", held)
+        await _spin()
+        first, second = (essay, small) if essay.done() else (small, essay)
+        assert not second.done()
+        admission.release("essay" if first is essay else "small", first.result())
+        await _spin()
+        admission.release("small" if first is essay else "essay", second.result())
+        return "essay" if first is essay else "small"
+
+    async def scenario():
+        # 权重 6:2，等待时间相近时小题优先
+        assert await handoff(5) == "small"
+        # 大作文等待 30 秒：2 × (1 + 30/10) = 8 > 6，老化后优先于刚入队的小题
+        assert await handoff(30) == "essay"
+        assert admission.get_stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_ip_rate_limit(monkeypatch):
+    clock = _setup(monkeypatch)
+    monkeypatch.setattr(admission, "_IP_RATE_PER_MINUTE", 6.0)
+    monkeypatch.setattr(admission, "_IP_BURST", 2.0)
+    monkeypatch.setattr(admission, "_ip_buckets", {})
+    admission.check_client("10.0.0.1")
+    admission.check_client("10.0.0.1")
+    with pytest.raises(admission.Rejected) as e:
+        admission.check_client("10.0.0.1")
+    assert e.value.retry_after == 10
+    admission.check_client("10.0.0.2")      # 其他 IP 不受影响
+    admission.check_client(None)            # 未知 IP 不限速
+    clock.now += 10
+    admission.check_client("10.0.0.1")
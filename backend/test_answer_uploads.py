@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""测试拍照作答的 multipart 上传：按 Content-Length 提前拒绝、图片数量与单张大小上限、不支持的格式与非 multipart 请求返回 415、
+EncodedJson 分块产出的请求体与内联 base64 的 json.dumps 逐字节一致、占位符只在所属 payload 内展开，
+以及 /api/grade/upload 把上传的图片交给批改。"""
+import asyncio
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.datastructures import FormData, Headers, UploadFile
+
+_TMP = tempfile.mkdtemp(prefix="answer_uploads_test_")
+os.environ.setdefault("GRADE_JOBS_DB_PATH", os.path.join(_TMP, "jobs.db"))
+os.environ.setdefault("GRADE_SESSIONS_DB_PATH", os.path.join(_TMP, "sessions.db"))
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ.setdefault("STATS_DB_PATH", os.path.join(_TMP, "stats.db"))
+
+import admission  # noqa: E402
+import answer_uploads  # noqa: E402
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+
+_PNG = bytes(range(256)) * 3 + b"tail"      # 772 字节：不是 3 的倍数，末块带 base64 填充
+
+
+def _image(data: bytes = _PNG, mime: str = "image/png") -> answer_uploads.UploadedImage:
+    image = answer_uploads.UploadedImage(io.BytesIO(data), mime, "answer.png")
+    image.scan()
+    return image
+
+
+def _body(data) -> bytes:
+    if isinstance(data, bytes):
+        return data
+
+    async def collect():
+        return b"".join([chunk async for chunk in data])
+
+    return asyncio.run(collect())
+
+
+def _upload(data: bytes, content_type: str = "image/jpeg", filename: str = "answer.jpg") -> UploadFile:
+    return UploadFile(io.BytesIO(data), filename=filename, headers=Headers({"content-type": content_type}))
+
+
+def test_encode_json_streams_same_bytes_as_inline_base64(monkeypatch):
+    monkeypatch.setattr(answer_uploads, "_CHUNK_BYTES", 3 * 50)     # 分多块编码
+    png, jpeg = _image(), _image(b"\xff\xd8jpeg" * 40, "image/jpeg")
+    assert png.size == len(_PNG) and png.digest == hashlib.sha256(base64.b64encode(_PNG)).hexdigest()
+
+    def payload(png_field, jpeg_url):
+        return {
+            "contents": [{"role": "user", "parts": [
+                {"text": "请批改 \"引号\" 与换行\n中文"},
+                {"inlineData": {"mimeType": "image/png", "data": png_field}},
+            ]}],
+            "messages": [{"content": [{"type": "image_url", "image_url": {"url": jpeg_url}}]}],
+            "again": png_field,
+        }
+
+    data = answer_uploads.encode_json(payload(png.base64_field(), jpeg.data_url()))
+    expected = json.dumps(
+        payload(base64.b64encode(_PNG).decode(), "data:image/jpeg;base64," + base64.b64encode(b"\xff\xd8jpeg" * 40).decode()),
+        ensure_ascii=False,
+    ).encode("utf-8")
+    assert isinstance(data, answer_uploads.EncodedJson)
+    assert _body(data) == expected and len(data) == len(expected)
+    assert _body(data) == expected          # 可重复迭代（上游重试时重新读文件）
+    assert answer_uploads.content_headers(data, {"A": "1"}) == {"A": "1", "Content-Length": str(len(expected))}
+
+    plain = {"text": "没有图片", "n": [1, 2.5, None]}
+    assert answer_uploads.encode_json(plain) == json.dumps(plain, ensure_ascii=False).encode("utf-8")
+    assert answer_uploads.content_headers(b"{}", {"A": "1"}) == {"A": "1"}
+    with pytest.raises(TypeError):
+        answer_uploads.encode_json({"x": object()})
+
+
+def test_placeholders_resolve_only_within_their_payload():
+    mine, other = _image(), _image(b"other" * 200)
+    # 另一个 payload 的占位符、或用户文本中恰好出现的同形字符串，都原样保留为文本
+    text = f"作答里出现了 {other.token} 与 {answer_uploads._TOKEN_PREFIX}x@@"
+    data = answer_uploads.encode_json({"text": text, "data": mine.base64_field()})
+    assert _body(data) == json.dumps(
+        {"text": text, "data": base64.b64encode(_PNG).decode()}, ensure_ascii=False
+    ).encode("utf-8")
+    assert answer_uploads.encode_json({"text": text}) == json.dumps({"text": text}, ensure_ascii=False).encode("utf-8")
+
+
+def test_check_content_length(monkeypatch):
+    monkeypatch.setattr(answer_uploads, "_MAX_BYTES", 1000)
+    answer_uploads.check_content_length({"content-length": "1000"})
+    for headers, status in (({}, 411), ({"content-length": "abc"}, 400), ({"content-length": "1001"}, 413)):
+        with pytest.raises(answer_uploads.UploadRejected) as e:
+            answer_uploads.check_content_length(headers)
+        assert e.value.status == status
+
+
+def test_parse_form_limits(monkeypatch):
+    monkeypatch.setattr(answer_uploads, "_MAX_IMAGES", 2)
+    monkeypatch.setattr(answer_uploads, "_MAX_IMAGE_BYTES", 1000)
+    payload, images = answer_uploads.parse_form(FormData([
+        ("payload", json.dumps({"paperId": "p1", "answers": {"q1": "作答"}})),
+        ("images", _upload(_PNG, "image/jpg")),
+        ("images", _upload(b"", "image/png")),      # 空文件忽略
+    ]))
+    assert payload == {"paperId": "p1", "answers": {"q1": "作答"}}
+    assert [(img.mime, img.size, img.filename) for img in images] == [("image/jpeg", len(_PNG), "answer.jpg")]
+
+    for form, status in (
+        ([("payload", "{不是 JSON")], 400),
+        ([("payload", "[1, 2]")], 400),
+        ([("images", _upload(b"x" * 10)) for _ in range(3)], 413),
+        ([("images", _upload(b"x" * 1001))], 413),
+        ([("images", _upload(b"GIF89a", "image/gif"))], 415),
+    ):
+        with pytest.raises(answer_uploads.UploadRejected) as e:
+            answer_uploads.parse_form(FormData(form))
+        assert e.value.status == status
+
+
+@pytest.fixture
+def client(monkeypatch):
+    graded = []
+
+    async def run_grading(ctx):
+        graded.append(ctx)
+        return {"score": 18, "maxScore": 20, "content": "批改报告"}
+
+    async def no_normalize(payload):
+        return None
+
+    monkeypatch.setattr(main, "_prepare_grading", lambda payload: {"has_essay": False, "answer_images": payload["answer_images"]})
+    monkeypatch.setattr(main, "_run_grading", run_grading)
+    monkeypatch.setattr(main, "_normalize_answer_images", no_normalize)
+    monkeypatch.setattr(main, "_record_submit_stat", lambda has_essay, ip: None)
+    monkeypatch.setattr(admission, "_IP_RATE_PER_MINUTE", 0)
+    monkeypatch.setattr(answer_uploads, "_MAX_BYTES", 64 * 1024)
+    monkeypatch.setattr(answer_uploads, "_MAX_IMAGES", 2)
+    monkeypatch.setattr(answer_uploads, "_MAX_IMAGE_BYTES", 4096)
+    test_client = TestClient(main.app)
+    test_client.graded = graded
+    return test_client
+
+
+def _post(client, files, payload=None):
+    data = {"payload": json.dumps(payload or {"paperId": "p1", "answers": {"q1": "见图"}})}
+    with contextlib.redirect_stdout(io.StringIO()):
+        return client.post("/api/grade/upload", data=data, files=files)
+
+
+def test_upload_endpoint_passes_images_to_grading(client):
+    r = _post(client, [("images", ("a.png", _PNG, "image/png")), ("images", ("b.jpg", b"\xff\xd8" * 100, "image/jpeg"))])
+    assert r.status_code == 200 and r.json()["content"] == "批改报告"
+    images = client.graded[0]["answer_images"]
+    assert [(img.mime, img.size) for img in images] == [("image/png", len(_PNG)), ("image/jpeg", 200)]
+    assert b"".join(images[0].raw_chunks()) == _PNG
+
+
+def test_upload_endpoint_rejections(client):
+    png = ("a.png", _PNG, "image/png")
+    assert _post(client, [("images", png)] * 3).status_code == 413                                  # 超过图片数量上限
+    assert _post(client, [("images", ("big.png", b"x" * 4097, "image/png"))]).status_code == 413    # 单张过大
+    assert _post(client, [("images", ("a.gif", b"GIF89a", "image/gif"))]).status_code == 415
+    # 整个请求超过 GRADE_UPLOAD_MAX_BYTES：按 Content-Length 直接拒绝
+    huge = _post(client, [("images", ("huge.png", b"x" * (64 * 1024), "image/png"))])
+    assert huge.status_code == 413 and huge.json()["detail"].startswith("上传内容过大")
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert client.post("/api/grade/upload", json={"paperId": "p1"}).status_code == 415
+    assert client.graded == []
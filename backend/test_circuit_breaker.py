@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""测试上游熔断器：按失败率熔断、到时转半开只放一个探测、探测成功恢复 / 失败翻倍熔断时长、429 立即熔断。"""
+import types
+
+import circuit_breaker
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+def _fake_clock(monkeypatch) -> _Clock:
+    clock = _Clock()
+    monkeypatch.setattr(circuit_breaker, "time", types.SimpleNamespace(time=clock.time))
+    monkeypatch.setattr(circuit_breaker, "_MIN_REQUESTS", 4)
+    monkeypatch.setattr(circuit_breaker, "_ERROR_RATE", 0.5)
+    monkeypatch.setattr(circuit_breaker, "_OPEN_SECONDS", 30.0)
+    monkeypatch.setattr(circuit_breaker, "_MAX_OPEN_SECONDS", 100.0)
+    monkeypatch.setattr(circuit_breaker, "_breakers", {})
+    return clock
+
+
+def test_opens_on_error_rate_then_half_open_probe_closes(monkeypatch):
+    clock = _fake_clock(monkeypatch)
+    name = "test-upstream"
+    for ok in (True, False, True):
+        assert circuit_breaker.allow(name)
+        circuit_breaker.record(name, ok, 1.0)
+    assert circuit_breaker.get_stats()[name]["state"] == circuit_breaker.CLOSED
+
+    # 第 4 次失败：4 次中 2 次失败，达到 50% 失败率，熔断
+    circuit_breaker.record(name, False, 1.0)
+    assert circuit_breaker.is_open(name)
+    assert not circuit_breaker.allow(name)
+    assert circuit_breaker.get_stats()[name]["rejected"] == 1
+
+    # 熔断时长到期：半开，只放行一个探测请求；is_open 不占用探测名额
+    clock.now += 30
+    assert not circuit_breaker.is_open(name)
+    assert circuit_breaker.allow(name)
+    assert not circuit_breaker.allow(name)
+    assert circuit_breaker.get_stats()[name]["state"] == circuit_breaker.HALF_OPEN
+
+    # 探测成功：恢复正常，窗口清空
+    circuit_breaker.record(name, True, 1.0)
+    stats = circuit_breaker.get_stats()[name]
+    assert stats["state"] == circuit_breaker.CLOSED and stats["windowRequests"] == 0
+    assert circuit_breaker.allow(name) and circuit_breaker.allow(name)
+
+
+def test_failed_probe_doubles_open_time_up_to_max(monkeypatch):
+    clock = _fake_clock(monkeypatch)
+    name = "test-probe"
+    for _ in range(4):
+        circuit_breaker.record(name, False, 1.0)
+    assert circuit_breaker.is_open(name)
+
+    expected = 30.0
+    for _ in range(3):
+        clock.now += expected
+        assert circuit_breaker.allow(name)
+        circuit_breaker.record(name, False, 1.0)
+        expected = min(100.0, expected * 2)
+        assert circuit_breaker.is_open(name)
+        assert circuit_breaker.get_stats()[name]["openRemainingSeconds"] == expected
+        clock.now += expected - 1
+        assert circuit_breaker.is_open(name)
+        clock.now -= expected - 1
+
+
+def test_stalled_probe_lets_another_probe_through(monkeypatch):
+    clock = _fake_clock(monkeypatch)
+    name = "test-stalled"
+    circuit_breaker.record_quota(name, 0.1)
+    clock.now += 30
+    assert circuit_breaker.allow(name)
+    clock.now += circuit_breaker._PROBE_TIMEOUT_SECONDS + 1
+    assert circuit_breaker.allow(name)
+
+
+def test_released_probe_lets_next_probe_through_immediately(monkeypatch):
+    clock = _fake_clock(monkeypatch)
+    name = "test-released"
+    circuit_breaker.record_quota(name, 0.1)
+    clock.now += 30
+    assert circuit_breaker.allow(name)
+    assert not circuit_breaker.allow(name)
+    # 探测请求没有发出（如没拿到 Key、剩余时间不够）：归还名额后下一个请求立即探测，而不是等探测超时
+    circuit_breaker.release_probe(name)
+    assert circuit_breaker.allow(name)
+    circuit_breaker.record(name, True, 1.0)
+    # 已回报结果后归还为空操作
+    circuit_breaker.release_probe(name)
+    assert circuit_breaker.get_stats()[name]["state"] == circuit_breaker.CLOSED
+
+
+def test_quota_opens_key_immediately_and_order_prefers_healthy(monkeypatch):
+    _fake_clock(monkeypatch)
+    circuit_breaker.record("gemini#0", True, 1.0)
+    circuit_breaker.record_quota("gemini#0", 0.2)
+    assert circuit_breaker.is_open("gemini#0")
+    assert circuit_breaker.get_stats()["gemini#0"]["reason"] == "配额/限流"
+    assert circuit_breaker.order(["gemini#0", "gemini#1"]) == ["gemini#1", "gemini#0"]
+    # 健康度相同时保持调用方给出的顺序
+    assert circuit_breaker.order(["b-upstream", "a-upstream"]) == ["b-upstream", "a-upstream"]
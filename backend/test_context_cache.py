@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""测试 Gemini 上下文缓存：对本地桩服务（scripts/stub_gemini_server.py）验证创建、复用与失效回退。"""
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BACKEND_DIR, "scripts"))
+
+_TMP = tempfile.mkdtemp(prefix="ctx_cache_test_")
+os.environ["GRADE_JOBS_DB_PATH"] = os.path.join(_TMP, "jobs.db")
+os.environ["GRADE_SESSIONS_DB_PATH"] = os.path.join(_TMP, "sessions.db")
+os.environ["GRADE_CACHE_DB_PATH"] = "off"
+os.environ["GRADE_CACHE_TTL_SECONDS"] = "0"
+os.environ["STATS_DB_PATH"] = os.path.join(_TMP, "stats.db")
+os.environ["GEMINI_CONTEXT_CACHE_MIN_USES"] = "2"
+
+from stub_gemini_server import start_stub_server  # noqa: E402
+
+_server, _state = start_stub_server()
+os.environ["GEMINI_ENDPOINT"] = f"http://127.0.0.1:{_server.server_address[1]}"
+os.environ["GEMINI_API_KEY"] = "stub-key"
+os.environ.pop("GEMINI_API_KEY_FALLBACK", None)
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+    main._build_index()
+
+PAPER_ID = "gwy_guojia_2023_Dishiji"
+
+
+def _grade_once(answer: str) -> str:
+    ctx = main._prepare_grading({"paperId": PAPER_ID, "question_id": "q1", "user_answer": answer})
+    assert ctx["context_cache"] and ctx["prompt"].endswith(ctx["context_cache"]["suffix"])
+    return ctx
+
+
+async def _scenario():
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # 第 1 次：前缀只用过一次，不建缓存，发完整 prompt
+            ctx = _grade_once("一是加强统筹协调。")
+            assert await main._call_grading_providers(ctx)
+            assert _state.calls["create"] == 0
+            assert "cachedContent" not in _state.last_generate
+
+            # 第 2 次：达到最少使用次数，建缓存并只上传答案部分
+            ctx = _grade_once("二是完善配套政策。")
+            assert await main._call_grading_providers(ctx)
+            assert _state.calls["create"] == 1
+            assert _state.last_generate.get("cachedContent")
+            sent = _state.last_generate["contents"][0]["parts"][0]["text"]
+            assert sent == ctx["context_cache"]["suffix"] and "二是完善配套政策" in sent
+
+            # 第 3 次：复用同一缓存
+            ctx = _grade_once("三是强化督促落实。")
+            assert await main._call_grading_providers(ctx)
+            assert _state.calls["create"] == 1 and _state.calls["generate_cached"] == 2
+
+            # 远端缓存失效：引用失败后自动改发完整 prompt，结果不受影响
+            _state.caches.clear()
+            ctx = _grade_once("四是健全考核机制。")
+            assert await main._call_grading_providers(ctx)
+            assert "cachedContent" not in _state.last_generate
+            assert main.gemini_context_cache.get_stats()["fallbacks"] == 1
+    finally:
+        await main._close_http_clients()
+
+
+def test_context_cache_create_reuse_and_fallback():
+    asyncio.run(_scenario())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""测试 Gemini 多 Key 调度：平滑加权轮询的分配比例、跳过熔断 / 已试过的 Key、TPM 按实际用量结算与退回、令牌桶耗尽时限流。"""
+import asyncio
+import types
+from collections import Counter
+
+import gemini_key_pool
+
+
+def _setup(monkeypatch, keys: str, queue_seconds: float = 0.0):
+    """keys 为 GEMINI_API_KEYS 的写法；时钟冻结，令牌桶不随时间回填。"""
+    monkeypatch.setenv("GEMINI_API_KEY", "")
+    monkeypatch.setenv("GEMINI_API_KEY_FALLBACK", "")
+    monkeypatch.setenv("GEMINI_API_KEYS", keys)
+    monkeypatch.setattr(gemini_key_pool, "time", types.SimpleNamespace(monotonic=lambda: 1000.0))
+    monkeypatch.setattr(gemini_key_pool, "_QUEUE_SECONDS", queue_seconds)
+    monkeypatch.setattr(gemini_key_pool, "_config_source", None)
+    monkeypatch.setattr(gemini_key_pool, "_keys", [])
+    monkeypatch.setattr(gemini_key_pool, "_counters", {"acquired": 0, "queued": 0, "queue_seconds": 0.0, "throttled": 0})
+
+
+def _acquire(tokens: int = 100, exclude=(), usable=lambda i: True):
+    return asyncio.run(gemini_key_pool.acquire(tokens, set(exclude), usable))
+
+
+def _tok(idx: int) -> float:
+    return gemini_key_pool._keys[idx]["tok_tokens"]
+
+
+def test_weighted_round_robin_distribution(monkeypatch):
+    _setup(monkeypatch, "key-a:3:1000, key-b:1:1000")
+    assert gemini_key_pool.configured_keys() == ["key-a", "key-b"]
+    picks = [_acquire() for _ in range(8)]
+    assert Counter(picks) == {0: 6, 1: 2}
+    # 平滑加权：权重小的 Key 均匀穿插，而不是连续排在最后
+    assert picks[:4] == [0, 0, 1, 0] and picks[4:] == picks[:4]
+    stats = gemini_key_pool.get_stats()["keys"]
+    assert [k["selected"] for k in stats] == [6, 2]
+    assert stats[0]["key"] == "…ey-a" and stats[0]["requestsLastMinute"] == 6
+
+
+def test_skips_excluded_unusable_and_zero_weight_keys(monkeypatch):
+    _setup(monkeypatch, "key-a, key-b, key-c:0")
+    assert _acquire(exclude={0}) == 1
+    assert _acquire(usable=lambda i: i != 1) == 0
+    assert _acquire(exclude={0}, usable=lambda i: i != 1) is None
+
+
+def test_settle_corrects_and_refunds_tpm(monkeypatch):
+    _setup(monkeypatch, "key-a:1:60:1000")
+    idx = _acquire(300)
+    assert _tok(idx) == 700
+    # 上游报错 / 超时：按 0 结算，预扣的 token 全部退回
+    gemini_key_pool.settle(idx, 300, 0)
+    assert _tok(idx) == 1000
+
+    # 实际用量多于估算：多扣；少于估算：退回差额
+    idx = _acquire(300)
+    gemini_key_pool.settle(idx, 300, 500)
+    assert _tok(idx) == 500
+    idx = _acquire(300)
+    gemini_key_pool.settle(idx, 300, 100)
+    assert _tok(idx) == 400
+    assert gemini_key_pool.get_stats()["keys"][0]["tokensLastMinute"] == 600
+
+
+def test_release_returns_request_and_tokens(monkeypatch):
+    _setup(monkeypatch, "key-a:1:60:1000")
+    idx = _acquire(300)
+    assert gemini_key_pool._keys[idx]["req_tokens"] == 59
+    gemini_key_pool.release(idx, 300)
+    k = gemini_key_pool._keys[idx]
+    assert k["req_tokens"] == 60 and k["tok_tokens"] == 1000
+    stats = gemini_key_pool.get_stats()["keys"][0]
+    assert stats["selected"] == 0 and stats["requestsLastMinute"] == 0
+
+
+def test_throttles_when_buckets_are_empty(monkeypatch):
+    _setup(monkeypatch, "key-a:1:60:1000, key-b:1:1:1000")
+    assert _acquire(800) == 0
+    assert _acquire(800) == 1          # key-a 的 TPM 不够，改用 key-b
+    assert _acquire(100) == 0
+    assert _acquire(100) == 0          # key-b 每分钟只允许 1 次请求
+    assert _acquire(800) is None       # 都没有余量，且不排队
+    assert gemini_key_pool.get_stats()["throttled"] == 1
@@ -67,6 +67,30 @@ def test_no_images_normal_submit():
     print(f"[OK] has_images=false 时未触发图片校验 400 (status={status})")
 
 
+def test_grade_job_validation_and_unknown_id():
+    """异步批改任务：缺答案时提交即返回 400；查询不存在的 jobId 返回 404。"""
+    data = json.dumps({"paperId": "gwy_guojia_2023_Dishiji"}, ensure_ascii=False).encode("utf-8")
+    req = urllib.request.Request(
+        f"{BASE}/api/grade/jobs",
+        data=data,
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        urllib.request.urlopen(req, timeout=10)
+        status = 200
+    except urllib.error.HTTPError as e:
+        status = e.code
+    assert status == 400, f"缺答案的任务期望 400，得到 {status}"
+    try:
+        urllib.request.urlopen(f"{BASE}/api/grade/jobs/not-a-job", timeout=10)
+        status = 200
+    except urllib.error.HTTPError as e:
+        status = e.code
+    assert status == 404, f"不存在的任务期望 404，得到 {status}"
+    print("[OK] /api/grade/jobs 参数校验 400、未知任务 404")
+
+
 def main():
     print("正在连接后端", BASE, "...")
     try:
@@ -77,6 +101,7 @@ def main():
 
     test_has_images_but_empty_answer_images()
     test_no_images_normal_submit()
+    test_grade_job_validation_and_unknown_id()
     print("\n全部通过。")
 
 
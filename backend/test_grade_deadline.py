@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""测试批改时限：剩余时间不够某上游通常耗时的调用时跳过它、上游超过截止时间时 /api/grade 返回 504、
+流式批改同样跳过上游，且整个上游流（而不只是每次读取）不超过截止时间，到时推送 504 error 事件；
+熔断半开时没拿到 Key 或超过截止时间而没发出请求，归还探测名额。"""
+import asyncio
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import pytest
+from fastapi import HTTPException
+
+_TMP = tempfile.mkdtemp(prefix="deadline_test_")
+os.environ.setdefault("GRADE_JOBS_DB_PATH", os.path.join(_TMP, "jobs.db"))
+os.environ.setdefault("GRADE_SESSIONS_DB_PATH", os.path.join(_TMP, "sessions.db"))
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ.setdefault("STATS_DB_PATH", os.path.join(_TMP, "stats.db"))
+
+import grade_hedging  # noqa: E402
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+
+
+def _ctx(budget: float) -> dict:
+    return {
+        "prompt": "请批改",
+        "answer_images": [],
+        "temperature": 0.3,
+        "top_p": 0.9,
+        "context_cache": None,
+        "deadline": time.monotonic() + budget,
+        "prompt_format": "test",
+        "image_report": None,
+        "grading_session_id": "deadline-test",
+    }
+
+
+@pytest.fixture(autouse=True)
+def _setup(monkeypatch):
+    monkeypatch.setattr(main, "_GRADE_MIN_ATTEMPT_SECONDS", 0.05)
+    monkeypatch.setattr(main, "_deadline_stats", {"timeouts": 0, "skipped_attempts": 0})
+    monkeypatch.setattr(grade_hedging, "_ENABLED", False)
+    monkeypatch.setattr(main.circuit_breaker, "order", lambda names: list(names))
+
+
+def _run(coro):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(coro)
+
+
+def test_skips_provider_slower_than_remaining_budget(monkeypatch):
+    calls = []
+
+    async def gemini(prompt, **kwargs):
+        calls.append("gemini")
+        return "Gemini 结果"
+
+    async def qianduoduo(prompt, **kwargs):
+        calls.append("qianduoduo")
+        return "钱多多结果"
+
+    monkeypatch.setattr(main, "call_gemini_system", gemini)
+    monkeypatch.setattr(main, "call_qianduoduo_gemini", qianduoduo)
+    # Gemini 通常要 10 秒，只剩 1 秒：跳过 Gemini，直接调用钱多多
+    monkeypatch.setattr(grade_hedging, "typical_latency", lambda name: 10.0 if name == "Gemini" else 0.0)
+    assert _run(main._call_grading_providers(_ctx(1.0))) == "钱多多结果"
+    assert calls == ["qianduoduo"] and main._deadline_stats["skipped_attempts"] == 1
+
+
+def test_non_stream_returns_504_when_upstream_outlives_deadline(monkeypatch):
+    cancelled = []
+
+    async def hang(prompt, **kwargs):
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.append("gemini")
+            raise
+
+    monkeypatch.setattr(main, "call_gemini_system", hang)
+    monkeypatch.setattr(main, "call_qianduoduo_gemini", hang)
+    started = time.monotonic()
+    with pytest.raises(HTTPException) as e:
+        _run(main._call_grading_providers(_ctx(0.2)))
+    assert e.value.status_code == 504
+    assert time.monotonic() - started < 3           # 截止时间后 1 秒内放弃，而不是等上游自身超时
+    assert cancelled == ["gemini"] and main._deadline_stats["timeouts"] == 1
+
+
+def _events(ctx) -> list:
+    async def collect():
+        return [chunk async for chunk in main._grade_event_stream_uncached(ctx)]
+
+    events = []
+    for raw in _run(collect()):
+        name, data = raw.decode("utf-8").strip().split("\n")
+        events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_stream_caps_whole_upstream_stream_at_deadline(monkeypatch):
+    closed = []
+
+    async def trickle(prompt, images, **kwargs):
+        # 每次读取都很快，但整个流远超截止时间
+        try:
+            for i in range(100):
+                await asyncio.sleep(0.05)
+                yield f"第{i}段\n"
+        finally:
+            closed.append("gemini")
+
+    async def never(prompt, images, **kwargs):
+        raise AssertionError("已超时，不应再调用下一个上游")
+        yield  # pragma: no cover
+
+    monkeypatch.setattr(main, "stream_gemini_system", trickle)
+    monkeypatch.setattr(main, "stream_qianduoduo_gemini", never)
+    started = time.monotonic()
+    events = _events(_ctx(0.3))
+    assert time.monotonic() - started < 1.5
+    assert events[0][0] == "chunk" and events[-1] == ("error", {"status": 504, "detail": main._GRADING_TIMEOUT_DETAIL})
+    assert "result" not in [name for name, _ in events]
+    assert closed == ["gemini"] and main._deadline_stats["timeouts"] == 1
+
+
+def test_stream_skips_provider_slower_than_remaining_budget(monkeypatch):
+    calls = []
+
+    async def gemini(prompt, images, **kwargs):
+        calls.append("gemini")
+        yield "不应调用"
+
+    async def qianduoduo(prompt, images, **kwargs):
+        calls.append("qianduoduo")
+        yield "钱多多报告\n"
+
+    monkeypatch.setattr(main, "stream_gemini_system", gemini)
+    monkeypatch.setattr(main, "stream_qianduoduo_gemini", qianduoduo)
+    monkeypatch.setattr(grade_hedging, "typical_latency", lambda name: 10.0 if name == "Gemini" else 0.0)
+
+    async def collect():
+        main._grading_deadline.set(time.monotonic() + 1.0)
+        return [text async for text in main._stream_grading_providers(_ctx(1.0))]
+
+    assert _run(collect()) == ["钱多多报告\n"]
+    assert calls == ["qianduoduo"] and main._deadline_stats["skipped_attempts"] == 1
+
+
+def test_unsent_gemini_request_releases_half_open_probes(monkeypatch):
+    monkeypatch.setattr(main.circuit_breaker, "_breakers", {})
+    monkeypatch.setattr(main.circuit_breaker, "_OPEN_SECONDS", 0.0)
+    monkeypatch.setattr(main, "_get_gemini_api_keys", lambda: ["key-0"])
+    monkeypatch.setattr(main.gemini_key_pool, "settle", lambda idx, estimated, used: None)
+    acquired = []
+
+    async def acquire(tokens, tried):
+        return acquired.pop() if acquired else None
+
+    async def send(url, payload, **kwargs):
+        raise main._DeadlineExceeded("剩余时间不够")
+
+    monkeypatch.setattr(main, "_acquire_gemini_key", acquire)
+    monkeypatch.setattr(main, "_send_gemini_request", send)
+    for name in ("gemini", "gemini#0"):
+        main.circuit_breaker.record_quota(name, 0.1)    # 熔断时长为 0：立即转为半开
+
+    # 没拿到 Key、拿到 Key 但超过截止时间：都没有发出请求，探测名额归还后下一个请求可立即探测
+    assert _run(main.call_gemini_system("请批改")) is None
+    acquired.append(0)
+    assert _run(main.call_gemini_system("请批改")) is None
+    acquired.append(0)
+
+    async def drain():
+        return [text async for text in main.stream_gemini_system("请批改")]
+
+    assert _run(drain()) == []
+    assert main.circuit_breaker.allow("gemini") and main.circuit_breaker.allow("gemini#0")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""测试多题拆分批改的合并：部分题目失败时其余照常返回、maxScore 含失败的题目、档位只按已批改的题目并在含大作文时
+按大作文标准、全部失败时抛出错误、partial 结果不保存为批改会话。"""
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+_TMP = tempfile.mkdtemp(prefix="fan_out_test_")
+os.environ.setdefault("GRADE_JOBS_DB_PATH", os.path.join(_TMP, "jobs.db"))
+os.environ.setdefault("GRADE_SESSIONS_DB_PATH", os.path.join(_TMP, "sessions.db"))
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ.setdefault("STATS_DB_PATH", os.path.join(_TMP, "stats.db"))
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+
+# 题目 id -> (是否大作文, 满分, 得分；None 表示该题批改失败)
+_QUESTIONS = {"q1": (False, 20, 16), "q2": (True, 40, 33), "q3": (False, 10, None)}
+
+
+def _ctx(qid: str, session_id: str = "fan-out-test") -> dict:
+    has_essay, max_score, _ = _QUESTIONS[qid]
+    return {
+        "has_essay": has_essay,
+        "model_input": {"questions": [{"id": qid, "maxScore": max_score}]},
+        "grading_session_id": f"{session_id}/{qid}",
+        "qid": qid,
+    }
+
+
+async def _fake_grading(ctx):
+    qid = ctx["qid"]
+    _, max_score, score = _QUESTIONS[qid]
+    if score is None:
+        raise HTTPException(status_code=503, detail="上游不可用")
+    return {
+        "score": score,
+        "maxScore": max_score,
+        "grade": "单题档位",
+        "content": f"{qid} 的报告",
+        "overallEvaluation": f"{qid} 的总评",
+        "perQuestion": {qid: {"score": score, "maxScore": max_score}},
+    }
+
+
+@pytest.fixture(autouse=True)
+def _stub_grading(monkeypatch):
+    monkeypatch.setattr(main, "_run_grading", _fake_grading)
+    monkeypatch.setattr(main, "_fan_out_stats", {k: 0 for k in main._fan_out_stats})
+
+
+def _merge(*qids):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(main._run_fan_out({qid: _ctx(qid) for qid in qids}))
+
+
+def test_partial_failure_keeps_other_questions():
+    result = _merge("q1", "q2", "q3")
+    assert result["partial"] is True and result["failedQuestions"] == ["q3"]
+    assert result["perQuestion"]["q3"] == {"error": "上游不可用", "status": 503, "maxScore": 10}
+    assert result["perQuestion"]["q1"]["score"] == 16 and result["perQuestion"]["q1"]["gradingSessionId"] == "fan-out-test/q1"
+    # maxScore 含失败的题目，score 只计已批改的题目
+    assert result["score"] == 49 and result["maxScore"] == 70
+    assert "q1 的报告" in result["content"] and "q3" not in result["content"]
+    assert result["overallEvaluation"].endswith("题目 q3 批改失败，未计入得分与档位，请稍后重新提交。")
+    assert main._fan_out_stats["questions"] == 3 and main._fan_out_stats["failed_questions"] == 1
+
+
+def test_grade_band_follows_essay_rubric_when_essay_is_graded():
+    # 49/60 ≈ 82%：大作文标准为 A 档（≥80%），小题标准只到 B 档（<85%）
+    assert _merge("q1", "q2")["grade"] == "A档（优秀）"
+    # 只有小题（失败的题不计）：16/20 = 80% 按小题标准为 B 档
+    small = _merge("q1", "q3")
+    assert small["grade"] == "B档（良好）" and small["score"] == 16 and small["maxScore"] == 30
+
+
+def test_all_failed_raises_first_error():
+    with pytest.raises(HTTPException) as e:
+        _merge("q3")
+    assert e.value.status_code == 503
+
+
+def test_partial_result_is_not_saved_as_session(monkeypatch):
+    saved = []
+
+    def prepare(payload):
+        qid = next(iter(payload["answers"]))
+        return _ctx(qid, payload["gradingSessionId"].split("/")[0])
+
+    async def remember(payload, result, client_id, client_ip):
+        saved.append(payload["gradingSessionId"])
+
+    monkeypatch.setattr(main, "_prepare_grading", prepare)
+    monkeypatch.setattr(main, "_remember_session", remember)
+    monkeypatch.setattr(main, "_record_submit_stat", lambda has_essay, ip: None)
+    client = TestClient(main.app)
+
+    def grade(session_id, qids):
+        payload = {"answers": {qid: "作答" for qid in qids}, "fanOut": True, "gradingSessionId": session_id}
+        with contextlib.redirect_stdout(io.StringIO()):
+            return client.post("/api/grade", json=payload)
+
+    partial = grade("partial-session", ["q1", "q3"])
+    assert partial.status_code == 200 and partial.json()["partial"] is True
+    complete = grade("complete-session", ["q1", "q2"])
+    assert complete.status_code == 200 and complete.json()["partial"] is False
+    assert saved == ["complete-session"]
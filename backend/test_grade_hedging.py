@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""测试批改对冲与断开取消：触发时间分位数、对冲占比上限、主上游过慢时并行调用下一个上游并取消落后者、
+调用方取消（客户端断开）时所有进行中的上游调用随之取消。"""
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+from collections import deque
+
+_TMP = tempfile.mkdtemp(prefix="hedging_test_")
+os.environ.setdefault("GRADE_JOBS_DB_PATH", os.path.join(_TMP, "jobs.db"))
+os.environ.setdefault("GRADE_SESSIONS_DB_PATH", os.path.join(_TMP, "sessions.db"))
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ.setdefault("STATS_DB_PATH", os.path.join(_TMP, "stats.db"))
+
+import grade_hedging  # noqa: E402
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+
+
+def _reset(monkeypatch, enabled: bool = True, delay: float = 0.05):
+    monkeypatch.setattr(grade_hedging, "_ENABLED", enabled)
+    monkeypatch.setattr(grade_hedging, "_DEFAULT_DELAY_SECONDS", delay)
+    monkeypatch.setattr(grade_hedging, "_latencies", {})
+    monkeypatch.setattr(grade_hedging, "_requests", deque())
+    monkeypatch.setattr(grade_hedging, "_hedges", deque())
+    monkeypatch.setattr(grade_hedging, "_counters", {"requests": 0, "hedges": 0, "denied": 0, "wins": {}})
+
+
+def test_hedge_delay_uses_percentile_with_floor(monkeypatch):
+    _reset(monkeypatch, delay=30.0)
+    monkeypatch.setattr(grade_hedging, "_MIN_DELAY_SECONDS", 3.0)
+    for i in range(grade_hedging._MIN_SAMPLES - 1):
+        grade_hedging.record_latency("slow", 10.0 + i)
+    assert grade_hedging.hedge_delay("slow") == 30.0          # 样本不足：默认值
+    assert grade_hedging.typical_latency("slow") == 0.0
+    grade_hedging.record_latency("slow", 29.0)
+    assert grade_hedging.hedge_delay("slow") == 28.0          # 20 个样本（10…28, 29）的 p95
+    for _ in range(grade_hedging._MIN_SAMPLES):
+        grade_hedging.record_latency("fast", 0.5)
+    assert grade_hedging.hedge_delay("fast") == 3.0           # 不低于下限
+
+
+def test_hedge_rate_is_capped(monkeypatch):
+    _reset(monkeypatch)
+    monkeypatch.setattr(grade_hedging, "_MAX_RATE", 0.1)
+    for _ in range(20):
+        grade_hedging.note_request()
+    assert grade_hedging.try_acquire_hedge() and grade_hedging.try_acquire_hedge()
+    assert not grade_hedging.try_acquire_hedge()
+    stats = grade_hedging.get_stats()
+    assert stats["hedges"] == 2 and stats["denied"] == 1
+
+
+def test_slow_primary_is_hedged_and_cancelled(monkeypatch):
+    _reset(monkeypatch)
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(5)
+            return "慢上游结果"
+        except asyncio.CancelledError:
+            cancelled.append("slow")
+            raise
+
+    async def fast():
+        await asyncio.sleep(0.01)
+        return "快上游结果"
+
+    async def scenario():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await main._first_successful_provider([
+                ("慢上游", "hedge-test-slow", slow),
+                ("快上游", "hedge-test-fast", fast),
+            ])
+
+    assert asyncio.run(scenario()) == "快上游结果"
+    assert cancelled == ["slow"]
+    stats = grade_hedging.get_stats()
+    assert stats["hedges"] == 1 and stats["wins"] == {"快上游": 1}
+    assert stats["latency"]["快上游"]["samples"] == 1 and "慢上游" not in stats["latency"]
+
+
+def test_serial_fallback_when_hedging_disabled(monkeypatch):
+    _reset(monkeypatch, enabled=False)
+    calls = []
+
+    async def empty():
+        calls.append("empty")
+        return None
+
+    async def ok():
+        calls.append("ok")
+        return "结果"
+
+    async def scenario():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await main._first_successful_provider([("甲", "hedge-test-a", empty), ("乙", "hedge-test-b", ok)])
+
+    assert asyncio.run(scenario()) == "结果"
+    assert calls == ["empty", "ok"] and grade_hedging.get_stats()["hedges"] == 0
+
+
+def test_caller_cancel_cancels_upstream_calls(monkeypatch):
+    _reset(monkeypatch, enabled=False)
+    cancelled = []
+    before = main._disconnect_stats["cancelled_upstream_calls"]
+
+    async def hang():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append("hang")
+            raise
+
+    async def scenario():
+        with contextlib.redirect_stdout(io.StringIO()):
+            task = asyncio.create_task(main._first_successful_provider([("挂起", "hedge-test-hang", hang)]))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert cancelled == ["hang"]
+    assert main._disconnect_stats["cancelled_upstream_calls"] == before + 1
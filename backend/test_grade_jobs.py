@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""测试异步批改任务队列（进程内，不需要启动服务）：提交 → 轮询 → 完成 / 失败、任务结束后清空 payload、
+同时执行的任务数不超过 worker 数、排队已满时返回 503。"""
+import asyncio
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+_TMP = tempfile.mkdtemp(prefix="grade_jobs_test_")
+os.environ.setdefault("GRADE_JOBS_DB_PATH", os.path.join(_TMP, "jobs.db"))
+os.environ.setdefault("GRADE_SESSIONS_DB_PATH", os.path.join(_TMP, "sessions.db"))
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ.setdefault("STATS_DB_PATH", os.path.join(_TMP, "stats.db"))
+
+import admission  # noqa: E402
+import grade_jobs  # noqa: E402
+import paper_store  # noqa: E402
+import paper_watcher  # noqa: E402
+import papers_snapshot  # noqa: E402
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+
+
+class _FakeGrading:
+    """代替 _run_grading：记录同时执行的任务数；release 未设置时一直占着 worker。"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.running = 0
+        self.max_running = 0
+        self.remembered = []
+
+    async def __call__(self, ctx):
+        assert ctx["background"] is True
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            while not self.release.is_set():
+                await asyncio.sleep(0.01)
+            if ctx["answer"] == "上游故障":
+                raise HTTPException(status_code=503, detail="上游不可用")
+            return {"score": 18, "maxScore": 20, "content": f"批改：{ctx['answer']}"}
+        finally:
+            self.running -= 1
+
+
+@pytest.fixture
+def grading(monkeypatch, tmp_path):
+    monkeypatch.setattr(grade_jobs, "_DB_PATH", str(tmp_path / "jobs.db"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        grade_jobs._init_db()
+    fake = _FakeGrading()
+
+    async def remember(payload, result, client_id, client_ip):
+        fake.remembered.append((payload["gradingSessionId"], client_id))
+
+    monkeypatch.setattr(main, "_run_grading", fake)
+    monkeypatch.setattr(main, "_prepare_grading", lambda payload: {"has_essay": False, "answer": payload["answer"]})
+    monkeypatch.setattr(main, "_remember_session", remember)
+    monkeypatch.setattr(main, "_record_submit_stat", lambda has_essay, ip: None)
+    monkeypatch.setattr(main, "_GRADE_JOB_WORKERS", 2)
+    monkeypatch.setattr(main, "_GRADE_JOB_QUEUE_SIZE", 2)
+    monkeypatch.setattr(main, "_grade_job_tasks", [])
+    monkeypatch.setattr(main, "_grade_job_contexts", {})
+    monkeypatch.setattr(admission, "_IP_RATE_PER_MINUTE", 0)
+    # 启动时加载空的试卷目录，不启动目录监视
+    monkeypatch.setattr(main, "get_data_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(papers_snapshot, "_PATH", "")
+    monkeypatch.setattr(paper_store, "_index", {})
+    monkeypatch.setattr(paper_store, "_resident", OrderedDict())
+    monkeypatch.setattr(paper_store, "_resident_bytes", 0)
+    monkeypatch.setattr(paper_watcher, "start", lambda *args: False)
+    return fake
+
+
+def _submit(client, answer: str, session_id: str = ""):
+    payload = {"answer": answer, "gradingSessionId": session_id or f"session-{answer}"}
+    with contextlib.redirect_stdout(io.StringIO()):
+        return client.post("/api/grade/jobs", json=payload, headers={"X-Client-Id": "client-a"})
+
+
+def _wait_for(client, job_id: str, statuses, timeout: float = 5.0) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/api/grade/jobs/{job_id}").json()
+        if job["status"] in statuses or time.monotonic() > deadline:
+            return job
+        time.sleep(0.02)
+
+
+def _stored_payload(job_id: str) -> str:
+    conn = sqlite3.connect(grade_jobs._DB_PATH)
+    try:
+        return conn.execute("SELECT payload FROM grade_jobs WHERE id = ?", (job_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_submit_poll_done_and_payload_cleared(grading):
+    grading.release.set()
+    with contextlib.redirect_stdout(io.StringIO()), TestClient(main.app) as client:
+        r = _submit(client, "作答一")
+        assert r.status_code == 202 and r.json()["status"] == "queued"
+        job_id = r.json()["jobId"]
+        assert r.headers["location"] == f"/api/grade/jobs/{job_id}"
+
+        job = _wait_for(client, job_id, ("done", "failed"))
+        assert job["status"] == "done" and job["result"]["content"] == "批改：作答一"
+        assert "payload" not in job
+        # 任务结束即清空持久化的 payload（可含数 MB 的 base64 图片）
+        assert _stored_payload(job_id) == grade_jobs._EMPTY_PAYLOAD
+        assert grading.remembered == [("session-作答一", "client-a")]
+
+        failed_id = _submit(client, "上游故障").json()["jobId"]
+        failed = _wait_for(client, failed_id, ("done", "failed"))
+        assert failed["status"] == "failed" and failed["errorCode"] == 503 and failed["error"] == "上游不可用"
+        assert _stored_payload(failed_id) == grade_jobs._EMPTY_PAYLOAD
+        assert client.get("/api/grade/jobs/nope").status_code == 404
+
+
+def test_worker_pool_bounds_concurrency_and_queue(grading):
+    with contextlib.redirect_stdout(io.StringIO()), TestClient(main.app) as client:
+        running = [_submit(client, f"作答{i}").json()["jobId"] for i in range(2)]
+        assert [_wait_for(client, job_id, ("running",))["status"] for job_id in running] == ["running"] * 2
+
+        # 两个 worker 都占满：后续任务留在队列里，队列（容量 2）满后拒绝
+        queued = [_submit(client, f"作答{i}").json()["jobId"] for i in range(2, 4)]
+        full = _submit(client, "作答4")
+        assert full.status_code == 503 and full.headers["retry-after"] == "30"
+        time.sleep(0.1)
+        assert [client.get(f"/api/grade/jobs/{job_id}").json()["status"] for job_id in queued] == ["queued"] * 2
+        assert grading.max_running == 2
+
+        grading.release.set()
+        assert [_wait_for(client, job_id, ("done", "failed"))["status"] for job_id in running + queued] == ["done"] * 4
+        assert grading.max_running == 2 and grading.running == 0
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""测试批改会话存储：保存与取回、If-None-Match 返回 notModified、只有原所有者能覆盖（不带客户端 id 的记录也不能被认领）、
+过期记录取不到且可被重新使用、按 nextBefore 分页查询历史。"""
+import os
+import tempfile
+import types
+
+import pytest
+
+os.environ.setdefault("GRADE_SESSIONS_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="sessions_test_"), "sessions.db"))
+
+import grade_sessions  # noqa: E402
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch, tmp_path) -> _Clock:
+    clock = _Clock()
+    monkeypatch.setattr(grade_sessions, "time", types.SimpleNamespace(time=clock.time))
+    monkeypatch.setattr(grade_sessions, "_DB_PATH", str(tmp_path / "sessions.db"))
+    monkeypatch.setattr(grade_sessions, "_TTL_SECONDS", 3600)
+    monkeypatch.setattr(grade_sessions, "_counters", {k: 0 for k in grade_sessions._counters})
+    monkeypatch.setattr(grade_sessions, "_saves_since_trim", 0)
+    grade_sessions._init_db()
+    return clock
+
+
+def _result(score: float) -> dict:
+    return {"score": score, "maxScore": 20, "grade": "B档（良好）", "content": f"得分 {score}"}
+
+
+def test_save_get_and_not_modified(clock):
+    etag = grade_sessions.save("s1", _result(15), "client-a", "1.1.1.1", "paper-1", ["q1", 2])
+    assert etag and etag.startswith('"')
+    record = grade_sessions.get("s1")
+    assert record["result"] == _result(15) and record["etag"] == etag and not record["notModified"]
+    assert record["paperId"] == "paper-1" and record["questionIds"] == ["q1", "2"] and record["score"] == 15
+
+    cached = grade_sessions.get("s1", f'"other", {etag}')
+    assert cached["notModified"] and "result" not in cached
+    assert grade_sessions.get("missing") is None and grade_sessions.get("x" * 200) is None
+    assert grade_sessions.save("x" * 200, _result(1)) is None
+    stats = grade_sessions.get_stats()
+    assert stats["hits"] == 1 and stats["not_modified"] == 1 and stats["misses"] == 1
+
+
+def test_only_owner_can_overwrite(clock):
+    assert grade_sessions.save("owned", _result(10), "client-a", "1.1.1.1")
+    assert grade_sessions.save("owned", _result(12), "client-a", "2.2.2.2")     # 同一客户端换了网络
+    assert grade_sessions.save("owned", _result(0), "client-b", "1.1.1.1") is None
+    assert grade_sessions.save("owned", _result(0), None, "1.1.1.1") is None
+    assert grade_sessions.get("owned")["score"] == 12
+
+    # 不带客户端 id 的记录：只有同一 IP、同样不带 id 的请求能覆盖，带 id 的请求不能认领
+    assert grade_sessions.save("anon", _result(10), None, "3.3.3.3")
+    assert grade_sessions.save("anon", _result(0), "client-b", "3.3.3.3") is None
+    assert grade_sessions.save("anon", _result(0), None, "4.4.4.4") is None
+    assert grade_sessions.save("anon", _result(11), None, "3.3.3.3")
+    assert grade_sessions.get("anon")["score"] == 11
+    assert grade_sessions.list_sessions("client-b")["items"] == []
+    assert grade_sessions.get_stats()["rejected"] == 4
+
+
+def test_expired_records_are_hidden_trimmed_and_reusable(clock):
+    grade_sessions.save("old", _result(10), "client-a", "1.1.1.1")
+    clock.now += 3601
+    assert grade_sessions.get("old") is None
+    assert grade_sessions.list_sessions("client-a")["items"] == []
+
+    # 过期记录视为不存在：其他客户端可重新使用该 id，创建时间随之更新
+    assert grade_sessions.save("old", _result(5), "client-b", "5.5.5.5")
+    item = grade_sessions.list_sessions("client-b")["items"][0]
+    assert item["sessionId"] == "old" and item["createdAt"] == clock.now
+
+    grade_sessions.save("stale", _result(1), "client-c", "1.1.1.1")
+    clock.now += 3601
+    grade_sessions._trim()
+    assert grade_sessions.get_stats()["expired"] == 2
+
+
+def test_list_sessions_paginates_with_next_before(clock):
+    for i in range(5):
+        grade_sessions.save(f"s{i}", _result(i), "client-a", "1.1.1.1", "paper-1", [f"q{i}"])
+        clock.now += 10
+    grade_sessions.save("other", _result(9), "client-b", "1.1.1.1")
+
+    first = grade_sessions.list_sessions("client-a", limit=2)
+    assert [i["sessionId"] for i in first["items"]] == ["s4", "s3"]
+    assert "content" not in first["items"][0]
+    second = grade_sessions.list_sessions("client-a", limit=2, before=first["nextBefore"])
+    assert [i["sessionId"] for i in second["items"]] == ["s2", "s1"]
+    last = grade_sessions.list_sessions("client-a", limit=2, before=second["nextBefore"])
+    assert [i["sessionId"] for i in last["items"]] == ["s0"] and last["nextBefore"] is None
+    assert len(grade_sessions.list_sessions("client-a", limit=1000)["items"]) == 5
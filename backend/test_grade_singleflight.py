@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""测试相同批改的合并（single-flight）：同时提交的相同答案只调用一次上游、各请求拿到同一结果；
+截止时间较短的跟随方到时返回 504，共享的上游调用不受影响，发起方照常拿到结果；最后一个等待方离开时才取消上游调用。"""
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import time
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+_TMP = tempfile.mkdtemp(prefix="singleflight_test_")
+os.environ.setdefault("GRADE_JOBS_DB_PATH", os.path.join(_TMP, "jobs.db"))
+os.environ.setdefault("GRADE_SESSIONS_DB_PATH", os.path.join(_TMP, "sessions.db"))
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ.setdefault("STATS_DB_PATH", os.path.join(_TMP, "stats.db"))
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+
+
+class _Request:
+    """_grade_payload 用到的最小请求对象：X-Grade-Timeout 请求头、客户端地址、是否已断开。"""
+
+    def __init__(self, timeout: float):
+        self.headers = {"x-grade-timeout": str(timeout)}
+        self.client = None
+
+    async def is_disconnected(self) -> bool:
+        return False
+
+
+class _Upstream:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.calls = 0
+        self.finished = 0
+
+    async def __call__(self, ctx):
+        self.calls += 1
+        await asyncio.sleep(self.seconds)
+        self.finished += 1
+        return f"批改报告（{ctx['grading_session_id']} 发起）"
+
+
+def _setup(monkeypatch, upstream_seconds: float) -> _Upstream:
+    upstream = _Upstream(upstream_seconds)
+    cache_key = uuid.uuid4().hex        # 结果缓存（内存层）会记住前一个测试的结果：每个测试用新的指纹
+
+    def prepare(payload):
+        return {
+            "cache_key": cache_key,
+            "grading_session_id": payload["session"],
+            "has_essay": False,
+            "answer_images": [],
+            "prompt_format": "test",
+        }
+
+    monkeypatch.setattr(main, "_prepare_grading", prepare)
+    monkeypatch.setattr(main, "_call_grading_providers", upstream)
+    monkeypatch.setattr(main, "_build_grading_result", lambda ctx, raw: {"score": 18, "maxScore": 20, "content": raw})
+    monkeypatch.setattr(main, "_record_submit_stat", lambda has_essay, ip: None)
+    monkeypatch.setattr(main, "_GRADE_MIN_ATTEMPT_SECONDS", 0.05)
+    monkeypatch.setattr(main, "_DISCONNECT_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(main, "_singleflight_stats", {k: 0 for k in main._singleflight_stats})
+    monkeypatch.setattr(main, "_deadline_stats", {"timeouts": 0, "skipped_attempts": 0})
+    return upstream
+
+
+async def _grade(session: str, timeout: float, start_after: float = 0.0):
+    await asyncio.sleep(start_after)
+    try:
+        return await main._grade_payload(_Request(timeout), {"session": session})
+    except HTTPException as e:
+        return e
+
+
+def _run(coro):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(coro)
+
+
+def test_concurrent_identical_requests_share_one_upstream_call(monkeypatch):
+    upstream = _setup(monkeypatch, 0.2)
+
+    async def both():
+        return await asyncio.gather(_grade("leader", 30), _grade("follower", 30, start_after=0.05))
+
+    leader, follower = _run(both())
+    assert upstream.calls == 1
+    assert leader == follower and leader["content"] == "批改报告（leader 发起）"
+    assert main._singleflight_stats["upstream_calls"] == 1 and main._singleflight_stats["coalesced"] == 1
+    assert main._inflight_gradings == {} and main._inflight_waiters == {}
+
+
+def test_follower_with_shorter_deadline_times_out_while_leader_continues(monkeypatch):
+    upstream = _setup(monkeypatch, 2.5)
+
+    async def both():
+        return await asyncio.gather(_grade("leader", 30), _grade("follower", 0.1, start_after=0.05))
+
+    started = time.monotonic()
+    leader, follower = _run(both())
+    # 跟随方按自己的截止时间（0.1 秒，另加 2 秒宽限）等待，不会等到发起方的上游返回
+    assert isinstance(follower, HTTPException) and follower.status_code == 504
+    assert follower.detail == main._GRADING_TIMEOUT_DETAIL and main._deadline_stats["timeouts"] == 1
+    # 跟随方放弃不取消共享的上游调用：发起方照常拿到结果，上游只调用一次
+    assert leader["content"] == "批改报告（leader 发起）"
+    assert upstream.calls == 1 and upstream.finished == 1
+    assert time.monotonic() - started < 5
+    assert main._inflight_gradings == {} and main._inflight_waiters == {}
+
+
+@pytest.mark.parametrize("waiters", [1, 2])
+def test_upstream_cancelled_only_when_last_waiter_leaves(monkeypatch, waiters):
+    upstream = _setup(monkeypatch, 0.5)
+    monkeypatch.setattr(main, "_disconnect_stats", dict(main._disconnect_stats, cancelled_gradings=0))
+    ctx = main._prepare_grading({"session": "leaver"})
+
+    async def leave_early():
+        tasks = [asyncio.ensure_future(main._run_grading(dict(ctx))) for _ in range(waiters)]
+        await asyncio.sleep(0.05)
+        tasks[0].cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        return results[1:]
+
+    rest = _run(leave_early())
+    if waiters == 1:
+        assert upstream.finished == 0 and main._disconnect_stats["cancelled_gradings"] == 1
+    else:
+        assert rest[0]["content"] == "批改报告（leaver 发起）" and upstream.finished == 1
+        assert main._disconnect_stats["cancelled_gradings"] == 0
+    assert upstream.calls == 1
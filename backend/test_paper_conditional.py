@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""测试试卷条件请求：/api/paper 的强 ETag 与 Last-Modified、If-None-Match（含压缩版本的弱 ETag）与 If-Modified-Since 返回 304、
+试卷原地修改后 ETag 变化；/api/papers/validate 批量校验只返回有变化与已不存在的试卷；/api/list 的 ETag。"""
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="paper_conditional_test_")
+os.environ.setdefault("GRADE_JOBS_DB_PATH", os.path.join(_TMP, "jobs.db"))
+os.environ.setdefault("GRADE_SESSIONS_DB_PATH", os.path.join(_TMP, "sessions.db"))
+os.environ.setdefault("GRADE_CACHE_DB_PATH", "off")
+os.environ.setdefault("STATS_DB_PATH", os.path.join(_TMP, "stats.db"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import paper_store  # noqa: E402
+import papers_snapshot  # noqa: E402
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import main  # noqa: E402
+
+
+def _write_paper(data_dir, pid: str, name: str):
+    content = {
+        "id": pid,
+        "name": name,
+        "region": "江苏",
+        "year": 2024,
+        "materials": [{"title": "材料一", "content": "基层治理" * 200}],
+        "questions": [{"id": "q1", "title": "概括主要做法"}],
+    }
+    with open(os.path.join(data_dir, f"{pid}.json"), "w", encoding="utf-8") as f:
+        json.dump(content, f, ensure_ascii=False)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    for i in range(3):
+        _write_paper(tmp_path, f"p{i}", f"测试试卷{i}")
+    monkeypatch.setattr(main, "get_data_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(papers_snapshot, "_PATH", "")
+    monkeypatch.setattr(paper_store, "_BUDGET_BYTES", 0)
+    monkeypatch.setattr(paper_store, "_index", {})
+    monkeypatch.setattr(paper_store, "_resident", OrderedDict())
+    monkeypatch.setattr(paper_store, "_resident_bytes", 0)
+    monkeypatch.setattr(paper_store, "_index_complete", False)
+    monkeypatch.setattr(main, "_papers_listing", main._papers_listing)
+    monkeypatch.setattr(main, "_paper_conditional_stats", {k: 0 for k in main._paper_conditional_stats})
+    with contextlib.redirect_stdout(io.StringIO()):
+        main._build_index()
+    return TestClient(main.app)
+
+
+def test_paper_conditional_get(client, tmp_path):
+    r = client.get("/api/paper", params={"id": "p0"}, headers={"Accept-Encoding": "identity"})
+    assert r.status_code == 200 and r.json()["name"] == "测试试卷0"
+    etag, last_modified = r.headers["etag"], r.headers["last-modified"]
+    assert etag.startswith('"') and "Accept-Encoding" in r.headers["vary"]
+
+    # 压缩版本带弱 ETag；带回强或弱 ETag 都返回 304，304 的 ETag 与 Vary 与对应的 200 一致
+    gz = client.get("/api/paper", params={"id": "p0"}, headers={"Accept-Encoding": "gzip"})
+    assert gz.headers["content-encoding"] == "gzip" and gz.headers["etag"] == f"W/{etag}"
+    for tag, encoding, expected in ((etag, "gzip", f"W/{etag}"), (f"W/{etag}", "identity", etag)):
+        nm = client.get("/api/paper", params={"id": "p0"}, headers={"If-None-Match": tag, "Accept-Encoding": encoding})
+        assert nm.status_code == 304 and nm.content == b""
+        assert nm.headers["etag"] == expected and "Accept-Encoding" in nm.headers["vary"]
+
+    # If-None-Match 优先于 If-Modified-Since
+    assert client.get("/api/paper", params={"id": "p0"}, headers={"If-Modified-Since": last_modified}).status_code == 304
+    stale = client.get("/api/paper", params={"id": "p0"}, headers={"If-None-Match": '"old"', "If-Modified-Since": last_modified})
+    assert stale.status_code == 200
+    assert main._paper_conditional_stats["not_modified"] == 3
+
+    # 原地修改（mtime 变新）后 ETag 随内容变化
+    _write_paper(tmp_path, "p0", "测试试卷0（修订）")
+    future = time.time() + 5
+    os.utime(tmp_path / "p0.json", (future, future))
+    r2 = client.get("/api/paper", params={"id": "p0"}, headers={"If-None-Match": etag})
+    assert r2.status_code == 200 and r2.json()["name"] == "测试试卷0（修订）" and r2.headers["etag"] != etag
+
+    assert client.get("/api/paper", params={"id": "../p0"}).status_code == 404
+    assert client.get("/api/paper", params={"id": "nope"}).status_code == 404
+
+
+def test_validate_papers_returns_only_changed_and_missing(client):
+    etags = {
+        pid: client.get("/api/paper", params={"id": pid}, headers={"Accept-Encoding": "identity"}).headers["etag"]
+        for pid in ("p0", "p1")
+    }
+    r = client.post("/api/papers/validate", json={"papers": [
+        {"id": "p0", "etag": f"W/{etags['p0']}"},
+        {"id": "p1", "etag": '"old"'},
+        {"id": "p2"},
+        {"id": "gone", "etag": '"x"'},
+    ]})
+    assert r.status_code == 200 and r.headers["cache-control"] == "no-store"
+    data = r.json()
+    assert data["unchanged"] == 1 and data["missing"] == ["gone"]
+    assert [c["id"] for c in data["changed"]] == ["p1", "p2"]
+    assert data["changed"][0]["etag"] == etags["p1"] and data["changed"][0]["lastModified"]
+    assert data["changed"][0]["paper"] == client.get("/api/paper", params={"id": "p1"}).json()
+    stats = main._paper_conditional_stats
+    assert stats["batch_checked"] == 4 and stats["batch_changed"] == 2 and stats["batch_missing"] == 1
+
+    assert client.post("/api/papers/validate", json={"papers": "p0"}).status_code == 400
+    assert client.post("/api/papers/validate", json={"papers": [{"etag": '"x"'}]}).status_code == 400
+    too_many = [{"id": f"p{i}"} for i in range(main.MAX_VALIDATE_PAPERS + 1)]
+    assert client.post("/api/papers/validate", json={"papers": too_many}).status_code == 400
+
+
+def test_list_etag(client):
+    r = client.get("/api/list", headers={"Accept-Encoding": "br"})
+    assert sorted(p["id"] for p in r.json()) == ["p0", "p1", "p2"]
+    # 三份试卷的索引不足 MIN_SIZE，不压缩，ETag 为强 ETag
+    assert "content-encoding" not in r.headers and r.headers["etag"].startswith('"')
+    nm = client.get("/api/list", headers={"If-None-Match": r.headers["etag"], "Accept-Encoding": "br"})
+    assert nm.status_code == 304 and nm.headers["etag"] == r.headers["etag"]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""测试试卷存储：预算为 0 时全部常驻、按内存预算懒加载与最近最少使用淘汰、被淘汰的试卷再次访问时从磁盘读回、
+不安全的 id 不去磁盘查找。"""
+import json
+import os
+from collections import OrderedDict
+
+import paper_store
+import papers_snapshot
+
+
+def _prefixes(paper):
+    return {(paper["id"], q["id"]): {"body": f"{paper['name']}｜{q['id']}"} for q in paper.get("questions", [])}
+
+
+def _setup(monkeypatch, tmp_path, budget_bytes: int, papers: int = 4) -> str:
+    for i in range(papers):
+        content = {
+            "id": f"p{i}",
+            "name": f"测试试卷{i}",
+            "region": "北京",
+            "materials": [{"content": f"材料{i}-" + "段落文字" * 200}],
+            "questions": [{"id": "q1", "title": "第一题"}],
+        }
+        (tmp_path / f"p{i}.json").write_text(json.dumps(content, ensure_ascii=False), encoding="utf-8")
+    monkeypatch.setattr(papers_snapshot, "_PATH", "")
+    monkeypatch.setattr(paper_store, "_BUDGET_BYTES", budget_bytes)
+    monkeypatch.setattr(paper_store, "_index", {})
+    monkeypatch.setattr(paper_store, "_resident", OrderedDict())
+    monkeypatch.setattr(paper_store, "_resident_bytes", 0)
+    monkeypatch.setattr(paper_store, "_index_complete", False)
+    monkeypatch.setattr(paper_store, "_data_dir", "")
+    monkeypatch.setattr(paper_store, "_prefix_builder", None)
+    monkeypatch.setattr(paper_store, "_counters", {k: 0 for k in paper_store._counters})
+    paper_store.load(str(tmp_path), _prefixes, "test")
+    if budget_bytes:
+        # 没有快照时启动读入的试卷按预算留作热数据；清空后从冷启动开始计
+        assert len(paper_store._resident) == 1 and paper_store.get_stats()["evictions"] == papers - 1
+        for pid in list(paper_store._resident):
+            paper_store._drop_locked(pid)
+        monkeypatch.setattr(paper_store, "_counters", {k: 0 for k in paper_store._counters})
+    return str(tmp_path)
+
+
+def test_zero_budget_keeps_everything_resident(monkeypatch, tmp_path):
+    _setup(monkeypatch, tmp_path, 0)
+    stats = paper_store.get_stats()
+    assert stats["papers"] == 4 and stats["resident"] == {"json": 4, "paper": 4, "prefixes": 4}
+    assert paper_store.get_prefix("p1", "q1") == {"body": "测试试卷1｜q1"}
+    assert paper_store.get_stats()["disk_loads"] == 0
+
+
+def test_budget_evicts_least_recently_used(monkeypatch, tmp_path):
+    _setup(monkeypatch, tmp_path, 1)
+    assert paper_store.get_stats()["resident"]["json"] == 0
+    assert {m["id"] for m in paper_store.index_entries()} == {"p0", "p1", "p2", "p3"}
+
+    # 只剩一份：刚访问的试卷即使单独超出预算也保留
+    assert paper_store.get_json("p0") is not None
+    assert list(paper_store._resident) == ["p0"]
+    one = paper_store._resident["p0"]["size"]
+
+    # 预算约两份试卷的响应字节
+    monkeypatch.setattr(paper_store, "_BUDGET_BYTES", int(one * 2.5))
+    paper_store.get_json("p1")
+    paper_store.get_json("p0")                  # p0 变为最近使用
+    paper_store.get_json("p2")                  # 超出预算，淘汰最久未用的 p1
+    assert list(paper_store._resident) == ["p0", "p2"]
+    stats = paper_store.get_stats()
+    assert stats["evictions"] == 1 and stats["resident_bytes"] <= paper_store._BUDGET_BYTES
+    assert stats["hits"] == 1 and stats["disk_loads"] == 3
+
+    # 被淘汰的试卷再次访问时从磁盘读回，响应字节不变
+    body, _ = paper_store.get_json("p1")
+    assert json.loads(body)["id"] == "p1"
+    assert list(paper_store._resident) == ["p2", "p1"]
+    assert paper_store.get_stats()["disk_loads"] == 4
+
+
+def test_parsed_paper_and_prefixes_count_toward_budget(monkeypatch, tmp_path):
+    _setup(monkeypatch, tmp_path, 1)
+    paper_store.get_json("p0")
+    json_only = paper_store._resident["p0"]["size"]
+    paper = paper_store.get_paper("p0")
+    assert paper["id"] == "p0" and paper_store.is_current(paper)
+    assert paper_store._resident["p0"]["size"] > json_only
+    assert paper_store.get_prefix("p0", "q1") == {"body": "测试试卷0｜q1"}
+    stats = paper_store.get_stats()
+    assert stats["parses"] == 1 and stats["prefix_builds"] == 1 and stats["disk_loads"] == 1
+
+    # 淘汰后只读响应字节，需要 paper 时再由字节解析
+    monkeypatch.setattr(paper_store, "_BUDGET_BYTES", json_only)
+    paper_store.get_json("p1")
+    assert list(paper_store._resident) == ["p1"]
+    paper_store.get_json("p0")
+    assert paper_store._resident["p0"]["paper"] is None
+    assert paper_store.get_paper("p0")["name"] == "测试试卷0"
+    assert paper_store.get_stats()["parses"] == 2
+
+
+def test_unsafe_ids_never_reach_disk(monkeypatch, tmp_path):
+    data_dir = _setup(monkeypatch, tmp_path, 1)
+    (tmp_path.parent / "outside.json").write_text(json.dumps({"id": "outside"}), encoding="utf-8")
+    assert not paper_store.valid_id("../outside") and not paper_store.valid_id("a/b")
+    assert not paper_store.valid_id(None) and paper_store.valid_id("paper_2024-01")
+    assert paper_store.get_json("../outside") is None
+    assert paper_store.get_stats()["disk_loads"] == 0
+
+    # 不在索引中的合法 id 可从 data 目录读到，但不加入索引
+    with open(os.path.join(data_dir, "extra.json"), "w", encoding="utf-8") as f:
+        json.dump({"id": "extra", "name": "新增试卷"}, f, ensure_ascii=False)
+    assert paper_store.get_paper("extra")["name"] == "新增试卷"
+    assert "extra" not in {m["id"] for m in paper_store.index_entries()}
+
+    # 目录监视运行中时索引即为全部试卷，不再去磁盘查找
+    paper_store._drop_locked("extra")
+    monkeypatch.setattr(paper_store, "_index_complete", True)
+    assert paper_store.get_paper("extra") is None
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""测试试卷目录监视：对账时按文件签名找出新增 / 修改 / 删除的文件、经 paper_store.apply_changes 增量更新索引、
+轮询方式的后台线程发现改动并可停止、重建出错时计数而不中断监视。"""
+import json
+import os
+import time
+from collections import OrderedDict
+
+import paper_store
+import paper_watcher
+import papers_snapshot
+
+
+def _write_paper(data_dir, pid: str, name: str, filename: str = ""):
+    with open(os.path.join(data_dir, filename or f"{pid}.json"), "w", encoding="utf-8") as f:
+        json.dump({"id": pid, "name": name, "questions": []}, f, ensure_ascii=False)
+
+
+def _reset(monkeypatch):
+    monkeypatch.setattr(paper_watcher, "_counters", {k: (None if k.startswith("last_") else 0) for k in paper_watcher._counters})
+
+
+def _load_store(monkeypatch, data_dir):
+    monkeypatch.setattr(papers_snapshot, "_PATH", "")
+    monkeypatch.setattr(paper_store, "_BUDGET_BYTES", 0)
+    monkeypatch.setattr(paper_store, "_index", {})
+    monkeypatch.setattr(paper_store, "_resident", OrderedDict())
+    monkeypatch.setattr(paper_store, "_resident_bytes", 0)
+    monkeypatch.setattr(paper_store, "_index_complete", False)
+    paper_store.load(str(data_dir), lambda paper: {}, "test")
+
+
+def test_reconcile_reports_added_changed_and_removed(monkeypatch, tmp_path):
+    _reset(monkeypatch)
+    _write_paper(tmp_path, "same", "未变")
+    _write_paper(tmp_path, "edited", "已修改")
+    _write_paper(tmp_path, "new", "新增")
+    (tmp_path / "notes.txt").write_text("不是试卷", encoding="utf-8")
+    os.mkdir(tmp_path / "images")
+    files = papers_snapshot.scan(str(tmp_path))
+    known = {"same.json": files["same.json"][0], "edited.json": (1, 1), "deleted.json": (1, 1)}
+    calls = []
+
+    def on_change(names):
+        calls.append(list(names))
+        return {"added": 1, "changed": 1, "removed": 1}
+
+    paper_watcher._reconcile(str(tmp_path), lambda: known, on_change)
+    assert calls == [["deleted.json", "edited.json", "new.json"]]
+    stats = paper_watcher.get_stats()
+    assert stats["scans"] == 1 and stats["reindexes"] == 1 and stats["files"] == 3
+
+    # 没有变化时不调用 on_change
+    paper_watcher._reconcile(str(tmp_path), lambda: {n: sig for n, (sig, _) in files.items()}, on_change)
+    assert len(calls) == 1 and paper_watcher.get_stats()["scans"] == 2
+
+
+def test_reconcile_updates_paper_store_incrementally(monkeypatch, tmp_path):
+    _reset(monkeypatch)
+    _write_paper(tmp_path, "p1", "试卷一")
+    _write_paper(tmp_path, "p2", "试卷二")
+    _load_store(monkeypatch, tmp_path)
+    results = []
+
+    def on_change(names):
+        results.append(paper_store.apply_changes(names))
+        return results[-1]
+
+    _write_paper(tmp_path, "p3", "试卷三")
+    _write_paper(tmp_path, "p1", "试卷一（修订）")
+    future = time.time() + 5
+    os.utime(tmp_path / "p1.json", (future, future))
+    os.remove(tmp_path / "p2.json")
+    paper_watcher._reconcile(str(tmp_path), paper_store.file_sigs, on_change)
+    assert results == [{"added": 1, "changed": 1, "removed": 1}]
+    assert sorted(m["id"] for m in paper_store.index_entries()) == ["p1", "p3"]
+    assert paper_store.get_paper("p1")["name"] == "试卷一（修订）"
+    assert paper_store.get_paper("p2") is None
+
+    # 文件内的 id 被改掉：旧 id 移出索引
+    _write_paper(tmp_path, "p3-renamed", "试卷三", filename="p3.json")
+    os.utime(tmp_path / "p3.json", (future + 1, future + 1))
+    paper_watcher._reconcile(str(tmp_path), paper_store.file_sigs, on_change)
+    assert results[-1] == {"added": 0, "changed": 1, "removed": 0}
+    assert sorted(m["id"] for m in paper_store.index_entries()) == ["p1", "p3-renamed"]
+
+    # 再次对账：签名一致，无变化
+    paper_watcher._reconcile(str(tmp_path), paper_store.file_sigs, on_change)
+    assert len(results) == 2
+
+
+def test_poll_thread_picks_up_changes_and_stops(monkeypatch, tmp_path):
+    _reset(monkeypatch)
+    monkeypatch.setattr(paper_watcher, "_MODE", "poll")
+    monkeypatch.setattr(paper_watcher, "_POLL_SECONDS", 0.05)
+    known = {}
+    seen = []
+
+    def on_change(names):
+        files = papers_snapshot.scan(str(tmp_path))
+        known.update({name: files[name][0] for name in names})
+        seen.extend(names)
+        return {"added": len(names)}
+
+    assert paper_watcher.start(str(tmp_path), lambda: dict(known), on_change)
+    try:
+        assert paper_watcher.active()
+        assert not paper_watcher.start(str(tmp_path), dict, on_change)      # 已在运行
+        _write_paper(tmp_path, "late", "启动后新增")
+        deadline = time.time() + 5
+        while "late.json" not in seen and time.time() < deadline:
+            time.sleep(0.02)
+        assert seen == ["late.json"]
+        assert paper_watcher.get_stats()["mode"] == "poll"
+    finally:
+        paper_watcher.stop()
+    assert not paper_watcher.active() and paper_watcher.get_stats()["mode"] is None
+
+
+def test_failed_reindex_is_counted(monkeypatch, tmp_path, capsys):
+    _reset(monkeypatch)
+    _write_paper(tmp_path, "p1", "试卷一")
+
+    def broken(names):
+        raise RuntimeError("磁盘错误")
+
+    paper_watcher._reconcile(str(tmp_path), dict, broken)
+    stats = paper_watcher.get_stats()
+    assert stats["errors"] == 1 and stats["reindexes"] == 0
+    assert "重建索引失败" in capsys.readouterr().out
+    paper_watcher._reconcile(str(tmp_path / "missing"), dict, broken)
+    assert paper_watcher.get_stats()["errors"] == 2
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""测试预压缩响应：Accept-Encoding 协商（q 值、br 优先、都不接受时原始字节）、不值得压缩的内容不保留压缩版本、
+压缩版本带 Vary 与弱 ETag、If-None-Match 弱比较与 304、/images 静态文件按编码返回。"""
+import gzip
+
+import brotli
+from starlette.applications import Starlette
+from starlette.datastructures import Headers
+from starlette.routing import Mount
+from starlette.testclient import TestClient
+
+import precompress
+
+_BODY = ("{" + ",".join(f'"k{i}": "试卷内容{i % 7}"' for i in range(200)) + "}").encode("utf-8")
+
+
+def test_negotiate_by_q_value_and_preference():
+    both = {"br": b"", "gzip": b""}
+    assert precompress.negotiate("gzip, deflate, br", both) == "br"            # q 相同时 br 优先
+    assert precompress.negotiate("br;q=0.5, gzip", both) == "gzip"
+    assert precompress.negotiate("gzip;q=0, br;q=0", both) is None
+    assert precompress.negotiate("*", both) == "br"
+    assert precompress.negotiate("*;q=0.1, gzip;q=0.2", both) == "gzip"
+    assert precompress.negotiate("br", ["gzip"]) is None                      # 没有该编码的压缩版本
+    assert precompress.negotiate("", both) is None
+    assert precompress.negotiate("gzip;q=abc, br;q=0.3", both) == "br"       # 无法解析的 q 视为 0
+
+
+def test_compress_skips_small_and_already_compressed():
+    variants = precompress.compress(_BODY)
+    assert set(variants) == {"br", "gzip"}
+    assert brotli.decompress(variants["br"]) == _BODY and gzip.decompress(variants["gzip"]) == _BODY
+    assert precompress.compress(b"{}") == {}
+    assert precompress.compress(_BODY, "image/png") == {}
+
+
+def test_response_sets_vary_weak_etag_and_304():
+    variants = precompress.compress(_BODY)
+    etag = '"abc123"'
+    br = precompress.response(Headers({"accept-encoding": "br"}), _BODY, variants, headers={"ETag": etag})
+    assert br.headers["content-encoding"] == "br" and br.headers["vary"] == "Accept-Encoding"
+    assert br.headers["etag"] == 'W/"abc123"' and br.body == variants["br"]
+    assert int(br.headers["content-length"]) == len(variants["br"])
+
+    plain = precompress.response(Headers({}), _BODY, variants, headers={"ETag": etag})
+    assert "content-encoding" not in plain.headers and plain.headers["vary"] == "Accept-Encoding"
+    assert plain.headers["etag"] == etag and plain.body == _BODY
+
+    # 没有压缩版本的内容不带 Vary
+    assert "vary" not in precompress.response(Headers({"accept-encoding": "br"}), b"{}", {}).headers
+
+    # 304 的 ETag 与 Vary 与对应的 200 响应一致
+    nm = precompress.not_modified(Headers({"accept-encoding": "gzip"}), variants, {"ETag": etag})
+    assert nm.status_code == 304 and nm.headers["etag"] == 'W/"abc123"' and nm.headers["vary"] == "Accept-Encoding"
+
+    assert precompress.etag_matches('W/"abc123"', etag)
+    assert precompress.etag_matches('"other", "abc123"', etag)
+    assert precompress.etag_matches("*", etag)
+    assert not precompress.etag_matches('"other"', etag) and not precompress.etag_matches("", etag)
+
+
+def test_static_files_negotiate_and_revalidate(tmp_path):
+    (tmp_path / "data.json").write_bytes(_BODY)
+    (tmp_path / "pic.png").write_bytes(b"\x89PNG" + bytes(2000))
+    app = Starlette(routes=[Mount("/images", app=precompress.PrecompressedStaticFiles(directory=str(tmp_path)))])
+    client = TestClient(app)
+
+    gz = client.get("/images/data.json", headers={"Accept-Encoding": "gzip"})
+    assert gz.status_code == 200 and gz.headers["content-encoding"] == "gzip"
+    assert gz.content == _BODY and gz.headers["etag"].startswith("W/")
+    assert gz.headers["vary"] == "Accept-Encoding" and gz.headers["content-type"].startswith("application/json")
+
+    # 原始编码：StaticFiles 的 FileResponse，同样带 Vary，ETag 为强 ETag
+    plain = client.get("/images/data.json", headers={"Accept-Encoding": "identity"})
+    assert plain.status_code == 200 and "content-encoding" not in plain.headers
+    assert plain.content == _BODY and plain.headers["vary"] == "Accept-Encoding"
+    assert not plain.headers["etag"].startswith("W/")
+    assert int(plain.headers["content-length"]) == len(_BODY)
+
+    # 带回压缩版本的弱 ETag 仍按同一份内容校验
+    nm = client.get("/images/data.json", headers={"Accept-Encoding": "br", "If-None-Match": gz.headers["etag"]})
+    assert nm.status_code == 304 and nm.headers["etag"].startswith("W/") and nm.headers["vary"] == "Accept-Encoding"
+
+    # Range 请求与已压缩的图片直接交给 StaticFiles
+    part = client.get("/images/data.json", headers={"Accept-Encoding": "br", "Range": "bytes=0-9"})
+    assert part.status_code == 206 and part.content == _BODY[:10] and "content-encoding" not in part.headers
+    png = client.get("/images/pic.png", headers={"Accept-Encoding": "br"})
+    assert png.status_code == 200 and "content-encoding" not in png.headers and "vary" not in png.headers
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""测试 prompt token 估算与材料裁剪：按文字类别估算、按相关度从低到高删去段落、每份材料至少保留一个段落、
+最多删去 PROMPT_TRIM_MAX_RATIO 比例、分段统计。"""
+import copy
+
+import prompt_budget
+
+
+def test_estimate_tokens_by_script():
+    assert prompt_budget.estimate_tokens("") == 0
+    assert prompt_budget.estimate_tokens("春眠不觉晓") == 5
+    assert prompt_budget.estimate_tokens("hello world") == 4        # 两个单词各 ceil(5/4)，空格不计
+    assert prompt_budget.estimate_tokens("2024") == 2
+    assert prompt_budget.estimate_tokens("甲，乙\n\n丙") == 5         # 全角标点按中日韩字符计，连续换行计 1
+
+
+def test_trim_drops_least_relevant_and_keeps_one_paragraph_per_material(monkeypatch):
+    monkeypatch.setattr(prompt_budget, "_TRIM_MAX_RATIO", 1.0)
+    materials = [
+        {"title": "材料一", "content": "乡村振兴需要人才回流\n今天的天气非常晴朗\n城市交通越来越拥堵"},
+        {"title": "材料二", "content": "与题目毫无关系的一段描写"},
+    ]
+    original = copy.deepcopy(materials)
+    out, trimmed = prompt_budget.trim_materials(materials, "结合材料谈谈乡村振兴与人才", 10_000)
+
+    assert materials == original                    # 不修改传入的材料
+    assert out[0]["title"] == "材料一"
+    # 材料一只保留与题目最相关的段落，删去的连续段落合并为一个省略标记
+    assert out[0]["content"] == "乡村振兴需要人才回流\n" + prompt_budget.TRIM_MARKER
+    # 材料二只有一个段落，即使完全不相关也保留
+    assert out[1] is materials[1]
+    assert trimmed["paragraphs"] == 2
+    assert trimmed["tokens"] == prompt_budget.estimate_tokens("今天的天气非常晴朗") + prompt_budget.estimate_tokens(
+        "城市交通越来越拥堵"
+    )
+
+
+def test_trim_stops_at_excess_and_max_ratio(monkeypatch):
+    monkeypatch.setattr(prompt_budget, "_TRIM_MAX_RATIO", 1.0)
+    paras = ["乡村振兴人才", "无关段落甲甲", "无关段落乙乙乙乙", "乡村振兴政策"]
+    materials = [{"content": "\n".join(paras)}]
+    # 只超出 1 个 token：删去一个最不相关的段落（相关度相同时先删较长的）即可
+    out, trimmed = prompt_budget.trim_materials(materials, "乡村振兴", 1)
+    assert trimmed["paragraphs"] == 1
+    assert "无关段落乙乙乙乙" not in out[0]["content"] and "无关段落甲甲" in out[0]["content"]
+
+    # 比例上限为 0 时不删
+    monkeypatch.setattr(prompt_budget, "_TRIM_MAX_RATIO", 0.0)
+    out, trimmed = prompt_budget.trim_materials(materials, "乡村振兴", 10_000)
+    assert out == materials and trimmed == {"paragraphs": 0, "tokens": 0}
+
+
+def test_record_counts_sections_and_over_budget(monkeypatch):
+    monkeypatch.setattr(prompt_budget, "_BUDGET", 100)
+    counters = {k: 0 for k in prompt_budget._counters}
+    counters["tokens"] = {name: 0 for name in prompt_budget.SECTIONS}
+    monkeypatch.setattr(prompt_budget, "_counters", counters)
+    monkeypatch.setattr(prompt_budget, "_by_variant", {})
+    monkeypatch.setattr(prompt_budget, "_accuracy", {"samples": 0, "estimated": 0, "actual": 0})
+
+    prompt_budget.record({"instructions": 50, "materials": 80}, {"paragraphs": 2, "tokens": 30}, "compact")
+    prompt_budget.record({"instructions": 50, "materials": 10})
+    prompt_budget.note_actual(100, 120)
+    stats = prompt_budget.get_stats()
+    assert stats["requests"] == 2 and stats["over_budget"] == 1 and stats["max_total"] == 130
+    assert stats["trimmed"] == 1 and stats["trimmed_paragraphs"] == 2 and stats["trimmed_tokens"] == 30
+    assert stats["avg_tokens"]["materials"] == 45
+    assert stats["avg_total_by_format"] == {"compact": 130, "default": 60}
+    assert stats["actual_to_estimated"] == 1.2
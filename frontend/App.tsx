@@ -18,8 +18,9 @@ const LS_PAPERS_LIST = `shenlun_papers_v6_${encodeURIComponent(API_BASE)}`;
 /**
  * 试卷详情 localStorage：须带版本号。仅改 backend JSON 时用户浏览器可能仍用旧缓存（含已删的 OCR 占位），
  * bump 版本号可全员失效旧缓存；启动时也会清掉旧前缀键。
+ * 每条存 { etag, paper }：启动时把缓存的 (id, etag) 交给 /api/papers/validate 批量校验，只重新下载有变化的试卷。
  */
-const LS_PAPER_DETAIL_PREFIX = `shenlun_pd_v80_${encodeURIComponent(API_BASE)}_`;
+const LS_PAPER_DETAIL_PREFIX = `shenlun_pd_v81_${encodeURIComponent(API_BASE)}_`;
 const MAX_CACHED_DETAILS = 30;
 
 function removeLegacyPaperDetailCaches() {
@@ -53,17 +54,48 @@ function writeCachedList(papers: Paper[]) {
 function readCachedDetail(id: string): Paper | null {
   try {
     const raw = localStorage.getItem(LS_PAPER_DETAIL_PREFIX + id);
-    return raw ? JSON.parse(raw) : null;
+    return raw ? JSON.parse(raw).paper ?? null : null;
   } catch { return null; }
 }
 
-function writeCachedDetail(id: string, paper: Paper) {
+function writeCachedDetail(id: string, paper: Paper, etag: string | null) {
   try {
-    localStorage.setItem(LS_PAPER_DETAIL_PREFIX + id, JSON.stringify(paper));
+    localStorage.setItem(LS_PAPER_DETAIL_PREFIX + id, JSON.stringify({ etag, paper }));
     evictOldDetails();
   } catch {}
 }
 
+/** 批量校验缓存的试卷详情：有变化的写回新内容，已下架的删除；返回 { id: 新内容或 null（已删除） } */
+async function revalidateCachedDetails(): Promise<Record<string, Paper | null>> {
+  const entries: { id: string; etag: string }[] = [];
+  try {
+    for (let i = 0; i < localStorage.length; i++) {
+      const k = localStorage.key(i);
+      if (!k?.startsWith(LS_PAPER_DETAIL_PREFIX)) continue;
+      const etag = JSON.parse(localStorage.getItem(k) || '{}').etag;
+      if (etag) entries.push({ id: k.slice(LS_PAPER_DETAIL_PREFIX.length), etag });
+    }
+  } catch {}
+  if (entries.length === 0) return {};
+  const res = await fetch(`${API_BASE}/api/papers/validate`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ papers: entries }),
+  });
+  if (!res.ok) return {};
+  const data = await res.json();
+  const updates: Record<string, Paper | null> = {};
+  for (const item of data.changed || []) {
+    writeCachedDetail(item.id, item.paper, item.etag);
+    updates[item.id] = item.paper;
+  }
+  for (const id of data.missing || []) {
+    try { localStorage.removeItem(LS_PAPER_DETAIL_PREFIX + id); } catch {}
+    updates[id] = null;
+  }
+  return updates;
+}
+
 function evictOldDetails() {
   try {
     const keys: string[] = [];
@@ -129,6 +161,18 @@ const App: React.FC = () => {
     if (savedHistory) setHistory(JSON.parse(savedHistory));
   }, []);
 
+  // 启动时批量校验本地缓存的试卷详情（后端试卷原地修改后，旧缓存不必靠 bump 版本号失效）
+  useEffect(() => {
+    revalidateCachedDetails()
+      .then(updates => {
+        Object.entries(updates).forEach(([id, paper]) => {
+          if (paper) paperDetailMemCache.current.set(id, paper);
+          else paperDetailMemCache.current.delete(id);
+        });
+      })
+      .catch(() => {});
+  }, []);
+
   const getUrl = () => window.location.pathname + window.location.search;
 
   // 同步地址栏与页面状态，并响应手机物理返回键/手势（保证每次进子页都 pushState，返回时回到上一页而非退出网站）
@@ -219,11 +263,11 @@ const App: React.FC = () => {
     }
     inflightPrefetches.current.add(paperId);
     fetch(`${API_BASE}/api/paper?id=${paperId}`, { cache: 'no-store' })
-      .then(res => res.ok ? res.json() : null)
-      .then(data => {
-        if (data) {
-          paperDetailMemCache.current.set(paperId, data);
-          writeCachedDetail(paperId, data);
+      .then(async res => res.ok ? { data: await res.json(), etag: res.headers.get('ETag') } : null)
+      .then(result => {
+        if (result?.data) {
+          paperDetailMemCache.current.set(paperId, result.data);
+          writeCachedDetail(paperId, result.data, result.etag);
         }
       })
       .catch(() => {})
@@ -263,7 +307,7 @@ const App: React.FC = () => {
       const fullPaperData = await response.json();
 
       paperDetailMemCache.current.set(summaryPaper.id, fullPaperData);
-      writeCachedDetail(summaryPaper.id, fullPaperData);
+      writeCachedDetail(summaryPaper.id, fullPaperData, response.headers.get('ETag'));
 
       setSelectedPaper(fullPaperData);
       goToExam();